@@ -0,0 +1,195 @@
+import re
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from langchain_core.prompts import ChatPromptTemplate
+from pydantic import BaseModel, Field
+
+from .common import GraphState, ANALYSIS_MODE, ANALYSIS_MAP_REDUCE_MIN_LINES, ANALYSIS_CHUNK_LINES, \
+    ANALYSIS_CONCURRENCY
+from .prompts import analyze_section_prompt, analyze_reduce_prompt
+from .routing import select_route, get_chat_model
+from .structure import PROCEDURE_DIVISION, Paragraph, find_paragraphs, find_data_entries, words, defined_names, \
+    summarize_structure
+from .utils import print_info, print_error, format_copybooks_for_display
+
+SEVERITIES = ["high", "medium", "low"]
+
+
+class SectionFinding(BaseModel):
+    paragraph: str = Field(description="The paragraph or section the issue is in, as named in the code.")
+    severity: str = Field(description="Severity of the issue: 'high', 'medium' or 'low'.")
+    issue: str = Field(description="Thorough explanation of the issue.")
+    recommendation: str = Field(description="The recommended solution.")
+
+
+class SectionReview(BaseModel):
+    findings: List[SectionFinding] = Field(description="The issues found in the part, none if it needs no change.")
+
+
+class RankedFinding(BaseModel):
+    location: str = Field(description="Location of the issue, as given with its finding.")
+    severity: str = Field(description="Severity of the issue: 'high', 'medium' or 'low'.")
+    issue: str = Field(description="Thorough explanation of the issue.")
+    recommendation: str = Field(description="The recommended solution.")
+
+
+class AnalysisResult(BaseModel):
+    summary: str = Field(description="Overall critique of the program.")
+    findings: List[RankedFinding] = Field(description="The merged findings, from the most to the least important.")
+    grade: str = Field(description="Binary score 'good' or 'bad'.")
+
+
+class AnalysisChunk(NamedTuple):
+    # Lines of the part (0-based, end excluded) and the paragraphs it holds (none before the procedure division)
+    start: int
+    end: int
+    paragraphs: List[Paragraph]
+
+    @property
+    def location(self) -> str:
+        lines = f"lines {self.start + 1}-{self.end}"
+        if not self.paragraphs:
+            return lines
+        return f"{', '.join(paragraph.name for paragraph in self.paragraphs)} ({lines})"
+
+
+def use_map_reduce(program_lines: int, mode: str = ANALYSIS_MODE) -> bool:
+    if mode not in ("auto", "single", "map_reduce"):
+        raise ValueError(f"Unknown analysis mode: {mode}")
+    return mode == "map_reduce" or mode == "auto" and program_lines >= ANALYSIS_MAP_REDUCE_MIN_LINES
+
+
+def split_program(lines: List[str], chunk_lines: int = ANALYSIS_CHUNK_LINES) -> List[AnalysisChunk]:
+    """
+    Splits a program into the parts critiqued separately: the divisions before the procedure division every
+    chunk_lines lines, then the procedure division by groups of whole paragraphs of about chunk_lines lines.
+    """
+    procedure_start = next((index for index, line in enumerate(lines) if PROCEDURE_DIVISION.match(line)),
+                           len(lines))
+    chunks = [AnalysisChunk(start, min(start + chunk_lines, procedure_start), [])
+              for start in range(0, procedure_start, chunk_lines)]
+
+    # The lines between the procedure division header and the first paragraph go with the first group
+    start, group = procedure_start, []
+    for paragraph in find_paragraphs(lines):
+        if group and paragraph.end - start > chunk_lines:
+            chunks.append(AnalysisChunk(start, paragraph.start, group))
+            start, group = paragraph.start, []
+        group.append(paragraph)
+    if start < len(lines):
+        chunks.append(AnalysisChunk(start, len(lines), group))
+    return chunks
+
+
+def relevant_definitions(code: str, lines: List[str], copybooks: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Selects the data definitions of the program and the copybooks a part of it uses: the top-level entries of the
+    data division and the copybooks defining a name the part references, and the copybooks it copies.
+    """
+    referenced = words(code)
+    definitions = [entry.text for entry in find_data_entries(lines) if entry.names & referenced]
+    used_copybooks = {name: text for name, text in copybooks.items()
+                      if name.upper() in referenced or defined_names(text) & referenced}
+    return {"definitions": "\n".join(definitions), "copybooks": used_copybooks}
+
+
+def chunk_inputs(filename: str, lines: List[str], chunk: AnalysisChunk, copybooks: Dict[str, str]) -> Dict[str, Any]:
+    code = "\n".join(lines[chunk.start:chunk.end])
+    if chunk.paragraphs:
+        relevant = relevant_definitions(code, lines, copybooks)
+    else:
+        # A part of the data division is its own definitions
+        relevant = {"definitions": "", "copybooks": {name: text for name, text in copybooks.items()
+                                                     if name.upper() in words(code)}}
+    return {
+        "filename": filename,
+        "location": chunk.location,
+        "definitions": relevant["definitions"] or "None.",
+        "copybooks": format_copybooks_for_display(relevant["copybooks"]) if relevant["copybooks"] else "None.",
+        "code": code,
+    }
+
+
+def locate(finding: SectionFinding, chunk: AnalysisChunk) -> str:
+    """
+    Returns the location of a finding: the lines of the paragraph it names, or of its part.
+    """
+    name = re.sub(r"\s+SECTION$", "", finding.paragraph.strip().rstrip(".").upper())
+    for paragraph in chunk.paragraphs:
+        if paragraph.name == name:
+            return f"{paragraph.name} (lines {paragraph.start + 1}-{paragraph.end})"
+    return chunk.location
+
+
+def format_findings(findings: List[Dict[str, str]]) -> str:
+    return "\n".join(f"{number}. [{finding['severity']}] {finding['location']}: {finding['issue']}\n"
+                     f"   Recommendation: {finding['recommendation']}"
+                     for number, finding in enumerate(findings, start=1))
+
+
+def flagged_sections(findings: List[Dict[str, str]]) -> str:
+    """
+    Lists the locations of the findings once each, from the most important, with the severity of their most
+    important finding, for the generation to target.
+    """
+    locations: Dict[str, str] = {}
+    for finding in findings:
+        locations.setdefault(finding["location"], finding["severity"])
+    return "\n".join(f"- {location} ({severity})" for location, severity in locations.items())
+
+
+def map_reduce_analysis(state: GraphState, old_code: str, copybooks: Dict[str, str]) -> Optional[Dict[str, str]]:
+    """
+    Critiques the parts of the program concurrently, each with only the data definitions and copybooks it uses,
+    then merges their findings into one ranked critique with the location of each finding (also kept in
+    state["analysis_findings"]).
+
+    Returns:
+        dict: The critique of the program (description and grade), or None if no part could be critiqued.
+    """
+    lines = old_code.split("\n")
+    chunks = split_program(lines)
+    inputs = [chunk_inputs(state["filename"], lines, chunk, copybooks) for chunk in chunks]
+
+    # Every part is routed by the size of the largest one, so that they all go in the same batch
+    route = select_route("analyze_next_file", {**state, "program_lines": max(c.end - c.start for c in chunks)})
+    print_info(f"Analyzing {len(chunks)} parts of {state['filename']} with {route.model_name} (route {route.key}).")
+    chain = ChatPromptTemplate.from_template(analyze_section_prompt()) | \
+        get_chat_model(route).with_structured_output(SectionReview)
+    reviews = chain.batch(inputs, config={"max_concurrency": ANALYSIS_CONCURRENCY}, return_exceptions=True)
+
+    findings = []
+    for chunk, review in zip(chunks, reviews):
+        if isinstance(review, Exception):
+            print_error(f"Analysis of {chunk.location} failed: {review}")
+            continue
+        findings.extend({"location": locate(finding, chunk), "severity": finding.severity.lower(),
+                         "issue": finding.issue, "recommendation": finding.recommendation}
+                        for finding in review.findings)
+    if all(isinstance(review, Exception) for review in reviews):
+        return None
+    if not findings:
+        state["analysis_findings"] = []
+        return {"description": "No issue found in any part of the program.", "grade": "good"}
+
+    findings.sort(key=lambda finding: SEVERITIES.index(finding["severity"])
+                  if finding["severity"] in SEVERITIES else len(SEVERITIES))
+    route = select_route("analyze_next_file", state)
+    chain = ChatPromptTemplate.from_template(analyze_reduce_prompt()) | \
+        get_chat_model(route).with_structured_output(AnalysisResult)
+    try:
+        result = chain.invoke({
+            "filename": state["filename"],
+            "structure": summarize_structure(old_code),
+            "findings": format_findings(findings),
+        })
+        findings = [finding.dict() for finding in result.findings]
+        summary, grade = result.summary, result.grade
+    except Exception as e:
+        # The findings of the parts, ranked by severity, still make a usable critique
+        print_error(f"Merge of the findings failed: {e}")
+        summary, grade = f"{len(findings)} issue(s) found in the parts of the program.", "bad"
+
+    state["analysis_findings"] = findings
+    return {"description": f"{summary}\n\nFindings, from the most important:\n{format_findings(findings)}",
+            "grade": grade}
@@ -0,0 +1,211 @@
+import hashlib
+import json
+import mmap
+import os
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Set
+
+from .common import GraphState, BLOB_SPILL_DIR, BLOB_SPILL_THRESHOLD, BLOB_MEMORY_BUDGET
+from .utils import write_atomic
+
+BLOB_PREFIX = "blob:sha256:"
+
+# State keys holding a blob reference instead of the text itself (copybooks hold a reference per copybook)
+BLOB_STATE_KEYS = ["old_code", "previous_last_gen_code", "new_code", "sequence_areas", "examples"]
+
+
+def is_blob_ref(value) -> bool:
+    return isinstance(value, str) and value.startswith(BLOB_PREFIX) and len(value) == len(BLOB_PREFIX) + 64
+
+
+class BlobStore:
+    """
+    Content-addressed store of the large texts of the workflow (programs, generations, copybooks), so that the
+    state only carries their digests. Blobs are kept in memory up to a budget, then spilled to disk, where they
+    are read back through mmap. Large blobs are spilled right away.
+
+    The spill directory is shared by the processes: the spilled blobs a run still holds are registered under its
+    owner (the run) in the live/ directory of the spill directory, and a blob on disk is only removed when no
+    other owner has registered it.
+    """
+
+    def __init__(self, spill_dir: Optional[str] = BLOB_SPILL_DIR, spill_threshold: int = BLOB_SPILL_THRESHOLD,
+                 memory_budget: int = BLOB_MEMORY_BUDGET):
+        self.spill_dir = spill_dir or None
+        self.spill_threshold = spill_threshold
+        self.memory_budget = memory_budget
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_size = 0
+        self._spilled = set()
+        # Owner of the blobs of this process, and the spilled blobs registered under it
+        self.owner: Optional[str] = None
+        self._registered: Set[str] = set()
+
+    def _spill_path(self, digest: str) -> str:
+        return os.path.join(self.spill_dir, digest)
+
+    def _live_path(self, owner: str) -> str:
+        return os.path.join(self.spill_dir, "live", f"{owner}.json")
+
+    def _spill(self, digest: str, data: bytes):
+        path = self._spill_path(digest)
+        if not os.path.exists(path):
+            write_atomic(path, data)
+        self._spilled.add(digest)
+        self._register(self._registered | {digest})
+
+    def _register(self, digests: Set[str]):
+        # Written only when the spilled blobs held by the owner change, not at every put or collection
+        if self.spill_dir and self.owner and digests != self._registered:
+            write_atomic(self._live_path(self.owner), json.dumps(sorted(digests)))
+            self._registered = digests
+
+    def put(self, text: str) -> str:
+        """
+        Stores a text and returns its reference. The empty text is its own reference.
+        """
+        if not text:
+            return ""
+        if is_blob_ref(text):
+            return text
+        data = text.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in self._memory or digest in self._spilled:
+            return BLOB_PREFIX + digest
+
+        if self.spill_dir and len(data) >= self.spill_threshold:
+            self._spill(digest, data)
+        else:
+            self._memory[digest] = data
+            self._memory_size += len(data)
+            # Spill the least recently stored blobs once over the memory budget
+            while self.spill_dir and self._memory_size > self.memory_budget and len(self._memory) > 1:
+                old_digest, old_data = self._memory.popitem(last=False)
+                self._memory_size -= len(old_data)
+                self._spill(old_digest, old_data)
+        return BLOB_PREFIX + digest
+
+    def get(self, ref: str) -> str:
+        """
+        Returns the text of a reference. Values that are not references (e.g. plain text) are returned as is.
+        """
+        if not is_blob_ref(ref):
+            return ref or ""
+        digest = ref[len(BLOB_PREFIX):]
+        if digest in self._memory:
+            return self._memory[digest].decode("utf-8")
+        if self.spill_dir and os.path.exists(self._spill_path(digest)):
+            with open(self._spill_path(digest), 'rb') as file:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return str(mapped, "utf-8")
+        raise KeyError(f"Unknown blob: {ref}")
+
+    def release(self, owner: str):
+        """
+        Unregisters the blobs held by an owner, e.g. at the end of its run.
+        """
+        if owner == self.owner:
+            self._registered = set()
+        if self.spill_dir and os.path.exists(self._live_path(owner)):
+            os.remove(self._live_path(owner))
+
+    def _held_by_others(self, owner: Optional[str]) -> Set[str]:
+        held = set()
+        live_dir = os.path.join(self.spill_dir, "live")
+        if not os.path.isdir(live_dir):
+            return held
+        for name in os.listdir(live_dir):
+            if not name.endswith(".json") or name == f"{owner}.json":
+                continue
+            try:
+                with open(os.path.join(live_dir, name), 'r') as file:
+                    held.update(json.load(file))
+            except (OSError, ValueError):
+                continue
+        return held
+
+    def collect(self, live_refs: Iterable[str], owner: Optional[str] = None):
+        """
+        Drops every blob that is not in live_refs from memory, and from disk unless another owner has registered
+        it. The live spilled blobs replace the registered ones of the owner.
+        """
+        if owner is not None:
+            self.owner = owner
+        live = {ref[len(BLOB_PREFIX):] for ref in live_refs if is_blob_ref(ref)}
+        for digest in [d for d in self._memory if d not in live]:
+            self._memory_size -= len(self._memory.pop(digest))
+        if not self.spill_dir:
+            return
+        held = live | self._held_by_others(self.owner)
+        # The blobs still held by another run stay known, to be removed once they are released
+        for digest in [d for d in self._spilled if d not in held]:
+            self._spilled.discard(digest)
+            if os.path.exists(self._spill_path(digest)):
+                os.remove(self._spill_path(digest))
+        self._register(live & self._spilled)
+
+
+# Shared store of the workflow
+blob_store = BlobStore()
+
+
+def put_text(text: str) -> str:
+    return blob_store.put(text)
+
+
+def get_text(ref: str) -> str:
+    return blob_store.get(ref)
+
+
+def store_copybooks(copybooks: Dict[str, str]) -> Dict[str, str]:
+    return {name: put_text(content) for name, content in copybooks.items()}
+
+
+def load_copybooks(copybook_refs: Dict[str, str]) -> Dict[str, str]:
+    return {name: get_text(ref) for name, ref in (copybook_refs or {}).items()}
+
+
+def state_blob_refs(state: GraphState) -> Iterable[str]:
+    """
+    Lists the blob references held by a state.
+    """
+    refs = [state.get(key) for key in BLOB_STATE_KEYS]
+    refs.extend((state.get("copybooks") or {}).values())
+    return [ref for ref in refs if is_blob_ref(ref)]
+
+
+def blob_owner(state: GraphState) -> str:
+    return state.get("run_id") or "default"
+
+
+def collect_state(state: GraphState):
+    """
+    Drops the blobs the state doesn't hold anymore (see BlobStore.collect).
+    """
+    blob_store.collect(state_blob_refs(state), owner=blob_owner(state))
+
+
+def materialize(state: GraphState) -> Dict[str, object]:
+    """
+    Returns a copy of the state with its blob references replaced by their texts, for another process.
+    """
+    materialized = dict(state)
+    for key in BLOB_STATE_KEYS:
+        if key in materialized:
+            materialized[key] = get_text(materialized[key])
+    if "copybooks" in materialized:
+        materialized["copybooks"] = load_copybooks(materialized["copybooks"])
+    return materialized
+
+
+def dematerialize(values: Dict[str, object]) -> Dict[str, object]:
+    """
+    Inverse of materialize: stores the texts back in the blob store and returns the values with references.
+    """
+    values = dict(values)
+    for key in BLOB_STATE_KEYS:
+        if key in values:
+            values[key] = put_text(values[key] or "")
+    if "copybooks" in values:
+        values["copybooks"] = store_copybooks(values["copybooks"] or {})
+    return values
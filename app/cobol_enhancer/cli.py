@@ -0,0 +1,173 @@
+import argparse
+import os
+import sys
+from typing import Any, Dict, List, Optional
+
+# Only light modules here: each command imports what it needs, so that a job starts without loading the models,
+# the workflow graph or the plotting libraries it doesn't use
+from .common import INPUT_DIR, WorkflowExit, WORKFLOW_STEP_LIMIT
+from .utils import print_heading, print_info, print_error
+
+
+def resolve_files(names: List[str]) -> List[str]:
+    """
+    Resolves file names given on the command line: paths as they are, other names relative to the input
+    directory.
+    """
+    files = []
+    for name in names:
+        path = name if os.path.exists(name) else os.path.join(INPUT_DIR, name)
+        if os.path.exists(path):
+            files.append(path)
+        else:
+            print_error(f"File not found: {name}")
+    return files
+
+
+def run_workflow(state: Dict[str, Any]) -> int:
+    from .workflow import app
+
+    try:
+        for _ in app.stream(state, {"recursion_limit": WORKFLOW_STEP_LIMIT}):
+            pass
+    except WorkflowExit:
+        print_info("Workflow exited.")
+    return 0
+
+
+def run(args: argparse.Namespace) -> int:
+    if args.all:
+        from .inventory import get_inventory
+        files = get_inventory().paths()
+    else:
+        files = resolve_files(args.files)
+        if args.files and not files:
+            return 1
+    # Without files, the workflow asks which ones to process
+    return run_workflow({"files_to_process": files})
+
+
+def resume(args: argparse.Namespace) -> int:
+    from .results_store import ResultsStore
+
+    store = ResultsStore()
+    run_id, files = store.unfinished_files(args.run_id)
+    store.close()
+    if not files:
+        print_info(f"Nothing to resume{f' in run {run_id}' if run_id else ''}.")
+        return 0
+    print_info(f"Resuming run {run_id}: {len(files)} file(s) left.")
+    return run_workflow({"files_to_process": files, "run_id": run_id})
+
+
+def plan(args: argparse.Namespace) -> int:
+    from .planner import plan as plan_files, print_plan
+
+    if args.files:
+        files = resolve_files(args.files)
+    else:
+        from .inventory import get_inventory
+        files = get_inventory().paths()
+    print_plan(plan_files(files))
+    return 0
+
+
+def impact(args: argparse.Namespace) -> int:
+    import time
+    from .dependencies import copybook_impact
+    from .results_store import ResultsStore
+
+    store = ResultsStore()
+    programs = copybook_impact(args.copybooks, store)
+    store.close()
+    if not programs:
+        print_info("No program uses these copybooks.")
+        return 0
+
+    for program in programs:
+        if program["accepted_at"] is None:
+            status = "never accepted"
+        else:
+            status = f"accepted {time.strftime('%Y-%m-%d %H:%M', time.localtime(program['accepted_at']))}"
+            if program["changed"]:
+                status += f", before the change of {', '.join(program['changed'])}: to process again"
+        print_info(f"{program['path']} (uses {', '.join(program['copybooks'])}): {status}")
+
+    stale = [program["path"] for program in programs if program["changed"]]
+    print_info(f"{len(programs)} program(s) use these copybooks, {len(stale)} to process again.")
+    if args.run and stale:
+        return run_workflow({"files_to_process": stale})
+    return 0
+
+
+def export_graph(args: argparse.Namespace) -> int:
+    from .graph_export_utils import merge_deciders_for_printing, export_graph_to_image, \
+        convert_graph_to_plotly_figure
+    from .workflow import app
+
+    trace = None
+    if args.trace is not None:
+        from .results_store import ResultsStore
+        store = ResultsStore()
+        trace = store.run_trace(args.trace or None)
+        store.close()
+        if not trace:
+            print_error("No recorded run to overlay.")
+            return 1
+
+    from graphviz import ExecutableNotFound
+
+    graph = merge_deciders_for_printing(app.get_graph())
+    if args.html:
+        os.makedirs(args.output_dir, exist_ok=True)
+        path = os.path.join(args.output_dir, f"{args.name}.html")
+        convert_graph_to_plotly_figure(graph, trace).write_html(path)
+        print_info(f"Saved the interactive graph to {path}")
+    try:
+        export_graph_to_image(graph, args.output_dir, args.name, trace=trace)
+    except ExecutableNotFound:
+        print_error("Graphviz (dot) is not installed, the image can't be rendered.")
+        return 1
+    print_info(f"Saved the graph to {os.path.join(args.output_dir, args.name)}.png")
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="cobol-enhancer", description="Enhance COBOL programs with LLMs.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="process COBOL files")
+    run_parser.add_argument("files", nargs="*", help="files to process (asked interactively if none)")
+    run_parser.add_argument("--all", action="store_true", help="process every file of the input directory")
+    run_parser.set_defaults(handler=run)
+
+    resume_parser = subparsers.add_parser("resume", help="process the files left by an interrupted run")
+    resume_parser.add_argument("--run", dest="run_id", help="run to resume (the latest unfinished one by default)")
+    resume_parser.set_defaults(handler=resume)
+
+    plan_parser = subparsers.add_parser("plan", help="estimate the tokens, time and cost of processing files")
+    plan_parser.add_argument("files", nargs="*", help="files to plan (every file of the input directory if none)")
+    plan_parser.set_defaults(handler=plan)
+
+    impact_parser = subparsers.add_parser("impact", help="list the programs using copybooks, to process again "
+                                                         "after they changed")
+    impact_parser.add_argument("copybooks", nargs="+", help="names or paths of the copybooks")
+    impact_parser.add_argument("--run", action="store_true",
+                               help="process the programs accepted before the change of their copybooks")
+    impact_parser.set_defaults(handler=impact)
+
+    export_parser = subparsers.add_parser("export-graph", help="render the workflow graph")
+    export_parser.add_argument("--output-dir", default="data/")
+    export_parser.add_argument("--name", default="graph_image_own")
+    export_parser.add_argument("--trace", nargs="?", const="", metavar="RUN_ID",
+                               help="overlay the timings of a recorded run (the latest one if no id is given)")
+    export_parser.add_argument("--html", action="store_true", help="also write an interactive plotly version")
+    export_parser.set_defaults(handler=export_graph)
+
+    args = parser.parse_args(argv)
+    print_heading(f"COBOL ENHANCER {args.command.upper()}")
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
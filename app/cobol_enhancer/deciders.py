@@ -1,4 +1,10 @@
-from app.cobol_enhancer.common import GraphState
+from app.cobol_enhancer import review_queue
+from app.cobol_enhancer.blob_store import blob_store, blob_owner
+from app.cobol_enhancer.common import GraphState, REVIEW_MODE
+from app.cobol_enhancer.ingestion import ingestion_stats
+from app.cobol_enhancer.metrics import usage_tracker, route_stats
+from app.cobol_enhancer.results_store import ResultsStore, flush_node_timings
+from app.cobol_enhancer.transfer import settle_transfers
 from app.cobol_enhancer.utils import print_heading, print_info, print_error
 
 
@@ -12,6 +18,18 @@ def human_review_decider(state: GraphState):
         return "re_gen"
 
 
+def review_queue_decider(state: GraphState):
+    print_heading("HANDLE REVIEW QUEUE")
+
+    if state["human_decision"] == "yes":
+        return "send_file"
+    elif state["human_decision"] == "no":
+        print_info(f"Human review demands: {state['specific_demands']}")
+        return "re_gen"
+    else:
+        return "next_file"
+
+
 def evaluate_quality_decider(state: GraphState):
     print_heading("EVALUATION DECIDER")
     grade = state["critic"]["grade"]
@@ -23,11 +41,45 @@ def evaluate_quality_decider(state: GraphState):
         return "re_gen"
 
 
+def local_verification_decider(state: GraphState):
+    print_heading("LOCAL VERIFICATION DECIDER")
+    status = state["verification"]["status"]
+
+    if status in ("compilation_error", "execution_error"):
+        print_error("Local verification failed. Initiating regeneration...")
+        return "re_gen"
+    else:
+        return "verified"
+
+
 def has_finished_all_files_decider(state: GraphState):
     print_heading("FINISHED ALL FILES DECIDER")
-    if state["files_to_process"]:
+    if REVIEW_MODE == "queue" and (review_queue.has_decided_tickets() or
+                                   (not state["files_to_process"] and review_queue.has_parked_tickets())):
+        # Reviewed files are resumed first, and the last parked ones are waited for before ending
+        print_info("Resuming the files waiting in the review queue.")
+        return "pending_reviews"
+    elif state["files_to_process"]:
         return "next_file"
     else:
         print_info("All files have been processed.")
+        usage = usage_tracker.summary()
+        print_info(f"Token usage: {usage['prompt_tokens']} prompt tokens ({usage['cached_tokens']} from cache, "
+                   f"{usage['cache_hit_ratio']:.0%}), {usage['completion_tokens']} completion tokens "
+                   f"over {usage['calls']} calls.")
+        ingestion = ingestion_stats.summary()
+        if ingestion["saved_tokens"]:
+            print_info(f"Sequence areas stripped from {ingestion['files']} file(s): {ingestion['saved_tokens']} tokens "
+                       f"({ingestion['saved_ratio']:.0%} of the sources) saved in every prompt containing them.")
+        route_stats.print_summary()
+        route_stats.save()
+        flush_node_timings(state)
+        # The run ends once all of its uploads are over
+        settle_transfers(state.get("pending_transfers", []), wait=True)
+        # The blobs spilled by the run are not held anymore
+        blob_store.release(blob_owner(state))
+        store = ResultsStore()
+        store.finish_run(state["run_id"])
+        store.close()
         print_heading("END")
         return "no_more_file"
@@ -0,0 +1,269 @@
+import json
+import os
+import re
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from .common import COPYBOOK_EXTENSIONS, DEPENDENCY_CACHE_PATH, CLUSTER_MAX_SHARED_USERS, CLUSTER_MAX_SIZE
+from .ingestion import read_source
+from .inventory import SourceInventory, get_inventory
+from .utils import find_copybook, write_atomic
+
+# Static calls only: the target of a CALL identifier is only known at run time
+CALL_LITERAL = re.compile(r"\bCALL\s+['\"]([A-Za-z0-9#@$-]+)['\"]", re.IGNORECASE)
+COPY_STATEMENT = re.compile(r"\bCOPY\s+['\"]?([A-Za-z0-9#@$-]+)", re.IGNORECASE)
+# DB2 declarations generated by DCLGEN are pulled in like copybooks
+SQL_INCLUDE = re.compile(r"\bINCLUDE\s+([A-Za-z0-9#@$-]+)", re.IGNORECASE)
+PROGRAM_ID = re.compile(r"\bPROGRAM-ID\s*\.\s*['\"]?([A-Za-z0-9#@$-]+)", re.IGNORECASE)
+# Files are shared through their external name (DD name or path), the internal names differ between programs
+FILE_ASSIGN = re.compile(r"\bSELECT\s+(?:OPTIONAL\s+)?[A-Za-z0-9-]+\s+ASSIGN\s+(?:TO\s+)?['\"]?([A-Za-z0-9#@$.:/_-]+)",
+                         re.IGNORECASE)
+SQL_BLOCK = re.compile(r"\bEXEC\s+SQL\b(.*?)\bEND-EXEC\b", re.IGNORECASE | re.DOTALL)
+SQL_TABLE = re.compile(r"\b(?:FROM|JOIN|INTO|UPDATE|TABLE)\s+([A-Za-z][A-Za-z0-9_#@$]*(?:\.[A-Za-z][A-Za-z0-9_#@$]*)?)",
+                       re.IGNORECASE)
+# Members of SQL INCLUDE that are not tables of the application
+SQL_SYSTEM_INCLUDES = {"SQLCA", "SQLDA"}
+
+
+def copybook_key(name: str) -> str:
+    """
+    Returns the name of a copybook as used in the COPY statements: in upper case, without its extension.
+    """
+    name = os.path.basename(name)
+    stem, extension = os.path.splitext(name)
+    return (stem if extension in COPYBOOK_EXTENSIONS else name).upper()
+
+
+def parse_dependencies(code: str) -> Dict[str, Any]:
+    """
+    Extracts what a program or copybook depends on: its static CALL targets, copybooks (and SQL INCLUDE members),
+    external files and DB2 tables.
+    """
+    # Comment lines don't count
+    code = "\n".join(line for line in code.split("\n") if line[6:7] not in ("*", "/"))
+    program_id = PROGRAM_ID.search(code)
+    tables, includes = set(), set()
+    for block in SQL_BLOCK.findall(code):
+        includes.update(name.upper() for name in SQL_INCLUDE.findall(block))
+        tables.update(name.upper() for name in SQL_TABLE.findall(block))
+    return {
+        "program_id": program_id.group(1).upper() if program_id else "",
+        "calls": sorted({name.upper() for name in CALL_LITERAL.findall(code)}),
+        "copybooks": sorted({name.upper() for name in COPY_STATEMENT.findall(code)} |
+                            (includes - SQL_SYSTEM_INCLUDES)),
+        # Without the period ending the SELECT clause
+        "files": sorted({name.upper().rstrip(".") for name in FILE_ASSIGN.findall(code)}),
+        "tables": sorted(tables),
+    }
+
+
+class DependencyGraph:
+    """
+    Dependency graph of the programs of an input tree: what each program calls, copies, and which files and DB2
+    tables it uses. The dependencies of every program and copybook are cached on disk with the mtime and size of
+    their file, so only the changed files are parsed again.
+    """
+
+    def __init__(self, inventory: Optional[SourceInventory] = None, cache_path: Optional[str] = DEPENDENCY_CACHE_PATH):
+        self.inventory = inventory or get_inventory()
+        self.cache_path = cache_path
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._dirty = False
+        self._copybook_usage: Optional[Dict[str, int]] = None
+        self._load_cache()
+
+    def _load_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r') as file:
+                self._entries = json.load(file)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def save(self):
+        if self.cache_path and self._dirty:
+            write_atomic(self.cache_path, json.dumps(self._entries))
+            self._dirty = False
+
+    def _parse(self, path: str) -> Dict[str, Any]:
+        """
+        Returns the dependencies of a file, from the cache if it didn't change since it was parsed.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return parse_dependencies("")
+        key = os.path.abspath(path)
+        entry = self._entries.get(key)
+        if entry is None or entry["mtime"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+            entry = dict(parse_dependencies(read_source(path).text), mtime=stat.st_mtime_ns, size=stat.st_size)
+            self._entries[key] = entry
+            self._dirty = True
+        return entry
+
+    def program(self, path: str) -> Dict[str, Any]:
+        """
+        Returns the dependencies of a program, with its copybooks resolved through the nested COPY statements.
+        """
+        entry = dict(self._parse(path))
+        entry["copybooks"] = sorted(self.copybook_closure(entry["copybooks"]))
+        return entry
+
+    def copybook_closure(self, names: Iterable[str]) -> Set[str]:
+        closure, pending = set(), [copybook_key(name) for name in names]
+        while pending:
+            name = pending.pop()
+            if name in closure:
+                continue
+            closure.add(name)
+            path = find_copybook(name) or find_copybook(name.lower())
+            if path is not None:
+                pending.extend(self._parse(path)["copybooks"])
+        return closure
+
+    def programs(self, files: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        """
+        Returns the dependencies of the given programs, or of every program of the inventory.
+        """
+        files = self.inventory.paths() if files is None else files
+        programs = {path: self.program(path) for path in files}
+        self.save()
+        return programs
+
+    def dependents(self, copybooks: Iterable[str]) -> List[str]:
+        """
+        Returns the programs of the inventory that use one of the copybooks, directly or through other copybooks.
+        """
+        keys = {copybook_key(name) for name in copybooks}
+        return [path for path, program in self.programs().items() if keys & set(program["copybooks"])]
+
+    def copybook_usage(self) -> Dict[str, int]:
+        """
+        Returns the number of programs of the inventory using each copybook, counted once per process.
+        """
+        if self._copybook_usage is None:
+            self._copybook_usage = {}
+            for program in self.programs().values():
+                for name in program["copybooks"]:
+                    self._copybook_usage[name] = self._copybook_usage.get(name, 0) + 1
+        return self._copybook_usage
+
+    def clusters(self, files: List[str], max_shared_users: int = CLUSTER_MAX_SHARED_USERS,
+                 max_size: int = CLUSTER_MAX_SIZE) -> List[List[str]]:
+        """
+        Groups the programs that depend on each other or share context: one calls the other, or they use a common
+        copybook, file or DB2 table. The clusters come in the order of their first program, each with its programs
+        in the given order.
+
+        A copybook, file or table used by more than max_shared_users of the programs relates none of them, and
+        two clusters are not merged beyond max_size programs, so that a widely used resource doesn't group the
+        whole run.
+        """
+        programs = self.programs(files)
+        parent = {path: path for path in files}
+        size = {path: 1 for path in files}
+
+        def find(path: str) -> str:
+            while parent[path] != path:
+                parent[path] = parent[parent[path]]
+                path = parent[path]
+            return path
+
+        def merge(path: str, other: str):
+            root, other_root = find(path), find(other)
+            if root != other_root and size[root] + size[other_root] <= max_size:
+                parent[root] = other_root
+                size[other_root] += size[root]
+
+        # Programs are called by their PROGRAM-ID, which is usually the name of their member
+        names = {}
+        for path, program in programs.items():
+            for name in {program["program_id"], os.path.splitext(os.path.basename(path))[0].upper()} - {""}:
+                names.setdefault(name, path)
+
+        resources, users = {}, {}
+        for path, program in programs.items():
+            resources[path] = [("copybook", name) for name in program["copybooks"]] + \
+                              [("file", name) for name in program["files"]] + \
+                              [("table", name) for name in program["tables"]]
+            for resource in resources[path]:
+                users.setdefault(resource, []).append(path)
+
+        for path, program in programs.items():
+            for name in program["calls"]:
+                if name in names:
+                    merge(path, names[name])
+            for resource in resources[path]:
+                if len(users[resource]) <= max_shared_users:
+                    merge(path, users[resource][0])
+
+        clusters: Dict[str, List[str]] = {}
+        for path in files:
+            clusters.setdefault(find(path), []).append(path)
+        return list(clusters.values())
+
+    def shared_context(self, cluster: List[str]) -> Dict[str, List[str]]:
+        """
+        Returns the copybooks, files and DB2 tables used by more than one program of a cluster.
+        """
+        programs = self.programs(cluster)
+        shared = {}
+        for kind in ("copybooks", "files", "tables"):
+            counts: Dict[str, int] = {}
+            for program in programs.values():
+                for name in program[kind]:
+                    counts[name] = counts.get(name, 0) + 1
+            shared[kind] = sorted(name for name, count in counts.items() if count > 1)
+        return shared
+
+
+_dependency_graph: Optional[DependencyGraph] = None
+
+
+def get_dependency_graph() -> DependencyGraph:
+    """
+    Returns the shared dependency graph of the input directory, loaded from its cache on first use.
+    """
+    global _dependency_graph
+    if _dependency_graph is None:
+        _dependency_graph = DependencyGraph()
+    return _dependency_graph
+
+
+def order_copybooks(copybooks: Dict[str, str]) -> Dict[str, str]:
+    """
+    Orders the copybooks of a program for its prompts: the ones used by the most programs first, then by name, so
+    that programs sharing copybooks also share the start of their program context.
+    """
+    usage = get_dependency_graph().copybook_usage()
+    return dict(sorted(copybooks.items(), key=lambda item: (-usage.get(copybook_key(item[0]), 0),
+                                                            copybook_key(item[0]))))
+
+
+def copybook_impact(copybooks: Iterable[str], store) -> List[Dict[str, Any]]:
+    """
+    Lists the programs using the copybooks, directly or through other copybooks, with the time of their last
+    accepted output (from the results store) and the copybooks modified since then. The programs with modified
+    copybooks are the ones to process again.
+    """
+    graph = get_dependency_graph()
+    keys = {copybook_key(name) for name in copybooks}
+    modified_at = {}
+    for key in keys:
+        path = find_copybook(key) or find_copybook(key.lower())
+        if path is not None:
+            modified_at[key] = os.stat(path).st_mtime
+
+    impact = []
+    for path in graph.dependents(keys):
+        used = keys & set(graph.program(path)["copybooks"])
+        # Matched exactly, the history of a program never comes from another one whose name it matches as a pattern
+        history = store.query(program=os.path.basename(path))
+        accepted_at = history[0]["accepted_at"] if history else None
+        impact.append({
+            "path": path,
+            "copybooks": sorted(used),
+            "accepted_at": accepted_at,
+            "changed": sorted(key for key in used if accepted_at is not None and modified_at.get(key, 0) > accepted_at),
+        })
+    return impact
@@ -0,0 +1,367 @@
+import argparse
+import contextlib
+import difflib
+import hashlib
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, ChatResult, LLMResult
+from langchain_openai import ChatOpenAI
+
+from .blob_store import get_text
+from .common import (GraphState, SOURCE_EXTENSIONS, EVAL_DIR, EVAL_CASSETTE_PATH, EVAL_HISTORY_PATH,
+                     EVAL_CONCURRENCY, EVAL_MAX_ITERATIONS, EVAL_REGRESSION_TOLERANCE)
+from .examples import set_example_index
+from .ingestion import read_source
+from .metrics import extract_token_usage
+from .routing import Route, set_model_factory
+from .utils import print_heading, print_info, print_error, print_subheading, write_atomic
+
+
+class EvalCase(NamedTuple):
+    name: str
+    before_path: str
+    after_path: str
+
+
+def load_cases(eval_dir: str = EVAL_DIR) -> List[EvalCase]:
+    """
+    Lists the golden pairs of the evaluation directory: each source of eval_dir/before with the expected version
+    of the same relative path in eval_dir/after.
+    """
+    before_dir, after_dir = os.path.join(eval_dir, "before"), os.path.join(eval_dir, "after")
+    cases = []
+    for directory, _, filenames in os.walk(before_dir):
+        for filename in filenames:
+            if not filename.endswith(tuple(SOURCE_EXTENSIONS)):
+                continue
+            before_path = os.path.join(directory, filename)
+            name = os.path.relpath(before_path, before_dir)
+            after_path = os.path.join(after_dir, name)
+            if os.path.exists(after_path):
+                cases.append(EvalCase(name, before_path, after_path))
+            else:
+                print_error(f"No expected version of {name} in {after_dir}, skipped.")
+    return sorted(cases)
+
+
+class Cassette:
+    """
+    Recorded model responses, keyed by a hash of the request (model, parameters, messages and tools).
+    """
+
+    def __init__(self, path: str = EVAL_CASSETTE_PATH):
+        self.path = path
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        # Responses recorded since loading, to be merged into the file
+        self.recorded: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                self.entries = json.load(file)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self.entries.get(key)
+
+    def put(self, key: str, entry: Dict[str, Any]):
+        self.entries[key] = entry
+        self.recorded[key] = entry
+
+    def merge_and_save(self, recorded: Dict[str, Dict[str, Any]]):
+        self.entries.update(recorded)
+        write_atomic(self.path, json.dumps(self.entries, indent=1, sort_keys=True))
+
+
+class ReplayChatModel(ChatOpenAI):
+    """
+    ChatOpenAI answering from a cassette. In "replay" mode, a request that was not recorded is an error; in
+    "record" mode, it is sent to the API and its response recorded. The replayed responses carry their
+    recorded token usage and latency.
+    """
+
+    cassette: Any = None
+    mode: str = "replay"
+
+    def request_key(self, messages, stop=None, **kwargs) -> str:
+        message_dicts, params = self._create_message_dicts(messages, stop)
+        request = {"messages": message_dicts, **params, **kwargs}
+        return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _to_entry(result: ChatResult, latency: float) -> Dict[str, Any]:
+        return {
+            "generations": [{"message": message_to_dict(generation.message),
+                             "generation_info": generation.generation_info} for generation in result.generations],
+            "llm_output": result.llm_output,
+            "latency": latency,
+        }
+
+    @staticmethod
+    def _from_entry(entry: Dict[str, Any]) -> ChatResult:
+        generations = [ChatGeneration(message=messages_from_dict([generation["message"]])[0],
+                                      generation_info={**(generation["generation_info"] or {}),
+                                                       "recorded_latency": entry["latency"]})
+                       for generation in entry["generations"]]
+        return ChatResult(generations=generations, llm_output=entry["llm_output"])
+
+    def _lookup(self, key: str) -> Optional[ChatResult]:
+        entry = self.cassette.get(key)
+        if entry is not None:
+            return self._from_entry(entry)
+        if self.mode == "replay":
+            raise KeyError(f"No recorded response for request {key[:12]} (record it with --mode record).")
+        return None
+
+    def _generate(self, messages, stop=None, run_manager=None, stream=None, **kwargs) -> ChatResult:
+        key = self.request_key(messages, stop, **kwargs)
+        result = self._lookup(key)
+        if result is None:
+            start = time.perf_counter()
+            result = super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            self.cassette.put(key, self._to_entry(result, time.perf_counter() - start))
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, stream=None, **kwargs) -> ChatResult:
+        key = self.request_key(messages, stop, **kwargs)
+        result = self._lookup(key)
+        if result is None:
+            start = time.perf_counter()
+            result = await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            self.cassette.put(key, self._to_entry(result, time.perf_counter() - start))
+        return result
+
+
+class EvalRecorder(BaseCallbackHandler):
+    """
+    Tokens, calls and model latency of a case. The latency of replayed calls is the recorded one.
+    """
+
+    def __init__(self):
+        self.usage = {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+        self.calls = 0
+        self.latency = 0.0
+        self._started_at: Dict[UUID, float] = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs: Any):
+        self._started_at[run_id] = time.perf_counter()
+
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, **kwargs: Any):
+        self._started_at[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        started_at = self._started_at.pop(run_id, None)
+        generation_info = response.generations[0][0].generation_info if response.generations[0] else None
+        recorded_latency = (generation_info or {}).get("recorded_latency")
+        if recorded_latency is not None:
+            self.latency += recorded_latency
+        elif started_at is not None:
+            self.latency += time.perf_counter() - started_at
+        for key, value in extract_token_usage(response).items():
+            self.usage[key] += value
+        self.calls += 1
+
+
+def similarity(code: str, expected: str) -> float:
+    """
+    Scores how close a generated program is to the expected one, ignoring case, indentation and blank lines.
+    """
+    def normalize(text: str) -> List[str]:
+        return [line.strip().upper() for line in text.splitlines() if line.strip()]
+
+    return difflib.SequenceMatcher(None, normalize(code), normalize(expected), autojunk=False).ratio()
+
+
+def initial_state(file_path: str) -> GraphState:
+    return {
+        "files_to_process": [file_path], "filename": "", "original_critic": {}, "critic": {}, "old_code": "",
+        "previous_last_gen_code": "", "new_code": "", "specific_demands": "", "copybooks": {},
+        "atlas_answer": "", "atlas_message_type": "", "human_decision": "", "escalation_level": 0,
+        "generation_route": "", "run_id": "eval", "iteration_history": [], "node_timings": [],
+    }
+
+
+# Cassette and recorder of the current worker process
+_cassette: Optional[Cassette] = None
+_recorder: Optional[EvalRecorder] = None
+
+
+def _create_model(mode: str, model_name: Optional[str]):
+    def factory(route: Route, temperature: float, callbacks: List[Any]):
+        callbacks = callbacks + [_recorder]
+        model = model_name or route.model_name
+        if mode == "live":
+            return ChatOpenAI(temperature=temperature, model=model, callbacks=callbacks)
+        # The replayed model never reaches the API, any key will do
+        return ReplayChatModel(temperature=temperature, model=model, callbacks=callbacks, cassette=_cassette,
+                               mode=mode, openai_api_key=os.environ.get("OPENAI_API_KEY") or "replay")
+
+    return factory
+
+
+def run_case(case: EvalCase, mode: str, model_name: Optional[str], max_iterations: int,
+             cassette_path: str) -> Dict[str, Any]:
+    """
+    Runs the analysis, generation and critic nodes of the workflow on a golden case until the critic accepts
+    the output or max_iterations generations have been made, and scores the output against the expected one.
+    """
+    from .generation import analyze_next_file, generate, critic_generation  # Heavy, only needed by the workers
+
+    global _cassette, _recorder
+    if _cassette is None or _cassette.path != cassette_path:
+        _cassette = Cassette(cassette_path)
+    _cassette.recorded = {}
+    _recorder = EvalRecorder()
+    set_model_factory(_create_model(mode, model_name))
+    # The examples of the past runs would make the scores depend on the machine, and aren't in the cassette
+    set_example_index(None)
+
+    result = {"case": case.name, "score": 0.0, "accepted": False, "iterations": 0, "error": None}
+    start = time.perf_counter()
+    try:
+        # The nodes report their progress on the terminal, which would interleave between the workers
+        with contextlib.redirect_stdout(io.StringIO()):
+            state = analyze_next_file(initial_state(case.before_path))
+            while result["iterations"] < max_iterations and not result["accepted"]:
+                state = critic_generation(generate(state))
+                result["iterations"] += 1
+                result["accepted"] = state["critic"]["grade"] == "good"
+        result["score"] = similarity(get_text(state["new_code"]), read_source(case.after_path).text)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+
+    result.update(_recorder.usage, calls=_recorder.calls, latency=_recorder.latency,
+                  wall_time=time.perf_counter() - start, recorded=_cassette.recorded)
+    return result
+
+
+def summarize(results: List[Dict[str, Any]], mode: str, model_name: Optional[str]) -> Dict[str, Any]:
+    accepted = [result for result in results if result["accepted"]]
+    count = len(results) or 1
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": time.time(),
+        "commit": commit,
+        "mode": mode,
+        "model": model_name,
+        "cases": sorted(result["case"] for result in results),
+        "errors": sum(1 for result in results if result["error"]),
+        "score": sum(result["score"] for result in results) / count,
+        "acceptance_rate": len(accepted) / count,
+        "iterations_to_accept": sum(result["iterations"] for result in accepted) / len(accepted) if accepted else None,
+        "prompt_tokens": sum(result["prompt_tokens"] for result in results),
+        "completion_tokens": sum(result["completion_tokens"] for result in results),
+        "latency": sum(result["latency"] for result in results) / count,
+    }
+
+
+def find_regressions(summary: Dict[str, Any], previous: Dict[str, Any],
+                     tolerance: float = EVAL_REGRESSION_TOLERANCE) -> List[str]:
+    """
+    Compares an evaluation with a previous one of the same cases: a lower score or acceptance rate, or more
+    tokens, latency or iterations to accept beyond the tolerance, is a regression.
+    """
+    regressions = []
+    for metric in ["score", "acceptance_rate"]:
+        if summary[metric] < previous[metric] - tolerance:
+            regressions.append(f"{metric} dropped from {previous[metric]:.2f} to {summary[metric]:.2f}")
+    for metric in ["prompt_tokens", "completion_tokens", "latency", "iterations_to_accept"]:
+        if summary[metric] is None or not previous[metric]:
+            continue
+        if summary[metric] > previous[metric] * (1 + tolerance):
+            regressions.append(f"{metric} rose from {previous[metric]:.1f} to {summary[metric]:.1f} "
+                               f"(+{summary[metric] / previous[metric] - 1:.0%})")
+    return regressions
+
+
+def load_history(path: str = EVAL_HISTORY_PATH) -> List[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def append_history(summary: Dict[str, Any], path: str = EVAL_HISTORY_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, 'a') as file:
+        file.write(json.dumps(summary) + "\n")
+
+
+def run_eval(eval_dir: str = EVAL_DIR, mode: str = "replay", model_name: Optional[str] = None,
+             concurrency: int = EVAL_CONCURRENCY, max_iterations: int = EVAL_MAX_ITERATIONS,
+             cassette_path: str = EVAL_CASSETTE_PATH) -> List[Dict[str, Any]]:
+    """
+    Evaluates every golden case of eval_dir, concurrently in worker processes (each has its own blob store and
+    trackers), and merges the newly recorded responses into the cassette.
+    """
+    cases = load_cases(eval_dir)
+    with ProcessPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        results = list(executor.map(run_case, cases, [mode] * len(cases), [model_name] * len(cases),
+                                    [max_iterations] * len(cases), [cassette_path] * len(cases)))
+    recorded = {}
+    for result in results:
+        recorded.update(result.pop("recorded"))
+    if recorded:
+        Cassette(cassette_path).merge_and_save(recorded)
+    return results
+
+
+def print_report(results: List[Dict[str, Any]], summary: Dict[str, Any], regressions: List[str]):
+    print_heading("EVALUATION")
+    print_subheading(f"{'Case':<40} {'Score':>6} {'Accepted':>8} {'Iter.':>5} {'Tokens':>9} {'Latency':>8}")
+    for result in results:
+        print_info(f"{result['case']:<40} {result['score']:>6.2f} {str(result['accepted']):>8} "
+                   f"{result['iterations']:>5} {result['prompt_tokens'] + result['completion_tokens']:>9} "
+                   f"{result['latency']:>7.1f}s")
+        if result["error"]:
+            print_error(f"  {result['error']}")
+    iterations = summary["iterations_to_accept"]
+    print_subheading(f"Score {summary['score']:.2f}, {summary['acceptance_rate']:.0%} accepted"
+                     f"{f' in {iterations:.1f} iterations' if iterations is not None else ''}, "
+                     f"{summary['prompt_tokens']} prompt and {summary['completion_tokens']} completion tokens, "
+                     f"{summary['latency']:.1f}s of model time per case.")
+    for regression in regressions:
+        print_error(f"Regression: {regression}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Evaluate the workflow chains on golden COBOL pairs.")
+    parser.add_argument("--dir", default=EVAL_DIR, help="directory with the before/ and after/ sources")
+    parser.add_argument("--mode", choices=["replay", "record", "live"], default="replay",
+                        help="answer from the cassette, record the missing responses, or call the API only")
+    parser.add_argument("--model", help="model used for every node instead of the routed ones")
+    parser.add_argument("--concurrency", type=int, default=EVAL_CONCURRENCY)
+    parser.add_argument("--max-iterations", type=int, default=EVAL_MAX_ITERATIONS)
+    parser.add_argument("--cassette", default=EVAL_CASSETTE_PATH)
+    parser.add_argument("--no-history", action="store_true", help="don't compare with or add to the history")
+    args = parser.parse_args(argv)
+
+    results = run_eval(args.dir, args.mode, args.model, args.concurrency, args.max_iterations, args.cassette)
+    summary = summarize(results, args.mode, args.model)
+
+    regressions = []
+    if not args.no_history:
+        # Compared with the last evaluation of the same cases with the same model
+        previous = [entry for entry in load_history()
+                    if entry["cases"] == summary["cases"] and entry["model"] == summary["model"]]
+        if previous:
+            regressions = find_regressions(summary, previous[-1])
+        append_history(summary)
+
+    print_report(results, summary, regressions)
+    return 1 if regressions or summary["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,253 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple, TYPE_CHECKING
+
+from .common import (EXAMPLE_INDEX_DIR, EMBEDDING_MODEL, EXAMPLE_EMBED_BATCH_SIZE, EXAMPLE_TOKEN_BUDGET,
+                     EXAMPLE_MIN_SIMILARITY, RETRIEVE_EXAMPLES)
+from .ingestion import read_source
+from .planner import count_tokens
+from .structure import split_paragraphs
+from .utils import print_heading, print_info, print_error, write_atomic, file_lock
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Turns texts into embedding vectors, e.g. OpenAIEmbeddings.embed_documents
+Embedder = Callable[[List[str]], List[List[float]]]
+
+
+def paragraph_pairs(old_code: str, new_code: str) -> List[Tuple[str, str, str]]:
+    """
+    Pairs the paragraphs of an original program and of its accepted version by name, keeping the changed ones.
+
+    Returns:
+        list: The name, original text and accepted text of each changed paragraph.
+    """
+    new_paragraphs = dict(split_paragraphs(new_code))
+    return [(name, before, new_paragraphs[name]) for name, before in split_paragraphs(old_code)
+            if name in new_paragraphs and new_paragraphs[name] != before]
+
+
+class ExampleIndex:
+    """
+    Index of the accepted before/after paragraph pairs of the past runs, kept in a directory: the normalized
+    embeddings of the original paragraphs in a NumPy matrix (embeddings.npy) and the pairs in examples.jsonl, one
+    line per row of the matrix. New pairs are embedded by batches and appended, under a lock shared by the runs
+    adding to the same index.
+    """
+
+    def __init__(self, directory: str = EXAMPLE_INDEX_DIR, embedder: Optional[Embedder] = None,
+                 batch_size: int = EXAMPLE_EMBED_BATCH_SIZE):
+        self.directory = directory
+        self.batch_size = batch_size
+        self._embedder = embedder
+        self.examples: List[Dict[str, Any]] = []
+        self.embeddings: Optional["np.ndarray"] = None
+        self._load()
+
+    @property
+    def embeddings_path(self) -> str:
+        return os.path.join(self.directory, "embeddings.npy")
+
+    @property
+    def examples_path(self) -> str:
+        return os.path.join(self.directory, "examples.jsonl")
+
+    @property
+    def lock_path(self) -> str:
+        return os.path.join(self.directory, "index.lock")
+
+    def _load(self):
+        self.examples, self.embeddings = [], None
+        if not os.path.exists(self.embeddings_path) or not os.path.exists(self.examples_path):
+            return
+        # Imported when there is an index to load, not with the workflow
+        import numpy as np
+
+        with open(self.examples_path, 'r') as file:
+            self.examples = [json.loads(line) for line in file if line.strip()]
+        self.embeddings = np.load(self.embeddings_path)
+        # An interrupted append may leave rows without their example (or the reverse): drop them
+        count = min(len(self.examples), len(self.embeddings))
+        self.examples, self.embeddings = self.examples[:count], self.embeddings[:count]
+
+    def __len__(self) -> int:
+        return len(self.examples)
+
+    def embed(self, texts: List[str]) -> "np.ndarray":
+        """
+        Embeds texts by batches and returns their normalized vectors, one row per text.
+        """
+        import numpy as np
+
+        if self._embedder is None:
+            from langchain_openai import OpenAIEmbeddings
+            self._embedder = OpenAIEmbeddings(model=EMBEDDING_MODEL).embed_documents
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self._embedder(texts[start:start + self.batch_size]))
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    def add(self, program: str, pairs: List[Tuple[str, str, str]]) -> int:
+        """
+        Embeds the pairs not in the index yet and appends them to it.
+
+        Returns:
+            int: The number of pairs added.
+        """
+        known = {example["id"] for example in self.examples}
+        new_examples = []
+        for name, before, after in pairs:
+            example_id = hashlib.sha256(f"{before}\0{after}".encode("utf-8")).hexdigest()
+            if example_id not in known:
+                known.add(example_id)
+                new_examples.append({"id": example_id, "program": program, "paragraph": name,
+                                     "before": before, "after": after})
+        if not new_examples:
+            return 0
+
+        import numpy as np
+
+        vectors = self.embed([example["before"] for example in new_examples])
+        # Another run may have added to the index since it was loaded: the matrix and the examples are read again
+        # and written under the lock, so that each row stays with its example
+        with file_lock(self.lock_path):
+            self._load()
+            known = {example["id"] for example in self.examples}
+            rows = [row for row, example in enumerate(new_examples) if example["id"] not in known]
+            new_examples, vectors = [new_examples[row] for row in rows], vectors[rows]
+            if not new_examples:
+                return 0
+            embeddings = vectors if self.embeddings is None else np.vstack([self.embeddings, vectors])
+            # The matrix first: rows without an example are dropped on load
+            buffer = io.BytesIO()
+            np.save(buffer, embeddings)
+            write_atomic(self.embeddings_path, buffer.getvalue())
+            with open(self.examples_path, 'a') as file:
+                file.writelines(json.dumps(example) + "\n" for example in new_examples)
+        self.examples.extend(new_examples)
+        self.embeddings = embeddings
+        return len(new_examples)
+
+    def search(self, code: str, token_budget: int = EXAMPLE_TOKEN_BUDGET,
+               min_similarity: float = EXAMPLE_MIN_SIMILARITY) -> List[Dict[str, Any]]:
+        """
+        Finds the examples most similar to the paragraphs of a program, the best first, as many as fit in the
+        token budget. An example scores its best cosine similarity with any paragraph of the program.
+        """
+        paragraphs = [text for _, text in split_paragraphs(code)]
+        if not self.examples or not paragraphs:
+            return []
+        import numpy as np
+
+        scores = (self.embed(paragraphs) @ self.embeddings.T).max(axis=0)
+
+        selected, tokens = [], 0
+        for row in np.argsort(-scores):
+            if scores[row] < min_similarity:
+                break
+            example = self.examples[row]
+            example_tokens = count_tokens(example["before"]) + count_tokens(example["after"])
+            if tokens + example_tokens > token_budget:
+                continue
+            selected.append(dict(example, similarity=float(scores[row])))
+            tokens += example_tokens
+        return selected
+
+
+def format_examples(examples: List[Dict[str, Any]]) -> str:
+    return "\n\n".join(f"Example {index} ({example['program']}, paragraph {example['paragraph']}):\n"
+                       f"Before:\n{example['before']}\nAfter:\n{example['after']}"
+                       for index, example in enumerate(examples, 1))
+
+
+_example_index: Optional[ExampleIndex] = None
+_enabled = RETRIEVE_EXAMPLES
+
+
+def get_example_index() -> Optional[ExampleIndex]:
+    """
+    Returns the example index of the workflow, loaded on first use, or None if the retrieval is disabled.
+    """
+    global _example_index
+    if _enabled and _example_index is None:
+        _example_index = ExampleIndex()
+    return _example_index if _enabled else None
+
+
+def set_example_index(index: Optional[ExampleIndex]):
+    """
+    Replaces the example index of the workflow, or disables the retrieval and recording of examples if None
+    (e.g. in the evaluations, whose results must not depend on the past runs).
+    """
+    global _example_index, _enabled
+    _example_index, _enabled = index, index is not None
+
+
+def retrieve_examples(filename: str, old_code: str) -> str:
+    """
+    Returns the accepted past enhancements most similar to a program, formatted for the generation prompt.
+    """
+    index = get_example_index()
+    if index is None or not len(index):
+        return ""
+    try:
+        examples = index.search(old_code)
+    except Exception as e:
+        # The examples only help: the file is processed without them
+        print_error(f"Retrieval of the examples failed: {e}")
+        return ""
+    if examples:
+        print_info(f"Retrieved {len(examples)} accepted example(s) for {filename}: " +
+                   ", ".join(f"{example['paragraph']} ({example['similarity']:.2f})" for example in examples))
+    return format_examples(examples)
+
+
+def record_accepted(filename: str, old_code: str, new_code: str):
+    """
+    Adds the changed paragraphs of an accepted output to the example index.
+    """
+    index = get_example_index()
+    if index is None:
+        return
+    try:
+        added = index.add(filename, paragraph_pairs(old_code, new_code))
+    except Exception as e:
+        print_error(f"Indexing of the accepted paragraphs failed: {e}")
+        return
+    if added:
+        print_info(f"Added {added} accepted paragraph(s) of {filename} to the examples.")
+
+
+def main(argv: Optional[List[str]] = None):
+    """
+    Indexes the accepted outputs recorded by the previous runs whose source and output files are still on disk.
+    """
+    from .results_store import ResultsStore
+
+    parser = argparse.ArgumentParser(description="Index the accepted outputs of the previous runs as examples.")
+    parser.add_argument("--program", help="Only the outputs of the programs matching this pattern (SQL LIKE).")
+    args = parser.parse_args(argv)
+
+    print_heading("INDEXING ACCEPTED OUTPUTS")
+    store = ResultsStore()
+    outputs = store.query(program_pattern=args.program)
+    store.close()
+
+    index = ExampleIndex()
+    before = len(index)
+    for output in outputs:
+        if not os.path.exists(output["source_path"]) or not os.path.exists(output["output_path"]):
+            continue
+        pairs = paragraph_pairs(read_source(output["source_path"]).text, read_source(output["output_path"]).text)
+        index.add(output["program"], pairs)
+    print_info(f"{len(index) - before} example(s) added, {len(index)} in the index.")
+
+
+if __name__ == "__main__":
+    main()
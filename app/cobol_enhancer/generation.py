@@ -1,141 +1,241 @@
+import asyncio
 # Hacky trick to resolve an issue with pyreadline on Windows
 # Manually patch the Callable in collections if it's not present
 import collections.abc
 import os
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
 
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import AnthropicLLM
+from langchain_core.runnables import Runnable
 from pydantic import BaseModel, Field
 
-from .common import MODEL_NAME, GraphState, WorkflowExit
-from .prompts import critic_generation_prompt, analyze_file_prompt, generation_prompt
+from .common import GraphState, WorkflowExit, SPECULATIVE_CANDIDATES, SPECULATIVE_TEMPERATURES, INPUT_DIR, \
+    SOURCE_EXTENSIONS, CRITIC_MODE, CRITIC_DIFF_MAX_RATIO, CRITIC_DIFF_CONTEXT, CRITIC_PARAGRAPH_CONTEXT, \
+    CLUSTER_RELATED_FILES
+from .analysis import use_map_reduce, map_reduce_analysis, flagged_sections
+from .dependencies import get_dependency_graph, order_copybooks
+from .examples import retrieve_examples
+from .inventory import get_inventory
+from .planner import plan, print_plan, order_files, count_tokens
+from . import review_queue
+from .ingestion import SourceMember, read_source, ingestion_stats
+from .blob_store import blob_store, blob_owner, put_text, get_text, store_copybooks, load_copybooks, collect_state
+from .results_store import ResultsStore, start_iteration, grade_iteration, flush_node_timings
+from .prompts import critic_generation_prompt, critic_diff_prompt, analyze_file_prompt, generation_prompt
+from .routing import select_route, get_chat_model, record_generation_outcome
+from .structure import structured_diff, summarize_structure
 from .utils import print_heading, print_info, print_error, format_copybooks_for_display, print_code_comparator, \
-    get_previous_critic_description, generate_code_with_history, filename_tab_completion, extract_copybooks
+    get_previous_critic_description, generate_code, agenerate_code, filename_tab_completion, \
+    extract_copybooks, run_coroutine
 
 if not hasattr(collections, 'Callable'):
     collections.Callable = collections.abc.Callable
 
-try:
-    # Attempt to import readline for Unix/Linux systems
-    import readline
-except ImportError:
-    # Fallback for Windows, requiring pyreadline
+
+def setup_tab_completion():
+    # Only on the interactive path: readline is not needed to import the workflow
     try:
-        import pyreadline as readline
+        # Attempt to import readline for Unix/Linux systems
+        import readline
     except ImportError:
-        print("pyreadline is required on Windows. Please install with 'pip install pyreadline'.")
-        raise WorkflowExit
-
-
-def process_directory(state: GraphState) -> GraphState:
-    print_heading("PROCESSING DIRECTORY")
+        # Fallback for Windows, requiring pyreadline
+        try:
+            import pyreadline as readline
+        except ImportError:
+            print("pyreadline is required on Windows. Please install with 'pip install pyreadline'.")
+            raise WorkflowExit
 
-    # Set up tab completion for file names
+    # Set up tab completion for file names, including the ones in subdirectories
     readline.set_completer(filename_tab_completion)
+    readline.set_completer_delims(" \t\n,")
     readline.parse_and_bind("tab: complete")
 
+
+class CodeReviewResult(BaseModel):
+    description: str = Field(description="The written critique of the code comparison.")
+    grade: str = Field(description="Binary score 'good' or 'bad'.")
+
+
+def select_files() -> List[str]:
+    """
+    Asks the user which files to process, in the terminal.
+    """
+    setup_tab_completion()
+    inventory = get_inventory()
+
     files_to_process = []
 
     while True:
 
         # Ask the user how they want to proceed: all files or a specific list
         choice = input(
-            "Process all COBOL files in the directory (a), a specific list (s), or exit (e)? [a/s/e]: ").strip().lower()
+            "Process all COBOL files in the directory (a), a specific list (s), show a dry-run plan (p), "
+            "or exit (e)? [a/s/p/e]: ").strip().lower()
 
         if choice == 'a':
-            for root, dirs, files in os.walk("data/input/"):
-                for file in files:
-                    if file.endswith(".cob"):
-                        file_path = os.path.join(root, file)
-                        files_to_process.append(file_path)
+            files_to_process.extend(inventory.paths())
             break
         elif choice == 's':
             print("Enter the filenames to process, separated by commas (Tab for autocompletion): ")
             specified_files = input().strip().split(',')
             for file in specified_files:
                 file = file.strip()  # Remove any leading/trailing whitespace
-                if file.endswith(".cob"):
-                    file_path = os.path.join("data/input/", file)  # Assuming files are in 'data/input/'
-                    if os.path.exists(file_path):
+                if file.endswith(tuple(SOURCE_EXTENSIONS)):
+                    file_path = os.path.join(INPUT_DIR, file)  # Assuming files are in 'data/input/'
+                    if file in inventory or os.path.exists(file_path):
                         files_to_process.append(file_path)
                     else:
                         print_info(f"File not found: {file_path}")
                 else:
                     print_info(f"Ignored non-COBOL file: {file}")
             break
+        elif choice == 'p':
+            # Estimate the tokens, time and cost of processing all the files, without processing them
+            print_plan(plan(inventory.paths()))
+            continue
         elif choice == 'e':  # Allow the user to exit the program
             print_info("Exiting program as requested.")
             raise WorkflowExit
         else:
             print_error(
-                "Invalid choice. Please enter 'a' to process all files, 's' for a specific list, or 'e' to exit.")
+                "Invalid choice. Please enter 'a' to process all files, 's' for a specific list, 'p' for a plan, "
+                "or 'e' to exit.")
+
+    return files_to_process
+
 
+def process_directory(state: GraphState) -> GraphState:
+    print_heading("PROCESSING DIRECTORY")
+
+    # Files given on the command line, or left by an interrupted run, are processed without asking
+    files_to_process = list(state.get("files_to_process") or []) or select_files()
+
+    # Long programs first by default, so that they don't stretch the end of the run
+    files_to_process = order_files(files_to_process)
+    if CLUSTER_RELATED_FILES:
+        # Related programs one after the other, each cluster in place of its first program: they reuse the
+        # provider's cached prompt prefix (instructions and common copybooks) and the copybooks already resolved
+        clusters = get_dependency_graph().clusters(files_to_process)
+        files_to_process = [file_path for cluster in clusters for file_path in cluster]
+        for cluster in clusters:
+            if len(cluster) > 1:
+                print_info(f"Related programs processed together: {', '.join(map(os.path.basename, cluster))}")
     state["files_to_process"] = files_to_process
 
     if not files_to_process:
         print_info("No COBOL files to process. Exiting the program.")
         raise WorkflowExit  # Exit if no files are to be processed
 
+    # Every accepted output is recorded in the results store under the identifier of this run (kept when a run
+    # is resumed)
+    if not state.get("run_id"):
+        state["run_id"] = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:6]}"
+    store = ResultsStore()
+    store.start_run(state["run_id"], files_to_process)
+    store.close()
+    print_info(f"Run: {state['run_id']}")
+    # The blobs this run spills are registered under it, so that the other runs sharing the spill directory keep them
+    blob_store.owner = blob_owner(state)
+
     print_info(f"Files to process: {files_to_process}")
     return state
 
 
+def report_ingestion(file_path: str, source: SourceMember):
+    source_tokens = count_tokens(source.text)
+    # The areas are removed from every prompt containing the program
+    saved_tokens = count_tokens(source.sequence_areas) if source.sequence_areas else 0
+    ingestion_stats.record(source_tokens, saved_tokens)
+    source_format = source.layout["encoding"]
+    if source.layout["record_length"]:
+        source_format += f", {source.layout['record_length']}-byte records"
+    print_info(f"Read {file_path} ({source_format}): {source_tokens} tokens.")
+    if saved_tokens:
+        print_info(f"Stripped the sequence and identification areas: {saved_tokens} tokens saved per prompting of "
+                   f"the program ({saved_tokens / (source_tokens + saved_tokens):.0%}).")
+
+
 def analyze_next_file(state: GraphState) -> GraphState:
     print_heading("ANALYZING FILE")
+    # The timings of the previous file end with its handle_logs, the ones of this file start here
+    flush_node_timings(state)
     if not state["files_to_process"]:
         print_info("No more files to process.")
         return state
 
     current_file = state["files_to_process"][0]
-    with open(current_file, 'r') as file:
-        old_code = file.read()
+    source = read_source(current_file)
+    old_code = source.text
+    report_ingestion(current_file, source)
 
+    copybooks = order_copybooks(extract_copybooks(old_code))
     state["filename"] = os.path.basename(current_file)
-    state["old_code"] = old_code
-    state["copybooks"] = extract_copybooks(old_code)
+    state["old_code"] = put_text(old_code)
+    state["source_layout"] = source.layout
+    state["sequence_areas"] = put_text(source.sequence_areas)
+    state["copybooks"] = store_copybooks(copybooks)
+    state["program_lines"] = len(old_code.splitlines())
+    examples = retrieve_examples(state["filename"], old_code)
+    state["examples"] = put_text(examples) if examples else ""
+
+    # Every new file starts again from the cheapest model of its routes
+    state["escalation_level"] = 0
+    state["generation_route"] = ""
+    state["iteration_history"] = []
+
+    state["analysis_findings"] = []
+    original_critic = None
+    if use_map_reduce(state["program_lines"]):
+        # Falls back to the single analysis if none of the parts could be critiqued
+        original_critic = map_reduce_analysis(state, old_code, copybooks)
+
+    if original_critic is None:
+        template = analyze_file_prompt()
+        # model = AnthropicLLM(temperature=0, model="claude-2.1", streaming=True)
+        route = select_route("analyze_next_file", state)
+        model = get_chat_model(route)
+
+        chain = ChatPromptTemplate.from_template(template) | model.with_structured_output(CodeReviewResult)
 
-    template = analyze_file_prompt()
-    # model = AnthropicLLM(temperature=0, model="claude-2.1", streaming=True)
-    model = ChatOpenAI(temperature=0, model=MODEL_NAME, streaming=True)
-
-    class CodeReviewResult(BaseModel):
-        description: str = Field(description="The written critique of the code comparison.")
-        grade: str = Field(description="Binary score 'good' or 'bad'.")
-
-    chain = ChatPromptTemplate.from_template(template) | model.with_structured_output(CodeReviewResult)
-
-    critic_response = chain.invoke({
-        "filename": state["filename"],
-        "old_code": state["old_code"],
-        "copybooks": format_copybooks_for_display(state["copybooks"])
-    })
+        critic_response = chain.invoke({
+            "filename": state["filename"],
+            "old_code": old_code,
+            "copybooks": format_copybooks_for_display(copybooks)
+        })
+        original_critic = critic_response.dict()
 
-    state["original_critic"] = critic_response.dict()
+    state["original_critic"] = original_critic
 
     print_info(f"Original Code Critic Description: {state['original_critic']['description']}")
     print_info(f"Critic Grade: {state['original_critic']['grade']}")
     return state
 
 
-def generate(state: GraphState) -> GraphState:
-    print_heading("GENERATION")
+def prepare_generation(state: GraphState) -> Tuple[str, Dict[str, Any]]:
+    """
+    Builds the generation template and its variables from the state, then moves the last generated code to
+    previous_last_gen_code and resets the Atlas information consumed by this generation.
+    """
+    start_iteration(state)
 
     template = generation_prompt(state)
-    model = ChatOpenAI(temperature=0, model=MODEL_NAME, streaming=True)
     variables = {
         "filename": state["filename"],
-        "copybooks": format_copybooks_for_display(state["copybooks"]),
-        "old_code": state["old_code"],
+        "copybooks": format_copybooks_for_display(load_copybooks(state["copybooks"])),
+        "old_code": get_text(state["old_code"]),
         "original_critic": state["original_critic"],
-        "new_code": state.get("new_code", ""),
+        "flagged_sections": flagged_sections(state.get("analysis_findings") or []),
+        "examples": get_text(state.get("examples", "")),
+        "new_code": get_text(state.get("new_code", "")),
         "critic": (state.get("critic") or {}).get("description", ""),
         "specific_demands": state.get("specific_demands", ""),
         "atlas_answer": state.get("atlas_answer", ""),
         "atlas_message_type": (state.get("atlas_message_type") or "").replace('_', ' ').capitalize()
     }
 
-    # Does nothing if first generation
+    # Does nothing if first generation (only the reference moves, not the code)
     state["previous_last_gen_code"] = state.get("new_code", "")
 
     # Reset atlas-related state information if it was used during this execution
@@ -143,44 +243,88 @@ def generate(state: GraphState) -> GraphState:
         state["atlas_answer"] = ""
         state["atlas_message_type"] = ""
 
-    state["new_code"] = generate_code_with_history(state, "process_next_file", template, model, variables)
+    return template, variables
+
+
+def generate(state: GraphState) -> GraphState:
+    print_heading("GENERATION")
+
+    route = select_route("generate", state)
+    model = get_chat_model(route)
+    state["generation_route"] = route.key
+    print_info(f"Generating with {route.model_name} (route {route.key}).")
+
+    template, variables = prepare_generation(state)
+    state["new_code"] = put_text(generate_code(template, model, variables))
 
     # After first generation, clear the original_critic
     state["original_critic"] = {}
 
+    # Only the original, previous and new code of the file remain needed
+    collect_state(state)
+
     print_info(f"Generated file: {state['filename']}")
 
     return state
 
 
-def critic_generation(state: GraphState) -> GraphState:
-    print_heading("CRITIC GENERATION")
+def critic_diff_inputs(old_code: str, previous_code: str, new_code: str) -> Optional[Dict[str, str]]:
+    """
+    Builds the inputs of the diff mode of the critic, or returns None when the changes are too large for the
+    diff to be worth it (the full versions are given to the critic then).
+    """
+    code_diff, changed = structured_diff(old_code, new_code, CRITIC_DIFF_CONTEXT, CRITIC_PARAGRAPH_CONTEXT)
+    if len(code_diff) > CRITIC_DIFF_MAX_RATIO * len(new_code):
+        return None
+    iteration_diff = ""
+    if previous_code:
+        iteration_diff = structured_diff(previous_code, new_code, CRITIC_DIFF_CONTEXT, CRITIC_PARAGRAPH_CONTEXT)[0]
+    return {
+        "structure": summarize_structure(old_code),
+        "changed_paragraphs": ", ".join(changed) or "none",
+        "code_diff": code_diff or "No changes.",
+        "iteration_diff": iteration_diff or "No changes.",
+    }
 
-    # Concatenate the base prompt with the detailed sections
-    template = critic_generation_prompt(state)
 
-    # Set up the model and the structured output parser
-    model = ChatOpenAI(temperature=0, model=MODEL_NAME, streaming=True)
+def build_critic_chain(state: GraphState) -> Tuple[Runnable, Dict[str, Any]]:
+    inputs = {
+        "old_code": get_text(state["old_code"]),
+        "previous_iteration_code": get_text(state.get("previous_last_gen_code", "")),
+        "specific_demands": state.get("specific_demands", ""),
+        "previous_critic_description": get_previous_critic_description(state),
+        "atlas_answer": state.get("atlas_answer", ""),
+        "new_code": get_text(state["new_code"]),
+        "atlas_message_type": (state.get("atlas_message_type") or "").replace('_', ' ').capitalize()
+    }
 
-    # Define the Pydantic model for structured output
-    class CodeReviewResult(BaseModel):
-        description: str = Field(description="The written critique of the code comparison.")
-        grade: str = Field(description="Binary score 'good' or 'bad'.")
+    # The changes only, unless they are too large or the full mode is configured
+    diff_inputs = None
+    if CRITIC_MODE == "diff":
+        diff_inputs = critic_diff_inputs(inputs["old_code"], inputs["previous_iteration_code"], inputs["new_code"])
+    if diff_inputs is not None:
+        template = critic_diff_prompt(state)
+        inputs.update(diff_inputs)
+    else:
+        # Concatenate the base prompt with the detailed sections
+        template = critic_generation_prompt(state)
+
+    # Set up the model and the structured output parser
+    model = get_chat_model(select_route("critic_generation", state))
 
     # Use the full prompt to call the model with structured output
     chain = ChatPromptTemplate.from_template(template) | model.with_structured_output(CodeReviewResult)
+    return chain, inputs
+
+
+def critic_generation(state: GraphState) -> GraphState:
+    print_heading("CRITIC GENERATION")
+
+    chain, inputs = build_critic_chain(state)
 
     # Invoke the chain with the filled-out prompt
     try:
-        critic_response = chain.invoke({
-            "old_code": state["old_code"],
-            "previous_iteration_code": state.get("previous_last_gen_code", ""),
-            "specific_demands": state.get("specific_demands", ""),
-            "previous_critic_description": get_previous_critic_description(state),
-            "atlas_answer": state.get("atlas_answer", ""),
-            "new_code": state["new_code"],
-            "atlas_message_type": (state.get("atlas_message_type") or "").replace('_', ' ').capitalize()
-        })
+        critic_response = chain.invoke(inputs)
 
         # Update the state with the critic information
         state["critic"] = critic_response.dict()
@@ -192,13 +336,94 @@ def critic_generation(state: GraphState) -> GraphState:
         # Provide default values in case of an error
         state["critic"] = {"description": "An error occurred during critique generation.", "grade": "bad"}
 
+    grade_iteration(state)
+
+    # A rejected output escalates the next generation to a stronger model
+    record_generation_outcome(state, state["critic"]["grade"] == "good")
+
+    return state
+
+
+async def _generate_and_critique(state: GraphState, index: int, temperature: float, template: str,
+                                 variables: Dict[str, Any]) -> Tuple[int, str, Dict[str, str]]:
+    route = select_route("generate", state)
+    model = get_chat_model(route, temperature=temperature)
+    new_code = put_text(await agenerate_code(template, model, variables))
+
+    # The candidate is critiqued against the same previous iteration as a sequential generation would be
+    chain, inputs = build_critic_chain({**state, "new_code": new_code})
+    try:
+        critic = (await chain.ainvoke(inputs)).dict()
+    except Exception as e:
+        print_error(f"Error during critic generation of candidate {index}: {e}")
+        critic = {"description": "An error occurred during critique generation.", "grade": "bad"}
+
+    print_info(f"Candidate {index} (temperature {temperature}) graded {critic['grade']}.")
+    return index, new_code, critic
+
+
+async def _race_candidates(state: GraphState, template: str,
+                           variables: Dict[str, Any]) -> Tuple[int, str, Dict[str, str]]:
+    tasks = [
+        asyncio.create_task(_generate_and_critique(
+            state, index, SPECULATIVE_TEMPERATURES[index % len(SPECULATIVE_TEMPERATURES)], template, variables))
+        for index in range(SPECULATIVE_CANDIDATES)
+    ]
+    candidates = []
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                candidate = await next_done
+            except Exception as e:
+                print_error(f"Candidate generation failed: {e}")
+                continue
+            # The first candidate graded good wins, the others are cancelled
+            if candidate[2]["grade"] == "good":
+                return candidate
+            candidates.append(candidate)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Wait for the cancelled candidates to actually stop
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if not candidates:
+        raise RuntimeError("All the speculative candidates failed.")
+    # None is good: keep the most conservative one (lowest temperature) for the next round
+    return min(candidates, key=lambda candidate: candidate[0])
+
+
+def speculative_generation(state: GraphState) -> GraphState:
+    print_heading("SPECULATIVE GENERATION")
+
+    route = select_route("generate", state)
+    state["generation_route"] = route.key
+    print_info(f"Generating {SPECULATIVE_CANDIDATES} candidates with {route.model_name} (route {route.key}).")
+
+    template, variables = prepare_generation(state)
+    index, new_code, critic = run_coroutine(_race_candidates(state, template, variables))
+
+    state["new_code"] = new_code
+    state["critic"] = critic
+    state["original_critic"] = {}
+
+    # The losing candidates are dropped
+    collect_state(state)
+
+    print_info(f"Kept candidate {index} for file: {state['filename']}")
+    print_info(f"Critic Description: {state['critic']['description']}")
+    print_info(f"Critic Grade: {state['critic']['grade']}")
+
+    grade_iteration(state)
+    record_generation_outcome(state, state["critic"]["grade"] == "good")
+
     return state
 
 
 def human_review(state: GraphState) -> GraphState:
     print_heading("HUMAN REVIEW")
 
-    print_code_comparator(state["old_code"], state["new_code"])
+    print_code_comparator(get_text(state["old_code"]), get_text(state["new_code"]))
 
     decision_made = False
     specific_demands_provided = False
@@ -232,3 +457,22 @@ def human_review(state: GraphState) -> GraphState:
             print_error("Error: Please enter 'yes' or 'no'.")
 
     return state
+
+
+def queue_review(state: GraphState) -> GraphState:
+    print_heading("HUMAN REVIEW (QUEUE)")
+
+    # Park the finished candidate of the current file, its review happens in another process
+    if state.get("filename") and state.get("new_code"):
+        review_queue.park(state)
+        review_queue.clear_parked_state(state)
+
+    # Resume a reviewed file if any, only waiting for a decision when there is nothing else left to do
+    decided = review_queue.pop_decided_ticket(wait=not state["files_to_process"])
+    if decided:
+        review_queue.restore(state, *decided)
+    else:
+        state["human_decision"] = ""
+        print_info("No review decision yet. Moving on to the next file.")
+
+    return state
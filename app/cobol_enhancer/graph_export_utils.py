@@ -1,8 +1,14 @@
-import networkx as nx
-import plotly.graph_objects as go
-from graphviz import Digraph
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple, TYPE_CHECKING
+
 from langchain_core.runnables.graph import Graph, Edge
 
+if TYPE_CHECKING:
+    import plotly.graph_objects as go
+
+# A recorded run: the node timings of each file, in execution order (see ResultsStore.run_trace)
+RunTrace = Dict[str, List[Dict[str, Any]]]
+
 
 def merge_deciders_for_printing(graph: Graph) -> Graph:
     # Step 1: Identify deciders and their targets with labels
@@ -32,7 +38,56 @@ def merge_deciders_for_printing(graph: Graph) -> Graph:
     return Graph(new_nodes, new_edges)
 
 
-def export_graph_to_image(graph: Graph, output_directory: str, filename: str = "graph_advanced"):
+def summarize_trace(trace: RunTrace) -> Tuple[Dict[str, Dict[str, float]], Dict[Tuple[str, str], int]]:
+    """
+    Aggregates a run trace into the time spent in each node and the number of times each edge was traversed
+    (two nodes executed one after the other for the same file, or the handle_logs ending a file and the first node
+    of the next one).
+
+    Args:
+        trace (RunTrace): The node timings of each file.
+
+    Returns:
+        tuple: The total time, number of executions and mean time of each node, and the traversal count of each
+        (source, target) edge.
+    """
+    node_stats = defaultdict(lambda: {"total": 0.0, "count": 0, "mean": 0.0})
+    edge_counts = defaultdict(int)
+    for timings in trace.values():
+        for timing in timings:
+            stats = node_stats[timing["node"]]
+            stats["total"] += timing["duration"]
+            stats["count"] += 1
+            stats["mean"] = stats["total"] / stats["count"]
+        for previous, current in zip(timings, timings[1:]):
+            edge_counts[(previous["node"], current["node"])] += 1
+    # The files of a run are in processing order: once a file is handled, the workflow moves on to the next one
+    files = [timings for timings in trace.values() if timings]
+    for previous, current in zip(files, files[1:]):
+        if previous[-1]["node"] == "handle_logs":
+            edge_counts[("handle_logs", current[0]["node"])] += 1
+    return dict(node_stats), dict(edge_counts)
+
+
+def heat_color(value: float, maximum: float) -> str:
+    # From light yellow (no time) to red (the most time)
+    ratio = value / maximum if maximum else 0.0
+    low, high = (0xff, 0xff, 0xcc), (0xe3, 0x1a, 0x1c)
+    return "#" + "".join(f"{round(l + (h - l) * ratio):02x}" for l, h in zip(low, high))
+
+
+def export_graph_to_image(graph: Graph, output_directory: str, filename: str = "graph_advanced",
+                          trace: Optional[RunTrace] = None):
+    """
+    Renders the workflow graph with Graphviz. With a run trace, the nodes are coloured by the time spent in them
+    and the edges are as thick as the number of times they were traversed (untraversed edges are dashed).
+    """
+    from graphviz import Digraph  # Only needed to export, like plotly and networkx below
+
+    node_stats, edge_counts = summarize_trace(trace) if trace else ({}, {})
+    max_total = max((stats["total"] for stats in node_stats.values()), default=0.0)
+    max_count = max(edge_counts.values(), default=0)
+
     dot = Digraph(comment='Workflow Graph', format='png')
 
     # Increase the DPI for higher image quality
@@ -52,7 +107,13 @@ def export_graph_to_image(graph: Graph, output_directory: str, filename: str = "
     for node_id, node in graph.nodes.items():
         if node_id not in ['__start__', '__end__']:
             label = node_id.replace('_', ' ').title()
-            dot.node(node_id, label, fillcolor='#ffcccc')  # Light red for other nodes
+            if trace is None:
+                dot.node(node_id, label, fillcolor='#ffcccc')  # Light red for other nodes
+                continue
+            stats = node_stats.get(node_id)
+            if stats:
+                label += f"\n{stats['total']:.1f}s total, {stats['mean']:.1f}s mean ({stats['count']}x)"
+            dot.node(node_id, label, fillcolor=heat_color(stats["total"] if stats else 0.0, max_total))
 
     # Define edges with specific conditions for green color
     green_edges_label = ['human_check', 'send_file', 'sender', 'next_file', 'no_more_file', 'logs']
@@ -65,13 +126,24 @@ def export_graph_to_image(graph: Graph, output_directory: str, filename: str = "
             color = '#33cc33'  # Dark green for specified steps
         else:
             color = '#cc3333'  # Dark red for other steps
-        dot.edge(edge.source, edge.target, label=label, color=color, fontsize='10')
+        if trace is None:
+            dot.edge(edge.source, edge.target, label=label, color=color, fontsize='10')
+            continue
+        count = edge_counts.get((edge.source, edge.target), 0)
+        dot.edge(edge.source, edge.target, label=f"{label} x{count}" if count else label, color=color,
+                 fontsize='10', penwidth=str(1 + 5 * count / max_count) if max_count else '1',
+                 style='solid' if count else 'dashed')
 
     # Export the graph to a file
     dot.render(filename=filename, directory=output_directory, view=True, cleanup=True)
 
 
-def convert_graph_to_plotly_figure(graph: Graph) -> go.Figure:
+def convert_graph_to_plotly_figure(graph: Graph, trace: Optional[RunTrace] = None) -> "go.Figure":
+    if trace:
+        return convert_trace_to_plotly_figure(graph, trace)
+    import networkx as nx
+    import plotly.graph_objects as go
+
     # Create a directed graph with NetworkX
     G = nx.DiGraph()
 
@@ -116,3 +188,66 @@ def convert_graph_to_plotly_figure(graph: Graph) -> go.Figure:
                                                                     yaxis=dict(showgrid=False, zeroline=False,
                                                                                showticklabels=False)))
     return fig
+
+
+def _trace_view(nodes: List[str], edges: List[Tuple[str, str]], trace: RunTrace) -> Dict[str, list]:
+    # Styles of the nodes and edges for the given files
+    node_stats, edge_counts = summarize_trace(trace)
+    max_count = max(edge_counts.values(), default=0)
+    node_totals = [node_stats[node]["total"] if node in node_stats else 0.0 for node in nodes]
+    node_texts = [f"{node}<br>{node_stats[node]['total']:.1f}s total, {node_stats[node]['mean']:.1f}s mean "
+                  f"({node_stats[node]['count']}x)" if node in node_stats else f"{node}<br>not executed"
+                  for node in nodes]
+    edge_widths = [1 + 8 * edge_counts.get(edge, 0) / max_count if max_count else 1 for edge in edges]
+    edge_texts = [f"{source} -> {target}: {edge_counts.get((source, target), 0)}x" for source, target in edges]
+    return {"node_totals": node_totals, "node_texts": node_texts, "edge_widths": edge_widths,
+            "edge_texts": edge_texts}
+
+
+def convert_trace_to_plotly_figure(graph: Graph, trace: RunTrace) -> "go.Figure":
+    """
+    Plots the workflow graph as a heatmap of a run trace: nodes coloured by the time spent in them and edges as
+    thick as the number of times they were traversed, with a menu to drill down from the whole run to each file.
+    """
+    import networkx as nx
+    import plotly.graph_objects as go
+
+    G = nx.DiGraph()
+    for node_id in graph.nodes:
+        G.add_node(node_id)
+    for edge in graph.edges:
+        G.add_edge(edge.source, edge.target)
+    pos = nx.circular_layout(G)
+    nodes, edges = list(G.nodes()), list(G.edges())
+
+    views = {"All files": _trace_view(nodes, edges, trace)}
+    for file in trace:
+        views[file] = _trace_view(nodes, edges, {file: trace[file]})
+    view = views["All files"]
+
+    # One trace per edge, so that each edge has its own width
+    data = []
+    for (source, target), width, text in zip(edges, view["edge_widths"], view["edge_texts"]):
+        (x0, y0), (x1, y1) = pos[source], pos[target]
+        data.append(go.Scatter(x=[x0, (x0 + x1) / 2, x1], y=[y0, (y0 + y1) / 2, y1], mode='lines',
+                               line=dict(width=width, color='grey'), hoverinfo='text', hovertext=[text] * 3))
+    data.append(go.Scatter(x=[pos[node][0] for node in nodes], y=[pos[node][1] for node in nodes],
+                           mode='markers+text', text=nodes, textposition="bottom center", hoverinfo='text',
+                           hovertext=view["node_texts"],
+                           marker=dict(size=18, color=view["node_totals"], colorscale='YlOrRd', showscale=True,
+                                       colorbar=dict(title="Total time (s)"))))
+
+    buttons = []
+    for name, view in views.items():
+        # Per-trace values: the edges, then the nodes
+        buttons.append(dict(label=name, method="restyle", args=[{
+            "line.width": view["edge_widths"] + [None],
+            "hovertext": [[text] * 3 for text in view["edge_texts"]] + [view["node_texts"]],
+            "marker.color": [None] * len(edges) + [view["node_totals"]],
+        }]))
+
+    return go.Figure(data=data, layout=go.Layout(
+        showlegend=False, hovermode='closest', margin=dict(b=0, l=0, r=0, t=40),
+        updatemenus=[dict(buttons=buttons, direction="down", x=0, y=1.08, xanchor="left", yanchor="top")],
+        xaxis=dict(showgrid=False, zeroline=False, showticklabels=False),
+        yaxis=dict(showgrid=False, zeroline=False, showticklabels=False)))
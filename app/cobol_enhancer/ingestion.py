@@ -0,0 +1,260 @@
+import codecs
+import difflib
+import os
+import re
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from .common import (SOURCE_ENCODING, EBCDIC_CODEPAGE, STRIP_SEQUENCE_AREAS, SOURCE_RECORD_LENGTH,
+                     INGEST_CHUNK_SIZE)
+
+# Columns of the fixed reference format: 1-6 sequence area, 7 indicator, 8-72 program text, 73-80 identification
+SEQUENCE_AREA_LENGTH = 6
+PROGRAM_TEXT_END = 72
+# Indicator area (column 7) of fixed format: blank, comment, page eject, continuation or debugging line
+INDICATORS = ("", " ", "*", "/", "-", "D", "d")
+
+# Letters, digits and space in the EBCDIC code pages, used to recognize EBCDIC sources
+_EBCDIC_TEXT_BYTES = set(range(0xC1, 0xCA)) | set(range(0xD1, 0xDA)) | set(range(0xE2, 0xEA)) | \
+                     set(range(0xF0, 0xFA)) | {0x40, 0x4B, 0x5D, 0x4D, 0x7D, 0x60, 0x6B, 0x5E}
+# Line terminators: LF, CRLF and NEL (the EBCDIC new line, 0x15, decodes to U+0085)
+_LINE_TERMINATOR = re.compile("\r\n|\n|\x85")
+
+
+def _search_cp1047(name: str):
+    # cp1047 (z/OS Unix, ISPF) is not bundled with Python; it only differs from cp037 by 6 characters
+    if name != "cp1047":
+        return None
+    table = list(bytes(range(256)).decode("cp037"))
+    table[0x5F], table[0xB0] = "^", "¬"
+    table[0xAD], table[0xBA] = "[", "Ý"
+    table[0xBD], table[0xBB] = "]", "¨"
+    decoding_table = "".join(table)
+    encoding_table = codecs.charmap_build(decoding_table)
+
+    def encode(text, errors="strict"):
+        return codecs.charmap_encode(text, errors, encoding_table)
+
+    def decode(data, errors="strict"):
+        return codecs.charmap_decode(data, errors, decoding_table)
+
+    class IncrementalDecoder(codecs.IncrementalDecoder):
+        def decode(self, data, final=False):
+            return codecs.charmap_decode(data, self.errors, decoding_table)[0]
+
+    class IncrementalEncoder(codecs.IncrementalEncoder):
+        def encode(self, text, final=False):
+            return codecs.charmap_encode(text, self.errors, encoding_table)[0]
+
+    return codecs.CodecInfo(encode, decode, name="cp1047", incrementalencoder=IncrementalEncoder,
+                            incrementaldecoder=IncrementalDecoder)
+
+
+codecs.register(_search_cp1047)
+
+
+class SourceMember(NamedTuple):
+    # Text sent to the models: columns 1-6 blanked and columns 73-80 removed when the source is in fixed format
+    text: str
+    # How the source is stored, to write the output the same way (see encode_source)
+    layout: Dict[str, Any]
+    # Stripped areas, one line per source line: the 6 columns of the sequence area then the identification area
+    sequence_areas: str
+
+
+def detect_encoding(sample: bytes) -> str:
+    """
+    Guesses the encoding of a source from its first bytes: UTF-8 (which covers ASCII) when they decode as such,
+    EBCDIC_CODEPAGE when they are mostly EBCDIC letters, digits and spaces, Latin-1 otherwise.
+    """
+    if not sample:
+        return "utf-8"
+    try:
+        # The sample may end in the middle of a character
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    if sum(byte in _EBCDIC_TEXT_BYTES for byte in sample) / len(sample) > 0.6:
+        return EBCDIC_CODEPAGE
+    return "latin-1"
+
+
+def _split_lines(buffer: str) -> Tuple[List[Tuple[str, str]], str]:
+    # Returns the complete lines of the buffer with their terminator, and the incomplete rest
+    lines, start = [], 0
+    for match in _LINE_TERMINATOR.finditer(buffer):
+        lines.append((buffer[start:match.start()], match.group()))
+        start = match.end()
+    return lines, buffer[start:]
+
+
+def _iter_records(file, encoding: str, record_length: Optional[int]):
+    # Decodes the file chunk by chunk and yields its lines (or fixed-length records) and their terminator
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    rest = ""
+    while True:
+        chunk = file.read(INGEST_CHUNK_SIZE)
+        rest += decoder.decode(chunk, final=not chunk)
+        if record_length:
+            complete = len(rest) - len(rest) % record_length
+            for start in range(0, complete, record_length):
+                yield rest[start:start + record_length], ""
+            rest = rest[complete:]
+        else:
+            lines, rest = _split_lines(rest)
+            yield from lines
+        if not chunk:
+            break
+    if rest:
+        yield rest, ""
+
+
+def _has_fixed_columns(line: str) -> bool:
+    sequence = line[:SEQUENCE_AREA_LENGTH].strip()
+    return (not sequence or sequence.isdigit()) and line[SEQUENCE_AREA_LENGTH:SEQUENCE_AREA_LENGTH + 1] in INDICATORS
+
+
+def _is_fixed_format(lines: List[str]) -> bool:
+    # Fixed format with something to strip: no line beyond column 80, most lines with a numeric or blank sequence
+    # area and a valid indicator (code written from column 1 in free format must not be cut), and a sequence or
+    # identification area used
+    if any(len(line) > SOURCE_RECORD_LENGTH for line in lines):
+        return False
+    text_lines = [line for line in lines if line.strip()]
+    if sum(1 for line in text_lines if _has_fixed_columns(line)) * 2 <= len(text_lines):
+        return False
+    return any(line[:SEQUENCE_AREA_LENGTH].strip() or line[PROGRAM_TEXT_END:].strip() for line in lines)
+
+
+def read_source(path: str, encoding: str = SOURCE_ENCODING, strip: bool = STRIP_SEQUENCE_AREAS) -> SourceMember:
+    """
+    Reads a COBOL source or copybook, decoding it from EBCDIC if needed and streaming it so that the raw content
+    is never held in memory next to the decoded one. In fixed format, the sequence area (columns 1-6) is blanked
+    and the identification area (columns 73-80) removed, since they are only noise for the models; they are
+    kept aside to be restored by restore_sequence_areas.
+
+    Args:
+        path (str): The path of the source.
+        encoding (str): The encoding of the source, or "auto" to detect it.
+        strip (bool): Whether to strip the sequence and identification areas.
+
+    Returns:
+        SourceMember: The text to prompt with, the layout of the source and the stripped areas.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        sample = file.read(INGEST_CHUNK_SIZE)
+        if encoding == "auto":
+            encoding = detect_encoding(sample)
+        # Records transferred in binary from the mainframe have no line terminators
+        terminators = (b"\n",) if encoding in ("utf-8", "latin-1") else (b"\x15", b"\x25")
+        record_length = None
+        if size > SOURCE_RECORD_LENGTH and size % SOURCE_RECORD_LENGTH == 0 and \
+                not any(terminator in sample for terminator in terminators):
+            record_length = SOURCE_RECORD_LENGTH
+        file.seek(0)
+
+        lines, newline = [], "\n"
+        for index, (line, terminator) in enumerate(_iter_records(file, encoding, record_length)):
+            if index == 0 and terminator:
+                newline = terminator
+            lines.append(line)
+
+    layout = {"encoding": encoding, "newline": newline, "record_length": record_length, "fixed_format": False}
+    if not strip or not _is_fixed_format(lines):
+        return SourceMember("\n".join(lines), layout, "")
+
+    layout["fixed_format"] = True
+    areas = []
+    for index, line in enumerate(lines):
+        areas.append(line[:SEQUENCE_AREA_LENGTH].ljust(SEQUENCE_AREA_LENGTH) + line[PROGRAM_TEXT_END:])
+        lines[index] = (" " * SEQUENCE_AREA_LENGTH + line[SEQUENCE_AREA_LENGTH:PROGRAM_TEXT_END]).rstrip()
+    return SourceMember("\n".join(lines), layout, "\n".join(areas))
+
+
+def _restore_line(code: str, area: Optional[str]) -> str:
+    if area is None:
+        # New line: no sequence number, no identification
+        return code
+    sequence, identification = area[:SEQUENCE_AREA_LENGTH], area[SEQUENCE_AREA_LENGTH:]
+    program_text = code[SEQUENCE_AREA_LENGTH:]
+    if not identification or len(program_text) > PROGRAM_TEXT_END - SEQUENCE_AREA_LENGTH:
+        return (sequence + program_text).rstrip()
+    return sequence + program_text.ljust(PROGRAM_TEXT_END - SEQUENCE_AREA_LENGTH) + identification
+
+
+def restore_sequence_areas(original_text: str, sequence_areas: str, new_text: str) -> str:
+    """
+    Puts the sequence and identification areas stripped by read_source back on a generated version of the
+    source. Lines are aligned with the original ones: unchanged and modified lines get their areas back, added
+    lines get a blank sequence area.
+
+    Args:
+        original_text (str): The text returned by read_source.
+        sequence_areas (str): The areas returned by read_source.
+        new_text (str): The generated text, in the same layout as original_text.
+
+    Returns:
+        str: The generated text with the areas restored.
+    """
+    if not sequence_areas:
+        return new_text
+    original_lines = original_text.split("\n")
+    areas = sequence_areas.split("\n")
+    new_lines = new_text.split("\n")
+
+    restored = []
+    matcher = difflib.SequenceMatcher(None, original_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "delete":
+            continue
+        for offset, new_line in enumerate(new_lines[j1:j2]):
+            # Modified lines keep the areas of the original lines they replace, in order
+            area = areas[i1 + offset] if tag != "insert" and i1 + offset < i2 else None
+            if new_line[:SEQUENCE_AREA_LENGTH].strip():
+                # The model didn't keep the sequence area blank: leave the line as generated
+                area = None
+            restored.append(_restore_line(new_line, area))
+    return "\n".join(restored)
+
+
+def encode_source(text: str, layout: Dict[str, Any]) -> bytes:
+    """
+    Encodes a text in the encoding and record format of the source it comes from.
+    """
+    lines = text.split("\n")
+    record_length = layout.get("record_length")
+    if record_length and all(len(line) <= record_length for line in lines):
+        return "".join(line.ljust(record_length) for line in lines).encode(layout["encoding"], errors="replace")
+    # Lines too long for the records are written with line terminators rather than truncated
+    newline = layout.get("newline") or "\n"
+    return (newline.join(lines) + newline).encode(layout["encoding"], errors="replace")
+
+
+class IngestionStats:
+    """
+    Tokens saved by stripping the sequence and identification areas of the programs, for the run summary.
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.source_tokens = 0
+        self.saved_tokens = 0
+
+    def record(self, source_tokens: int, saved_tokens: int):
+        self.files += 1
+        self.source_tokens += source_tokens
+        self.saved_tokens += saved_tokens
+
+    def summary(self) -> Dict[str, Any]:
+        total = self.source_tokens + self.saved_tokens
+        return {
+            "files": self.files,
+            "source_tokens": self.source_tokens,
+            "saved_tokens": self.saved_tokens,
+            "saved_ratio": self.saved_tokens / total if total else 0.0,
+        }
+
+
+# Shared stats of the workflow
+ingestion_stats = IngestionStats()
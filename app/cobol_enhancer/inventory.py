@@ -0,0 +1,161 @@
+import bisect
+import fnmatch
+import json
+import os
+import time
+import uuid
+from typing import Dict, List, Optional, Sequence
+
+from .common import INPUT_DIR, SOURCE_EXTENSIONS, SOURCE_INCLUDE_GLOBS, SOURCE_EXCLUDE_GLOBS, INVENTORY_CACHE_PATH
+
+# Minimum delay in seconds between two checks of the directories' mtimes, so that repeated lookups
+# (e.g. tab completion) don't stat the whole tree every time
+RECHECK_INTERVAL = 2.0
+
+
+class SourceInventory:
+    """
+    Index of the COBOL sources of an input tree, scanned once and kept in a sorted list of paths relative to
+    the root. The index is cached on disk and invalidated when the mtime of any directory of the tree changes
+    (a directory's mtime changes whenever an entry is added, removed or renamed in it).
+    """
+
+    def __init__(self, root: str = INPUT_DIR, extensions: Sequence[str] = SOURCE_EXTENSIONS,
+                 include: Sequence[str] = SOURCE_INCLUDE_GLOBS, exclude: Sequence[str] = SOURCE_EXCLUDE_GLOBS,
+                 cache_path: Optional[str] = INVENTORY_CACHE_PATH):
+        self.root = root
+        self.extensions = tuple(extensions)
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self.cache_path = cache_path
+        self._files: List[str] = []
+        self._dir_mtimes: Dict[str, int] = {}
+        self._checked_at = 0.0
+        self._load_cache()
+
+    def _config(self) -> Dict[str, list]:
+        return {"root": os.path.abspath(self.root), "extensions": list(self.extensions),
+                "include": self.include, "exclude": self.exclude}
+
+    def _load_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r') as file:
+                cache = json.load(file)
+        except (OSError, ValueError):
+            return
+        if cache.get("config") == self._config():
+            self._files = cache["files"]
+            self._dir_mtimes = cache["dir_mtimes"]
+
+    def _save_cache(self):
+        if not self.cache_path:
+            return
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        # Not utils.write_atomic, which depends on this module. Concurrent runs each write their own temporary file
+        tmp_path = f"{self.cache_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'w') as file:
+                json.dump({"config": self._config(), "files": self._files, "dir_mtimes": self._dir_mtimes}, file)
+            os.replace(tmp_path, self.cache_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _matches(self, relative_path: str) -> bool:
+        if not relative_path.endswith(self.extensions):
+            return False
+        if self.include and not any(fnmatch.fnmatchcase(relative_path, pattern) for pattern in self.include):
+            return False
+        return not any(fnmatch.fnmatchcase(relative_path, pattern) for pattern in self.exclude)
+
+    def _is_stale(self) -> bool:
+        if not self._dir_mtimes:
+            return True
+        for relative_dir, mtime in self._dir_mtimes.items():
+            try:
+                if os.stat(os.path.join(self.root, relative_dir)).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def scan(self):
+        """
+        Walks the tree once, recording the matching sources and the mtime of every directory.
+        """
+        files, dir_mtimes = [], {}
+        pending = [""]
+        while pending:
+            relative_dir = pending.pop()
+            directory = os.path.join(self.root, relative_dir)
+            try:
+                dir_mtimes[relative_dir] = os.stat(directory).st_mtime_ns
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                relative_path = os.path.join(relative_dir, entry.name) if relative_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(relative_path)
+                elif self._matches(relative_path):
+                    files.append(relative_path)
+
+        self._files = sorted(files)
+        self._dir_mtimes = dir_mtimes
+        self._save_cache()
+
+    def refresh(self, force: bool = False):
+        """
+        Rescans the tree if it changed since the last scan. The check itself is throttled to RECHECK_INTERVAL.
+        """
+        now = time.monotonic()
+        if not force and self._files and now - self._checked_at < RECHECK_INTERVAL:
+            return
+        self._checked_at = now
+        if force or self._is_stale():
+            self.scan()
+
+    def files(self) -> List[str]:
+        """
+        Returns the sorted paths of the sources, relative to the root.
+        """
+        self.refresh()
+        return list(self._files)
+
+    def paths(self) -> List[str]:
+        """
+        Returns the sorted paths of the sources, including the root.
+        """
+        return [os.path.join(self.root, relative_path) for relative_path in self.files()]
+
+    def __contains__(self, relative_path: str) -> bool:
+        self.refresh()
+        index = bisect.bisect_left(self._files, relative_path)
+        return index < len(self._files) and self._files[index] == relative_path
+
+    def complete(self, prefix: str) -> List[str]:
+        """
+        Returns the sources starting with the prefix, found by bisection in the sorted index.
+        """
+        self.refresh()
+        start = bisect.bisect_left(self._files, prefix)
+        end = start
+        while end < len(self._files) and self._files[end].startswith(prefix):
+            end += 1
+        return self._files[start:end]
+
+
+_inventory: Optional[SourceInventory] = None
+
+
+def get_inventory() -> SourceInventory:
+    """
+    Returns the shared inventory of the input directory, built on first use.
+    """
+    global _inventory
+    if _inventory is None:
+        _inventory = SourceInventory()
+    return _inventory
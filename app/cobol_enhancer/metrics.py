@@ -0,0 +1,227 @@
+import functools
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+from .common import GraphState, MODEL_PRICES, CACHED_INPUT_PRICE_RATIO, ROUTE_STATS_PATH
+from .utils import print_info, print_subheading, write_atomic, file_lock
+
+
+def extract_token_usage(response: LLMResult) -> Dict[str, int]:
+    """
+    Reads the token usage reported by the provider for a single LLM call, including the number of prompt
+    tokens that were served from the provider's prompt-prefix cache.
+
+    Args:
+        response (LLMResult): The result passed to the callback handlers at the end of an LLM call.
+
+    Returns:
+        dict: The prompt, completion and cached token counts (0 when the provider did not report them).
+    """
+    usage = dict((response.llm_output or {}).get("token_usage") or {})
+
+    # Some integrations only attach the usage to the generated message itself
+    if not usage:
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                metadata = getattr(message, "response_metadata", None) or {}
+                usage = dict(metadata.get("token_usage") or metadata.get("usage") or {})
+                if usage:
+                    break
+            if usage:
+                break
+
+    prompt_tokens = usage.get("prompt_tokens", usage.get("input_tokens", 0)) or 0
+    completion_tokens = usage.get("completion_tokens", usage.get("output_tokens", 0)) or 0
+
+    # OpenAI reports cache hits under prompt_tokens_details, Anthropic under cache_read_input_tokens
+    prompt_details = usage.get("prompt_tokens_details") or {}
+    cached_tokens = prompt_details.get("cached_tokens", usage.get("cache_read_input_tokens", 0)) or 0
+
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cached_tokens": cached_tokens,
+    }
+
+
+class TokenUsageTracker(BaseCallbackHandler):
+    """
+    Callback handler accumulating the token usage of every LLM call of the workflow, so that the effect of the
+    prompt-prefix caching (time-to-first-token and input cost) can be followed across files and iterations.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        usage = extract_token_usage(response)
+        self.calls += 1
+        self.prompt_tokens += usage["prompt_tokens"]
+        self.completion_tokens += usage["completion_tokens"]
+        self.cached_tokens += usage["cached_tokens"]
+
+        if usage["prompt_tokens"]:
+            print_info(f"Prompt cache: {usage['cached_tokens']}/{usage['prompt_tokens']} input tokens served "
+                       f"from cache ({self.cache_hit_ratio(usage):.0%}).")
+
+    @staticmethod
+    def cache_hit_ratio(usage: Dict[str, int]) -> float:
+        return usage["cached_tokens"] / usage["prompt_tokens"] if usage["prompt_tokens"] else 0.0
+
+    def summary(self) -> Dict[str, Any]:
+        totals = {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+        }
+        totals["cache_hit_ratio"] = self.cache_hit_ratio(totals)
+        return totals
+
+
+# Shared tracker attached to every chat model of the workflow
+usage_tracker = TokenUsageTracker()
+
+
+def estimate_cost(model_name: str, usage: Dict[str, int]) -> float:
+    """
+    Estimates the cost in USD of a call from its token usage, using the prices of MODEL_PRICES.
+    Unknown models are counted as free.
+    """
+    input_price, output_price = MODEL_PRICES.get(model_name, (0.0, 0.0))
+    uncached_tokens = usage["prompt_tokens"] - usage["cached_tokens"]
+    input_cost = (uncached_tokens + usage["cached_tokens"] * CACHED_INPUT_PRICE_RATIO) * input_price
+    return (input_cost + usage["completion_tokens"] * output_price) / 1_000_000
+
+
+class RouteStats:
+    """
+    Per-route statistics (latency, cost and acceptance rate) used to tune the model routing table.
+    The statistics are accumulated across runs in ROUTE_STATS_PATH, read on first use. Saving adds the counts
+    recorded since the last save to the file as it is then, under a lock, so that concurrent processes don't
+    overwrite each other's statistics.
+    """
+
+    def __init__(self, path: str = ROUTE_STATS_PATH):
+        self.path = path
+        self._routes: Optional[Dict[str, Dict[str, float]]] = None
+        # Counts recorded by this process since the last save
+        self._pending: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def _read(self) -> Dict[str, Dict[str, float]]:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    @property
+    def routes(self) -> Dict[str, Dict[str, float]]:
+        if self._routes is None:
+            self._routes = self._read()
+        return self._routes
+
+    @staticmethod
+    def _route(routes: Dict[str, Dict[str, float]], route_key: str) -> Dict[str, float]:
+        return routes.setdefault(route_key, {
+            "calls": 0, "latency": 0.0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0,
+            "accepted": 0, "rejected": 0,
+        })
+
+    def _add(self, route_key: str, counts: Dict[str, float]):
+        with self._lock:
+            for routes in (self.routes, self._pending):
+                route = self._route(routes, route_key)
+                for name, value in counts.items():
+                    route[name] += value
+
+    def record_call(self, route_key: str, latency: float, usage: Dict[str, int], cost: float):
+        self._add(route_key, {"calls": 1, "latency": latency, "prompt_tokens": usage["prompt_tokens"],
+                              "completion_tokens": usage["completion_tokens"], "cost": cost})
+
+    def record_outcome(self, route_key: str, accepted: bool):
+        self._add(route_key, {"accepted" if accepted else "rejected": 1})
+
+    def save(self):
+        with self._lock:
+            if not self._pending:
+                return
+            with file_lock(f"{self.path}.lock"):
+                routes = self._read()
+                for route_key, counts in self._pending.items():
+                    route = self._route(routes, route_key)
+                    for name, value in counts.items():
+                        route[name] += value
+                write_atomic(self.path, json.dumps(routes, indent=2, sort_keys=True))
+            self._routes = routes
+            self._pending = {}
+
+    def print_summary(self):
+        print_subheading("Model routes (calls, mean latency, cost, acceptance rate):")
+        for route_key, route in sorted(self.routes.items()):
+            mean_latency = route["latency"] / route["calls"] if route["calls"] else 0.0
+            outcomes = route["accepted"] + route["rejected"]
+            acceptance = f"{route['accepted'] / outcomes:.0%}" if outcomes else "n/a"
+            print_info(f"{route_key}: {route['calls']} calls, {mean_latency:.1f}s, ${route['cost']:.4f}, "
+                       f"accepted {acceptance}")
+
+
+class RouteTracker(BaseCallbackHandler):
+    """
+    Callback handler attached to the model of a single route, recording the latency and cost of its calls.
+    """
+
+    def __init__(self, route_key: str, model_name: str, stats: RouteStats):
+        self.route_key = route_key
+        self.model_name = model_name
+        self.stats = stats
+        self._started: Dict[UUID, float] = {}
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: Any, *, run_id: UUID, **kwargs: Any):
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: Any, *, run_id: UUID, **kwargs: Any):
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        latency = time.perf_counter() - self._started.pop(run_id, time.perf_counter())
+        usage = extract_token_usage(response)
+        self.stats.record_call(self.route_key, latency, usage, estimate_cost(self.model_name, usage))
+
+
+# Shared statistics of all the model routes of the workflow
+route_stats = RouteStats()
+
+
+def timed_node(name: str, node: Callable[[GraphState], GraphState]) -> Callable[[GraphState], GraphState]:
+    """
+    Wraps a workflow node so that each of its executions is recorded in the node_timings of the state.
+    """
+
+    @functools.wraps(node)
+    def wrapper(state: GraphState) -> GraphState:
+        started_at = time.time()
+        start = time.perf_counter()
+        state = node(state)
+        state["node_timings"] = (state.get("node_timings") or []) + [{
+            "node": name,
+            "started_at": started_at,
+            "duration": time.perf_counter() - start,
+        }]
+        return state
+
+    return wrapper
@@ -0,0 +1,243 @@
+import os
+import sys
+from typing import Any, Dict, List, Optional
+
+from langchain_core.prompts import ChatPromptTemplate
+
+from .analysis import use_map_reduce, split_program, chunk_inputs
+from .common import GraphState, PLAN_ORDER_POLICY, EXPECTED_ITERATIONS, CRITIC_MODE, ANALYSIS_CONCURRENCY, \
+    CLUSTER_RELATED_FILES, RESULTS_DB_PATH
+from .dependencies import get_dependency_graph
+from .ingestion import read_source
+from .metrics import estimate_cost
+from .prompts import analyze_file_prompt, analyze_section_prompt, analyze_reduce_prompt, critic_generation_prompt, \
+    critic_diff_prompt
+from .results_store import ResultsStore
+from .routing import select_route
+from .structure import summarize_structure
+from .utils import print_heading, print_info, print_subheading, extract_copybooks, format_copybooks_for_display
+
+# Expected length of a critique, and of the findings on a part of a program in the map-reduce analysis, in tokens
+CRITIC_OUTPUT_TOKENS = 600
+SECTION_OUTPUT_TOKENS = 300
+# Expected size of a generated program compared to the original one
+GENERATION_OUTPUT_RATIO = 1.1
+# Expected size of the diffs given to the critic in diff mode compared to the program
+CRITIC_DIFF_RATIO = 0.15
+# Generation speed of each model, in output tokens per second, and time to first token in seconds
+MODEL_SPEEDS = {
+    "gpt-4-turbo-preview": (30.0, 1.5),
+    "gpt-4-turbo": (30.0, 1.5),
+    "gpt-4o": (60.0, 0.8),
+    "gpt-3.5-turbo": (80.0, 0.5),
+}
+DEFAULT_MODEL_SPEED = (30.0, 1.5)
+
+_encodings = {}
+
+
+def count_tokens(text: str, model_name: str = "gpt-4") -> int:
+    """
+    Counts the tokens of a text with the tokenizer of the model, or approximates it (4 characters per token)
+    when tiktoken or the model's encoding is not available.
+    """
+    if model_name not in _encodings:
+        try:
+            import tiktoken
+            try:
+                _encodings[model_name] = tiktoken.encoding_for_model(model_name)
+            except KeyError:
+                _encodings[model_name] = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            # tiktoken is missing or can't download the encoding (offline)
+            _encodings[model_name] = None
+    if _encodings[model_name] is None:
+        return len(text) // 4
+    return len(_encodings[model_name].encode(text, disallowed_special=()))
+
+
+def estimate_call(model_name: str, prompt_tokens: int, completion_tokens: int) -> Dict[str, float]:
+    tokens_per_second, time_to_first_token = MODEL_SPEEDS.get(model_name, DEFAULT_MODEL_SPEED)
+    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "cached_tokens": 0}
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "time": time_to_first_token + completion_tokens / tokens_per_second,
+        "cost": estimate_cost(model_name, usage),
+    }
+
+
+def expected_iterations(program: str, store: Optional[ResultsStore]) -> float:
+    """
+    Returns the mean number of generations the program needed in the previous runs, or EXPECTED_ITERATIONS.
+    """
+    if store is not None:
+        history = store.query(program=program)
+        if history:
+            return sum(output["iterations"] for output in history) / len(history)
+    return EXPECTED_ITERATIONS
+
+
+def plan_map_reduce_analysis(state: GraphState, old_code: str) -> List[Dict[str, float]]:
+    """
+    Estimates the calls of the map-reduce analysis: one per part of the program, run ANALYSIS_CONCURRENCY at a
+    time (their time is spread accordingly), then the merge of their findings.
+    """
+    lines = old_code.split("\n")
+    chunks = split_program(lines)
+    route = select_route("analyze_next_file", dict(state, program_lines=max(c.end - c.start for c in chunks)))
+    template = ChatPromptTemplate.from_template(analyze_section_prompt())
+    parallelism = min(ANALYSIS_CONCURRENCY, len(chunks))
+    calls = []
+    for chunk in chunks:
+        prompt = template.format(**chunk_inputs(state["filename"], lines, chunk, state["copybooks"]))
+        call = estimate_call(route.model_name, count_tokens(prompt, route.model_name), SECTION_OUTPUT_TOKENS)
+        call["time"] /= parallelism
+        calls.append(call)
+
+    route = select_route("analyze_next_file", state)
+    reduce_prompt = ChatPromptTemplate.from_template(analyze_reduce_prompt()).format(
+        filename=state["filename"], structure=summarize_structure(old_code), findings="")
+    # Plus the findings of the parts
+    calls.append(estimate_call(route.model_name,
+                               count_tokens(reduce_prompt, route.model_name) + SECTION_OUTPUT_TOKENS * len(chunks),
+                               CRITIC_OUTPUT_TOKENS))
+    return calls
+
+
+def plan_file(file_path: str, store: Optional[ResultsStore] = None) -> Dict[str, Any]:
+    """
+    Estimates the tokens, time and cost of processing a file, by building the prompts that will actually be
+    sent (same copybook resolution and prompt templates as the workflow) and routing them like the workflow.
+    """
+    # Read like the workflow reads it, without the sequence areas
+    old_code = read_source(file_path).text
+
+    state: GraphState = {
+        "filename": os.path.basename(file_path),
+        "old_code": old_code,
+        "copybooks": extract_copybooks(old_code),
+        "original_critic": {},
+        "critic": {},
+        "specific_demands": "",
+        "atlas_answer": "",
+        "atlas_message_type": "",
+        "new_code": "",
+        "previous_last_gen_code": "",
+    }
+    copybooks = format_copybooks_for_display(state["copybooks"])
+    source_tokens = count_tokens(old_code)
+    generated_tokens = int(source_tokens * GENERATION_OUTPUT_RATIO)
+    iterations = expected_iterations(state["filename"], store)
+
+    # Analysis of the original code
+    if use_map_reduce(len(old_code.splitlines())):
+        calls = plan_map_reduce_analysis(state, old_code)
+    else:
+        route = select_route("analyze_next_file", state)
+        analysis_prompt = ChatPromptTemplate.from_template(analyze_file_prompt()).format(
+            filename=state["filename"], old_code=old_code, copybooks=copybooks)
+        calls = [estimate_call(route.model_name, count_tokens(analysis_prompt, route.model_name),
+                               CRITIC_OUTPUT_TOKENS)]
+
+    # Generations and their critiques, escalating like the workflow after each rejection
+    from .generation import prepare_generation  # Not at the top, the generation module uses the planner
+    previous_code = ""
+    for iteration in range(max(1, round(iterations))):
+        generation_state = dict(state, original_critic={"description": "x"} if iteration == 0 else {},
+                                new_code=previous_code, critic={"description": ""}, iteration_history=[])
+        template, variables = prepare_generation(generation_state)
+        # Plus the critique the generation is based on (the original one, then the previous critic round)
+        generation_prompt_tokens = count_tokens(ChatPromptTemplate.from_template(template).format(**variables))
+        generation_prompt_tokens += CRITIC_OUTPUT_TOKENS
+        route = select_route("generate", state, escalation_level=iteration)
+        calls.append(estimate_call(route.model_name, generation_prompt_tokens, generated_tokens))
+
+        critic_state = dict(generation_state, new_code=old_code, previous_last_gen_code=previous_code)
+        if CRITIC_MODE == "diff":
+            # Stand-in for the diffs, of their expected size
+            code_diff = old_code[:int(len(old_code) * CRITIC_DIFF_RATIO)]
+            critic_prompt = ChatPromptTemplate.from_template(critic_diff_prompt(critic_state)).format(
+                structure=summarize_structure(old_code), changed_paragraphs="", code_diff=code_diff,
+                iteration_diff=code_diff, previous_critic_description="", specific_demands="", atlas_answer="")
+        else:
+            critic_prompt = ChatPromptTemplate.from_template(critic_generation_prompt(critic_state)).format(
+                old_code=old_code, previous_iteration_code=previous_code, new_code=old_code,
+                previous_critic_description="", specific_demands="", atlas_answer="", atlas_message_type="")
+        route = select_route("critic_generation", state, escalation_level=iteration)
+        calls.append(estimate_call(route.model_name, count_tokens(critic_prompt, route.model_name),
+                                   CRITIC_OUTPUT_TOKENS))
+        # The generated code is about the size of the original one
+        previous_code = old_code
+
+    return {
+        "file_path": file_path,
+        "source_tokens": source_tokens,
+        "copybook_tokens": count_tokens(copybooks),
+        "iterations": iterations,
+        "calls": len(calls),
+        "prompt_tokens": sum(call["prompt_tokens"] for call in calls),
+        "completion_tokens": sum(call["completion_tokens"] for call in calls),
+        "time": sum(call["time"] for call in calls),
+        "cost": sum(call["cost"] for call in calls),
+    }
+
+
+def order_files(files: List[str], policy: str = PLAN_ORDER_POLICY,
+                plans: Optional[Dict[str, Dict[str, Any]]] = None) -> List[str]:
+    """
+    Orders the files to process according to the policy: "largest_first" (default, so that long programs don't
+    end up stretching the end of the run), "smallest_first" or "input" (unchanged). The estimated time of the
+    plans is used when given, the file size otherwise.
+    """
+    if policy == "input":
+        return list(files)
+    if policy not in ("largest_first", "smallest_first"):
+        raise ValueError(f"Unknown ordering policy: {policy}")
+
+    def weight(file_path: str) -> float:
+        if plans and file_path in plans:
+            return plans[file_path]["time"]
+        return os.path.getsize(file_path)
+
+    return sorted(files, key=weight, reverse=policy == "largest_first")
+
+
+def plan(files: List[str], policy: str = PLAN_ORDER_POLICY) -> List[Dict[str, Any]]:
+    """
+    Plans the processing of the files and returns the per-file estimates in processing order (with the related
+    programs together, like the workflow).
+    """
+    # A dry run must not create the results database, so the history is only read when there is one
+    store = ResultsStore() if os.path.exists(RESULTS_DB_PATH) else None
+    try:
+        plans = {file_path: plan_file(file_path, store) for file_path in files}
+    finally:
+        if store is not None:
+            store.close()
+    ordered = order_files(files, policy, plans)
+    if CLUSTER_RELATED_FILES:
+        ordered = [file_path for cluster in get_dependency_graph().clusters(ordered) for file_path in cluster]
+    return [plans[file_path] for file_path in ordered]
+
+
+def print_plan(plans: List[Dict[str, Any]]):
+    print_heading("DRY-RUN PLAN")
+    print_subheading(f"{'File':<40} {'Source':>8} {'Copybooks':>9} {'Iter.':>5} {'Input':>9} {'Output':>8} "
+                     f"{'Time':>8} {'Cost':>8}")
+    for file_plan in plans:
+        print_info(f"{file_plan['file_path']:<40} {file_plan['source_tokens']:>8} {file_plan['copybook_tokens']:>9} "
+                   f"{file_plan['iterations']:>5.1f} {file_plan['prompt_tokens']:>9} "
+                   f"{file_plan['completion_tokens']:>8} {file_plan['time']:>7.0f}s ${file_plan['cost']:>7.2f}")
+
+    print_subheading(f"Total for {len(plans)} file(s): "
+                     f"{sum(p['prompt_tokens'] for p in plans)} input tokens, "
+                     f"{sum(p['completion_tokens'] for p in plans)} output tokens, "
+                     f"{sum(p['time'] for p in plans) / 60:.1f} min of model time, "
+                     f"${sum(p['cost'] for p in plans):.2f}.")
+
+
+if __name__ == "__main__":
+    from .inventory import get_inventory
+
+    print_plan(plan(sys.argv[1:] or get_inventory().paths()))
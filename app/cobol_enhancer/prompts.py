@@ -1,32 +1,128 @@
 from typing import Dict, Any
 
+from app.cobol_enhancer.blob_store import get_text
+from app.cobol_enhancer.common import STRIP_SEQUENCE_AREAS
 from app.cobol_enhancer.utils import get_previous_critic_description
 
 
+# Every template below is laid out so that providers with prompt-prefix caching can reuse as much of it as
+# possible: the static instructions come first, then the per-file context that stays stable across all
+# iterations on the same program (copybooks, filename, original code), and only at the very end the content
+# that changes from one iteration to the next (critics, demands, Atlas answers, last generated code). The
+# copybooks come before the filename, most shared first (see dependencies.order_copybooks), so that related
+# programs processed one after the other also share the start of their prompts.
+def sequence_area_instructions() -> str:
+    if STRIP_SEQUENCE_AREAS:
+        return """
+            Columns 1 to 6 (the sequence area) of every line are blank on purpose: the line numbers and signatures
+            developers keep there are removed before this prompt and put back by the tool afterwards. Keep these
+            columns blank on every line, including the lines you add, and never write line numbers in them.
+            """
+    return """
+            It's crucial to preserve the original line numbers on the left side of each line of code. Some developers do sign
+            here by replacing the 6 digit number.
+            These line numbers are essential for tracking and documentation purposes. Please make sure that any 
+            modifications you suggest do not remove or alter these line numbers.
+            """
+
+
+def generation_rules() -> str:
+    # Shared by the generation and its continuations, so that a continued program follows the same rules
+    return """
+            It's crucial that you don't remove existing comments. Even more important, it is crucial that you add more 
+            comments for a better understanding, not too much tho, just the right amount.
+
+            It's crucial to NOT change the termination method of the program. For example, don't introduce a new termination
+            method like "STOP RUN" if it was not there before.
+            """ + sequence_area_instructions()
+
+
+def program_context_section() -> str:
+    return """
+        ===========================================
+        Copybooks:
+        {copybooks}
+
+        Program: {filename}
+
+        Original COBOL Code:
+        {old_code}
+        ===========================================
+    """
+
+
 def analyze_file_prompt() -> str:
-    prompt = """
-        You are an expert in code analysis with a focus on COBOL. Examine the original provided code: {filename}. 
+    return """
+        You are an expert in code analysis with a focus on COBOL. Examine the original provided code given below. 
         Identify any errors, discrepancies or possible enhancement with good usages. Provide a detailed critique, 
         highlighting each issue with a thorough explanation and recommended solutions. Your review will guide 
         developers in refining the code. This version is under scrutiny for accuracy and adherence to best 
         practices.
+""" + analysis_criteria() + program_context_section()
 
-        Among all of your critics, it's crucial to focus on the following aspects:
-        - Check for more comments for a better understanding, not too much tho, just the right amount.
-        - Argue about the termination method. The termination method must not be changed.
+
+def analysis_criteria() -> str:
+    if STRIP_SEQUENCE_AREAS:
+        sequence_area = """
+        - Columns 1 to 6 (the sequence area) are blank on purpose: the line numbers and signatures of the developers
+        are removed from them before the review and put back by the tool afterwards. Don't ask for them, and argue
+        against any change that writes into these columns, they must stay blank."""
+    else:
+        sequence_area = """
         - Argue that the original line numbers on the left side of each line of code must be preserved. In fact some
         developers do sign here by replacing the 6 digit number, these line numbers are essential for
-        tracking who wrote the lines purposes. So don't remove or alter these line numbers or pseudos if they are there.
+        tracking who wrote the lines purposes. So don't remove or alter these line numbers or pseudos if they are there."""
+    return """
+        Among all of your critics, it's crucial to focus on the following aspects:
+        - Check for more comments for a better understanding, not too much tho, just the right amount.
+        - Argue about the termination method. The termination method must not be changed.""" + sequence_area + """
         
         It's crucial that overall you don't try to announce changes everywhere, just subtle but meaningful changes.
-        
+    """
+
+
+def analyze_section_prompt() -> str:
+    return """
+        You are an expert in code analysis with a focus on COBOL. Examine the part of a program given below,
+        together with the data definitions and copybooks it uses. Identify any errors, discrepancies or possible
+        enhancement with good usages in this part only. For each issue, give the paragraph it is in, its severity
+        (high, medium or low), a thorough explanation and the recommended solution. Report no issue rather than
+        inventing one.
+""" + analysis_criteria() + """
+        ===========================================
+        Program: {filename}
+        Part: {location}
+
+        Data definitions used by this part:
+        {definitions}
+
+        Copybooks used by this part:
+        {copybooks}
+
+        Code:
+        {code}
         ===========================================
-        Original COBOL Code:
-        
-        {old_code}
     """
 
-    return prompt
+
+def analyze_reduce_prompt() -> str:
+    return """
+        You are an expert in code analysis with a focus on COBOL. The parts of a program have been reviewed
+        separately, their findings are listed below with their locations. Merge them into a single critique of the
+        program: drop the duplicates and the findings that don't hold given the structure of the whole program,
+        rank the remaining ones from the most to the least important, keep their locations, and summarize the
+        overall state of the program. Grade the program 'good' if it needs no change, 'bad' otherwise.
+""" + analysis_criteria() + """
+        ===========================================
+        Program: {filename}
+
+        Structure:
+        {structure}
+
+        Findings of the parts:
+        {findings}
+        ===========================================
+    """
 
 
 def critic_generation_prompt(state: Dict[str, Any]) -> str:
@@ -41,12 +137,15 @@ def critic_generation_prompt(state: Dict[str, Any]) -> str:
         "developers in refining the code.\n\n"
     )
 
+    # Stable across every critic round of the same file
     prompt_sections = [
         "===========================================\n",
-        f"Original COBOL Code:\n{state.get('old_code', '')}\n\n",
+        "Original COBOL Code:\n{old_code}\n\n",
+        "===========================================\n",
     ]
 
-    if "previous_iteration_code" in state and state["previous_last_gen_code"]:
+    # Everything below changes from one iteration to the next
+    if state.get("previous_last_gen_code"):
         prompt_sections.append(
             "Previously Iterated COBOL Code (T-1 Version):\nThis code reflects the state prior to the most "
             "recent changes and serves as a benchmark against the new version.\n"
@@ -84,105 +183,172 @@ def critic_generation_prompt(state: Dict[str, Any]) -> str:
     return base_prompt + "".join(prompt_sections)
 
 
-def generation_prompt(state: Dict[str, Any]) -> str:
-    if "original_critic" in state and state["original_critic"]:
-        prompt_template = """
-            You are an AI with expertise in COBOL, tasked with refining a piece of code. 
-            Your objective is to correct these mistakes, ensuring the updated code remains 
-            true to its original functionality and improves upon it where possible.
+def critic_diff_prompt(state: Dict[str, Any]) -> str:
+    """
+    Builds the critic prompt of the diff mode: the changes made to the program instead of its full versions, so
+    that the size of the prompt follows the size of the changes.
+    """
+    base_prompt = (
+        "You are an expert in code analysis with a focus on COBOL. Examine the changes made to the original code "
+        "in its new version. Identify any errors or discrepancies introduced by these changes. Provide a detailed "
+        "critique, highlighting each issue with a thorough explanation and recommended solutions. Your review will "
+        "guide developers in refining the code.\n\n"
+        "The changes are given as hunks: each one is headed by its line ranges in the original and new versions "
+        "and the paragraphs it changes, lines starting with '-' are removed, lines starting with '+' are added and "
+        "lines starting with a space are unchanged context. Everything outside the hunks is unchanged.\n\n"
+    )
 
-            Based on the critics, refine the code to solve the identified issues. 
-            Ensure the final version is optimized, error-free, and faithful to the original's functionality. 
-            Your output should be the corrected code only.
+    # Stable across every critic round of the same file: the structure of the original code only, the paragraphs
+    # changed by the candidate are listed with the changes
+    prompt_sections = [
+        "===========================================\n",
+        "Structure of the Original COBOL Code:\n{structure}\n\n",
+        "===========================================\n",
+    ]
 
-            It's crucial that you don't remove existing comments. Even more important, it is crucial that you add more 
-            comments for a better understanding, not too much tho, just the right amount.
+    # Everything below changes from one iteration to the next
+    if state.get("previous_last_gen_code"):
+        prompt_sections.append(
+            "Changes Since the Previous Iteration (T-1 Version):\nWhat the latest round changed, to check "
+            "against the previous critique.\n"
+            "{iteration_diff}\n\n"
+        )
 
-            It's crucial to NOT change the termination method of the program. For example, don't introduce a new termination
-            method like "STOP RUN" if it was not there before.
+    if "specific_demands" in state and state["specific_demands"]:
+        prompt_sections.append(
+            "Developer's Specific Critique:\nFeedback provided by the developer to address certain "
+            "areas in the code that require special attention.\n"
+            "{specific_demands}\n\n"
+        )
 
-            It's crucial to preserve the original line numbers on the left side of each line of code. Some developers do sign
-            here by replacing the 6 digit number.
-            These line numbers are essential for tracking and documentation purposes. Please make sure that any 
-            modifications you suggest do not remove or alter these line numbers.
-            """
+    previous_critic_description = get_previous_critic_description(state)
+    if previous_critic_description:
+        prompt_sections.append(
+            "Previous Critique Round:\nA look back at the last set of comments and whether the subsequent "
+            "code adjustments have appropriately addressed those concerns.\n"
+            "{previous_critic_description}\n\n"
+        )
 
-        template_extension = """
-        Enhance the following COBOL code by refining and optimizing it while maintaining 
-        the original functionality. Ensure the final version is error-free:
+    if "atlas_answer" in state and state["atlas_answer"]:
+        prompt_sections.append(
+            "Atlas Error Trace:\nThe following errors were encountered during execution, which the new "
+            "version of the code aims to resolve.\n"
+            "{atlas_answer}\n\n"
+        )
 
-        Original Code:
-        {old_code}
-        
-        The critics:
-        {original_critic}
-        """
-    else:
-        prompt_template = """
+    prompt_sections.append(
+        "Changes of the Newly Generated COBOL Code for Review:\nAll the differences between the original code and "
+        "its latest version. This version is under scrutiny for accuracy and adherence to best practices.\n"
+        "Changed paragraphs: {changed_paragraphs}\n"
+        "{code_diff}\n"
+    )
+
+    return base_prompt + "".join(prompt_sections)
+
+
+def generation_prompt(state: Dict[str, Any]) -> str:
+    # The instructions are identical for the first generation and every regeneration so that they,
+    # together with the program context, form a prefix shared by all iterations on the same file.
+    prompt_template = """
             You are an AI with expertise in COBOL, tasked with refining a piece of code. 
-            A new version of {filename} has been generated to improve upon the old code. 
-            Your objective is to correct these mistakes, ensuring the updated code remains 
+            Your objective is to correct the mistakes identified below, ensuring the updated code remains 
             true to its original functionality and improves upon it where possible.
 
-            Based on the critics, refine the generated code to solve the identified issues. 
+            Based on the critics, demands or errors given at the end, refine the code to solve the identified issues. 
             Ensure the final version is optimized, error-free, and faithful to the original's functionality. 
             Your output should be the corrected code only.
+""" + generation_rules()
 
-            It's crucial that you don't remove existing comments. Even more important, it is crucial that you add more 
-            comments for a better understanding, not too much tho, just the right amount.
-
-            It's crucial to NOT change the termination method of the program. For example, don't introduce a new termination
-            method like "STOP RUN" if it was not there before.
-
-            It's crucial to preserve the original line numbers on the left side of each line of code. Some developers do sign
-            here by replacing the 6 digit number.
-            These line numbers are essential for tracking and documentation purposes. Please make sure that any 
-            modifications you suggest do not remove or alter these line numbers.
-            """
-
-        if "atlas_message_type" in state and state["atlas_message_type"]:
-            template_extension = """
+    if "original_critic" in state and state["original_critic"]:
+        template_extension = """
+        Enhance the original code above by refining and optimizing it while maintaining 
+        the original functionality. Ensure the final version is error-free.
+        
+        The critics:
+        {original_critic}
+        """
+        # Located findings of the map-reduce analysis (see analysis.flagged_sections)
+        if state.get("analysis_findings"):
+            template_extension += """
+        The issues are located in the following parts of the program, from the most important. Focus the changes
+        on these parts and leave the other ones as they are:
+        {flagged_sections}
+        """
+    elif "atlas_message_type" in state and state["atlas_message_type"]:
+        template_extension = """
+            A new version of the program has been generated to improve upon the original code above.
             The COBOL code has encountered a {atlas_message_type}. Correct the code 
             to address the following issue and ensure it is optimized and error-free:
         
             {atlas_answer}
         
-            Original Code:
-            {old_code}
-        
             Generated Code with errors:
             {new_code}
             """
-        elif "specific_demands" in state and state["specific_demands"]:
-            template_extension = """
+    elif "specific_demands" in state and state["specific_demands"]:
+        template_extension = """
+            A new version of the program has been generated to improve upon the original code above.
             Refine the COBOL code according to the specific demands of the developer 
             and ensure that all improvements are faithful to the original functionality:
             
             Specific demands:
             {specific_demands}
         
-            Original Code:
-            {old_code}
-        
             Generated Code with errors:
             {new_code}
             """
-        else:
-            template_extension = """
-            Enhance the following COBOL code by refining and optimizing it while maintaining 
+    else:
+        template_extension = """
+            A new version of the program has been generated to improve upon the original code above.
+            Enhance it by refining and optimizing it while maintaining 
             the original functionality. Ensure the final version is error-free:
         
             The critics:
             {critic}
         
-            Original Code:
-            {old_code}
-        
             Generated Code:
             {new_code}
             """
 
-    return prompt_template + template_extension
+    # Retrieved once per file, so the examples stay in the prefix shared by the iterations
+    examples_section = ""
+    if get_text(state.get("examples", "")):
+        examples_section = """
+            Accepted enhancements of similar paragraphs from past runs, showing the kind of changes our
+            reviewers accept. Use them as guidance for the style, not as code to copy:
+            {examples}
+            """
+
+    return prompt_template + program_context_section() + examples_section + template_extension
+
+
+def continuation_prompt() -> str:
+    # Only the end of the output and what is left of the original code, not the whole generation context, but with
+    # the same (short, static) rules as the generation and the names of the copybook fields
+    template = """
+    You are an AI with expertise in COBOL, refining a piece of code. Your previous output was cut off because of
+    its length and has to be continued. Follow the same rules as for the start of the output:
+    """ + generation_rules() + """
+    Keep the layout of the code: division, section and paragraph headers in area A (from column 8), statements in
+    area B (from column 12), and nothing beyond column 72.
+
+    Use only the data items defined in the program or in its copybooks. The fields of the copybooks:
+    {copybook_fields}
+
+    The changes requested for the code:
+    {changes}
+
+    The part of the original COBOL code that remains to be rewritten (from about where the output was cut off):
+    {remaining_code}
+
+    The last lines of your output so far:
+    {tail}
+
+    Continue the output exactly after its last line above. Don't repeat the lines already written and don't add
+    any explanation. Close the code block with ``` once the code is complete.
+    """
+
+    return template
 
 
 def message_type_decider_prompt() -> str:
@@ -1,24 +1,62 @@
 import os
 
-from langchain import hub
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
 from pydantic import BaseModel, Field
 
-from .common import GraphState, MODEL_NAME
+from .blob_store import get_text, collect_state
+from .common import GraphState, TRANSFER_MEMBER_NAMES, RECEIVER_MODE, SPOOL_TIMEOUT
+from .examples import record_accepted
+from .ingestion import restore_sequence_areas, encode_source
+from .metrics import route_stats
 from .prompts import message_type_decider_prompt
-from .utils import print_heading, print_info, print_error
+from .routing import select_route, get_chat_model
+from .results_store import ResultsStore
+from .spool import SpoolCollector
+from .transfer import get_transfer_manager, wait_for_transfer, settle_transfers
+from .utils import print_heading, print_info, print_error, write_atomic
+from .verification import clear_original_results
+
+
+def render_output(state: GraphState) -> bytes:
+    """
+    Returns the new code as it is written out: with the sequence areas, encoding and record format of the source.
+    """
+    new_code = restore_sequence_areas(get_text(state["old_code"]), get_text(state.get("sequence_areas", "")),
+                                      get_text(state["new_code"]))
+    layout = state.get("source_layout") or {"encoding": "utf-8", "newline": "\n", "record_length": None}
+    return encode_source(new_code, layout)
 
 
 def sender(state: GraphState) -> GraphState:
     print_heading("SENDER")
-    # Simulate sending the file to FTP (in real use, replace this with actual FTP send logic)
-    print_info(f"File {state['filename']} sent to FTP.")
+    remote_name = state["filename"]
+    if TRANSFER_MEMBER_NAMES:
+        remote_name = os.path.splitext(remote_name)[0].upper()[:8]
+    # Sources read as UTF-8 or Latin-1 are sent as text, the EBCDIC ones as they are
+    text = (state.get("source_layout") or {}).get("encoding", "utf-8") in ("utf-8", "latin-1")
+
+    # The upload runs in the background: only the spool receiver waits for it, otherwise it is reported once over
+    transfer_id = get_transfer_manager().submit(remote_name, render_output(state), text)
+    state["pending_transfers"] = state.get("pending_transfers", []) + [transfer_id]
+    print_info(f"Uploading {state['filename']} as {remote_name} (transfer {transfer_id}).")
     return state
 
 
 def receiver(state: GraphState) -> GraphState:
     print_heading("RECEIVER")
+    pending_transfers = list(state.get("pending_transfers", []))
+    if RECEIVER_MODE == "spool" and pending_transfers:
+        # The output of the job is looked for once its upload is over. A failed upload leaves the results to be
+        # given by hand, like a job without output
+        transfer = wait_for_transfer(pending_transfers.pop())
+        state["pending_transfers"] = settle_transfers(pending_transfers)
+        if transfer is not None:
+            atlas_answer = SpoolCollector().collect(transfer.remote_name, transfer.job_id, transfer.submitted_at)
+            if atlas_answer is not None:
+                state["atlas_answer"] = atlas_answer
+                return state
+            print_error(f"No output for {transfer.remote_name} in the spool after {SPOOL_TIMEOUT:.0f}s.")
+
     print("Enter the multi-line message from Atlas (compilation error, execution error, or logs).")
     print("Enter 'END' on a new line when you are done.")
 
@@ -31,6 +69,8 @@ def receiver(state: GraphState) -> GraphState:
 
     # Join all lines into a single string, separated by newline characters
     state["atlas_answer"] = '\n'.join(lines)
+    # The uploads went on while the results were entered, the ones still running are reported later
+    state["pending_transfers"] = settle_transfers(state.get("pending_transfers", []))
     return state
 
 
@@ -41,36 +81,52 @@ def message_type_decider(state: GraphState) -> str:
     # prompt = "Analyze the following message and determine if
     # it's a compilation error, execution error, or logs:\n\n" + state["atlas_answer"]
     template = message_type_decider_prompt()
-    model = ChatOpenAI(temperature=0, model=MODEL_NAME, streaming=True)
 
     # Define the Pydantic model for the message type result
     class MessageTypeResult(BaseModel):
         message_type: str = Field(
             description="The type of the message: 'compilation_error', 'execution_error', or 'logs'.")
 
-    chain = ChatPromptTemplate.from_template(template) | model.with_structured_output(MessageTypeResult)
+    message_types = ["compilation_error", "execution_error", "logs"]
+    escalation_level = 0
+    while True:
+        # Start with the cheap model and escalate when it fails to give a valid classification
+        route = select_route("message_type_decider", state, escalation_level)
+        model = get_chat_model(route)
+        chain = ChatPromptTemplate.from_template(template) | model.with_structured_output(MessageTypeResult)
+
+        try:
+            message_pydantic = chain.invoke({"atlas_answer": state["atlas_answer"]})
+            message = message_pydantic.dict()["message_type"]
+        except Exception as e:
+            print_error(f"Error determining message type with {route.model_name}: {e}")
+            message = None
+
+        route_stats.record_outcome(route.key, message in message_types)
+        route_stats.save()
+        if message in message_types:
+            break
 
-    try:
-        message_pydantic = chain.invoke({"atlas_answer": state["atlas_answer"]})
-        message = message_pydantic.dict()["message_type"]
+        next_route = select_route("message_type_decider", state, escalation_level + 1)
+        if next_route.tier == route.tier:
+            return "error"  # Fallback in case of failure
+        print_error(f"Invalid message type from {route.model_name}, escalating to {next_route.model_name}.")
+        escalation_level += 1
 
-        print_info(f"Determined message type: {message}")
+    print_info(f"Determined message type: {message}")
 
-        state["atlas_message_type"] = message
+    state["atlas_message_type"] = message
 
-        # Corrected comparisons to check the value of message_type
-        if message == "compilation_error":
-            print_info("The message indicates a compilation error.")
-            return "compilation_error"
-        elif message == "execution_error":
-            print_info("The message indicates an execution error.")
-            return "execution_error"
-        else:  # "logs"
-            print_info("The message is part of the logs.")
-            return "logs"
-    except Exception as e:
-        print_error(f"Error determining message type: {e}")
-        return "error"  # Fallback in case of failure
+    # Corrected comparisons to check the value of message_type
+    if message == "compilation_error":
+        print_info("The message indicates a compilation error.")
+        return "compilation_error"
+    elif message == "execution_error":
+        print_info("The message indicates an execution error.")
+        return "execution_error"
+    else:  # "logs"
+        print_info("The message is part of the logs.")
+        return "logs"
 
 
 def handle_logs(state: GraphState) -> GraphState:
@@ -79,23 +135,32 @@ def handle_logs(state: GraphState) -> GraphState:
 
     current_file = state["files_to_process"].pop(0)
     output_file_path = current_file.replace("data/input/", "data/output/")
-    justification_file_path = output_file_path.replace('.cob', '_justification.md')
-    log_file_path = output_file_path.replace('.cob', '_logs.txt')
-
-    os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+    output_stem = os.path.splitext(output_file_path)[0]
+    justification_file_path = output_stem + '_justification.md'
+    log_file_path = output_stem + '_logs.txt'
 
-    with open(output_file_path, 'w') as file:
-        file.write(state["new_code"])
+    # The output gets the sequence areas, encoding and record format of the source back. Each file is written
+    # atomically, so an interrupted run never leaves a truncated output behind
+    write_atomic(output_file_path, render_output(state))
     print_info(f"Saved improved code to: {output_file_path}")
 
-    with open(justification_file_path, 'w') as jfile:
-        jfile.write(state["critic"]["description"])
+    write_atomic(justification_file_path, state["critic"]["description"])
     print_info(f"Saved justification to: {justification_file_path}")
 
-    with open(log_file_path, 'w') as log_file:
-        log_file.write(state["atlas_answer"])
+    write_atomic(log_file_path, state["atlas_answer"])
     print_info(f"Saved logs to: {log_file_path}")
 
+    store = ResultsStore()
+    output_id = store.record_output(state, current_file, output_file_path)
+    store.close()
+    print_info(f"Recorded output {output_id} of run {state['run_id']} in the results store.")
+    # The timing of this node is added to the output afterwards (see results_store.flush_node_timings)
+    state["output_id"] = output_id
+
+    # The changed paragraphs become examples for the next files
+    record_accepted(state["filename"], get_text(state["old_code"]), get_text(state["new_code"]))
+    clear_original_results(state["filename"])
+
     # Clear state for the next iteration or conclusion
     state["old_code"] = ""
     state["previous_last_gen_code"] = ""
@@ -104,9 +169,21 @@ def handle_logs(state: GraphState) -> GraphState:
     state["specific_demands"] = ""
     state["filename"] = ""
     state["original_critic"] = {}
+    state["analysis_findings"] = []
     state["critic"] = {}
     state["copybooks"] = {}
     state["atlas_answer"] = ""
     state["atlas_message_type"] = ""
+    state["escalation_level"] = 0
+    state["generation_route"] = ""
+    state["iteration_history"] = []
+    state["node_timings"] = []
+    state["program_lines"] = 0
+    state["source_layout"] = {}
+    state["sequence_areas"] = ""
+    state["examples"] = ""
+
+    # Nothing of this file is needed anymore
+    collect_state(state)
 
     return state
@@ -0,0 +1,321 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from .blob_store import get_text
+from .common import GraphState, RESULTS_DB_PATH
+from .utils import print_info
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    started_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS run_files (
+    run_id TEXT NOT NULL REFERENCES runs(run_id),
+    source_path TEXT NOT NULL,
+    PRIMARY KEY (run_id, source_path)
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    output_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL REFERENCES runs(run_id),
+    program TEXT NOT NULL,
+    source_path TEXT NOT NULL,
+    output_path TEXT NOT NULL,
+    old_sha256 TEXT NOT NULL,
+    new_sha256 TEXT NOT NULL,
+    iterations INTEGER NOT NULL,
+    original_critic TEXT,
+    critic TEXT,
+    atlas_answer TEXT,
+    accepted_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS iterations (
+    output_id INTEGER NOT NULL REFERENCES outputs(output_id),
+    iteration INTEGER NOT NULL,
+    trigger TEXT,
+    route TEXT,
+    grade TEXT,
+    critique TEXT,
+    specific_demands TEXT,
+    atlas_answer TEXT,
+    code_sha256 TEXT
+);
+CREATE TABLE IF NOT EXISTS timings (
+    output_id INTEGER NOT NULL REFERENCES outputs(output_id),
+    node TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outputs_program ON outputs(program);
+CREATE INDEX IF NOT EXISTS outputs_accepted_at ON outputs(accepted_at);
+"""
+
+
+def sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ResultsStore:
+    """
+    Local SQLite database indexing every accepted output with its hashes, critiques, Atlas messages,
+    iteration history and per-node timings.
+    """
+
+    def __init__(self, path: str = RESULTS_DB_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def start_run(self, run_id: str, files: List[str] = ()):
+        with self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO runs (run_id, started_at) VALUES (?, ?)",
+                                    (run_id, time.time()))
+            # The selected files, so that an interrupted run can be resumed
+            self.connection.executemany("INSERT OR IGNORE INTO run_files (run_id, source_path) VALUES (?, ?)",
+                                        [(run_id, path) for path in files])
+
+    def unfinished_files(self, run_id: Optional[str] = None) -> Tuple[Optional[str], List[str]]:
+        """
+        Returns a run (the latest unfinished one by default) and its files without an accepted output yet.
+        """
+        if run_id is None:
+            row = self.connection.execute(
+                "SELECT run_id FROM runs WHERE finished_at IS NULL ORDER BY started_at DESC LIMIT 1").fetchone()
+            if row is None:
+                return None, []
+            run_id = row["run_id"]
+        rows = self.connection.execute(
+            "SELECT f.source_path FROM run_files f WHERE f.run_id = ? AND NOT EXISTS "
+            "(SELECT 1 FROM outputs o WHERE o.run_id = f.run_id AND o.source_path = f.source_path) "
+            "ORDER BY f.rowid", (run_id,))
+        return run_id, [row["source_path"] for row in rows]
+
+    def finish_run(self, run_id: str):
+        with self.connection:
+            self.connection.execute("UPDATE runs SET finished_at = ? WHERE run_id = ?", (time.time(), run_id))
+
+    def record_output(self, state: GraphState, source_path: str, output_path: str) -> int:
+        """
+        Records an accepted output and its whole history in a single transaction.
+
+        Returns:
+            int: The identifier of the recorded output.
+        """
+        history = state.get("iteration_history") or []
+        with self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO runs (run_id, started_at) VALUES (?, ?)",
+                                    (state["run_id"], time.time()))
+            cursor = self.connection.execute(
+                "INSERT INTO outputs (run_id, program, source_path, output_path, old_sha256, new_sha256, "
+                "iterations, original_critic, critic, atlas_answer, accepted_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (state["run_id"], state["filename"], source_path, output_path, sha256(get_text(state["old_code"])),
+                 sha256(get_text(state["new_code"])), len(history),
+                 history[0].get("original_critic", "") if history else "", state["critic"].get("description", ""),
+                 state["atlas_answer"], time.time()))
+            output_id = cursor.lastrowid
+            self.connection.executemany(
+                "INSERT INTO iterations (output_id, iteration, trigger, route, grade, critique, specific_demands, "
+                "atlas_answer, code_sha256) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(output_id, entry["iteration"], entry.get("trigger"), entry.get("route"), entry.get("grade"),
+                  entry.get("critique"), entry.get("specific_demands"), entry.get("atlas_answer"),
+                  entry.get("code_sha256")) for entry in history])
+            self.connection.executemany(
+                "INSERT INTO timings (output_id, node, started_at, duration) VALUES (?, ?, ?, ?)",
+                [(output_id, timing["node"], timing["started_at"], timing["duration"])
+                 for timing in state.get("node_timings") or []])
+        return output_id
+
+    def add_timings(self, output_id: int, timings: List[Dict[str, Any]]):
+        """
+        Adds node timings to a recorded output, e.g. of the nodes that ran after it was recorded.
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO timings (output_id, node, started_at, duration) VALUES (?, ?, ?, ?)",
+                [(output_id, timing["node"], timing["started_at"], timing["duration"]) for timing in timings])
+
+    def query(self, program: Optional[str] = None, min_iterations: Optional[int] = None,
+              since: Optional[float] = None, run_id: Optional[str] = None,
+              program_pattern: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Lists the accepted outputs matching all the given filters, most recent first, with their total
+        time spent in the workflow nodes. The program is matched exactly, the program pattern with * (or the
+        SQL LIKE wildcards) for any characters.
+        """
+        conditions, parameters = [], []
+        if program:
+            conditions.append("o.program = ?")
+            parameters.append(program)
+        if program_pattern:
+            conditions.append("o.program LIKE ?")
+            parameters.append(program_pattern.replace("*", "%"))
+        if min_iterations is not None:
+            conditions.append("o.iterations >= ?")
+            parameters.append(min_iterations)
+        if since is not None:
+            conditions.append("o.accepted_at >= ?")
+            parameters.append(since)
+        if run_id:
+            conditions.append("o.run_id = ?")
+            parameters.append(run_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        rows = self.connection.execute(
+            "SELECT o.output_id, o.run_id, o.program, o.source_path, o.output_path, o.old_sha256, o.new_sha256, "
+            "o.iterations, o.accepted_at, "
+            "(SELECT COALESCE(SUM(t.duration), 0) FROM timings t WHERE t.output_id = o.output_id) AS total_time "
+            f"FROM outputs o {where} ORDER BY o.accepted_at DESC", parameters)
+        return [dict(row) for row in rows]
+
+    def output_details(self, output_id: int) -> Dict[str, Any]:
+        output = dict(self.connection.execute("SELECT * FROM outputs WHERE output_id = ?", (output_id,)).fetchone())
+        output["iteration_history"] = [dict(row) for row in self.connection.execute(
+            "SELECT * FROM iterations WHERE output_id = ? ORDER BY iteration", (output_id,))]
+        output["node_timings"] = [dict(row) for row in self.connection.execute(
+            "SELECT node, started_at, duration FROM timings WHERE output_id = ? ORDER BY started_at", (output_id,))]
+        return output
+
+    def run_trace(self, run_id: Optional[str] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Returns the node timings of every file of a run (the latest one by default), in execution order.
+        """
+        if run_id is None:
+            row = self.connection.execute("SELECT run_id FROM runs ORDER BY started_at DESC LIMIT 1").fetchone()
+            if row is None:
+                return {}
+            run_id = row["run_id"]
+        trace: Dict[str, List[Dict[str, Any]]] = {}
+        labels: Dict[int, str] = {}
+        rows = self.connection.execute(
+            "SELECT o.output_id, o.program, t.node, t.started_at, t.duration FROM timings t "
+            "JOIN outputs o ON o.output_id = t.output_id WHERE o.run_id = ? ORDER BY o.output_id, t.started_at",
+            (run_id,))
+        for row in rows:
+            if row["output_id"] not in labels:
+                # A program accepted several times in the run gets one entry per output
+                label = row["program"]
+                while label in trace:
+                    label += "'"
+                labels[row["output_id"]] = label
+                trace[label] = []
+            trace[labels[row["output_id"]]].append(
+                {"node": row["node"], "started_at": row["started_at"], "duration": row["duration"]})
+        return trace
+
+
+def flush_node_timings(state: GraphState):
+    """
+    Adds the node timings left in the state to the last recorded output and clears them. These are the timings of
+    the nodes that ran after the output was recorded (handle_logs itself, whose timing is only appended once it
+    returns); the timings before the first output (process_directory) are left to go with it.
+    """
+    if state.get("output_id") and state.get("node_timings"):
+        store = ResultsStore()
+        store.add_timings(state["output_id"], state["node_timings"])
+        store.close()
+        state["node_timings"] = []
+
+
+def start_iteration(state: GraphState):
+    """
+    Opens a new entry of the iteration history of the current file, recording what triggered the generation.
+    Must be called before the generation inputs are reset.
+    """
+    if state.get("original_critic"):
+        trigger = "analysis"
+    elif state.get("atlas_message_type"):
+        trigger = state["atlas_message_type"]
+    elif state.get("specific_demands"):
+        trigger = "human_review"
+    else:
+        trigger = "critic"
+
+    history = state.get("iteration_history") or []
+    history.append({
+        "iteration": len(history) + 1,
+        "trigger": trigger,
+        "original_critic": json.dumps(state["original_critic"]) if state.get("original_critic") else "",
+        "specific_demands": state.get("specific_demands", ""),
+        "atlas_answer": state.get("atlas_answer", ""),
+    })
+    state["iteration_history"] = history
+
+
+def grade_iteration(state: GraphState):
+    """
+    Completes the last entry of the iteration history with the generated code and its critique.
+    """
+    if not state.get("iteration_history"):
+        return
+    state["iteration_history"][-1].update({
+        "route": state.get("generation_route", ""),
+        "grade": state["critic"].get("grade", ""),
+        "critique": state["critic"].get("description", ""),
+        "code_sha256": sha256(get_text(state["new_code"])),
+    })
+
+
+def parse_since(value: str) -> float:
+    """
+    Parses a relative age such as 7d, 12h or 30m into a timestamp.
+    """
+    units = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+    if not value or value[-1] not in units or not value[:-1].isdigit():
+        raise argparse.ArgumentTypeError("Expected an age such as 30m, 12h, 7d or 2w.")
+    return time.time() - int(value[:-1]) * units[value[-1]]
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Query and export the results of the COBOL enhancer runs.")
+    parser.add_argument("--db", default=RESULTS_DB_PATH, help="Path of the results database.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name in ("query", "export"):
+        subparser = subparsers.add_parser(name)
+        subparser.add_argument("--program", help="Program name, * as wildcard.")
+        subparser.add_argument("--min-iterations", type=int, help="Minimum number of generations.")
+        subparser.add_argument("--since", type=parse_since, help="Only outputs accepted within this age (e.g. 7d).")
+        subparser.add_argument("--run", dest="run_id", help="Only outputs of this run.")
+    subparsers.choices["export"].add_argument("--format", choices=["json", "csv"], default="json")
+    subparsers.choices["export"].add_argument("--output", help="Output file, standard output by default.")
+    args = parser.parse_args(argv)
+
+    store = ResultsStore(args.db)
+    outputs = store.query(program_pattern=args.program, min_iterations=args.min_iterations, since=args.since,
+                          run_id=args.run_id)
+
+    if args.command == "query":
+        for output in outputs:
+            print_info(f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(output['accepted_at']))}  "
+                       f"{output['program']:<20} {output['iterations']:>3} generations  "
+                       f"{output['total_time']:>8.1f}s  run {output['run_id']}")
+        print_info(f"{len(outputs)} output(s).")
+    else:
+        file = open(args.output, 'w', newline='') if args.output else sys.stdout
+        try:
+            if args.format == "json":
+                json.dump([store.output_details(output["output_id"]) for output in outputs], file, indent=2)
+            else:
+                writer = csv.DictWriter(file, fieldnames=list(outputs[0].keys()) if outputs else ["output_id"])
+                writer.writeheader()
+                writer.writerows(outputs)
+        finally:
+            if args.output:
+                file.close()
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
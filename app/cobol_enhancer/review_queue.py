@@ -0,0 +1,203 @@
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from .blob_store import materialize, dematerialize
+from .common import GraphState, REVIEW_QUEUE_DIR, REVIEW_POLL_INTERVAL
+from .utils import print_heading, print_info, print_error, print_subheading, print_code_comparator
+
+# The queue is a plain directory so that reviewers can work from another process (terminal or HTTP):
+# finished candidates are parked in pending/, the reviewers' decisions are written to decisions/.
+PENDING_DIR = os.path.join(REVIEW_QUEUE_DIR, "pending")
+DECISIONS_DIR = os.path.join(REVIEW_QUEUE_DIR, "decisions")
+
+# State keys that belong to the file under review and travel with its ticket
+PARKED_STATE_KEYS = ["filename", "original_critic", "critic", "old_code", "previous_last_gen_code", "new_code",
+                     "specific_demands", "copybooks", "atlas_answer", "atlas_message_type", "escalation_level",
+                     "generation_route", "iteration_history", "node_timings", "program_lines",
+                     "source_layout", "sequence_areas", "analysis_findings"]
+
+
+def _write_json(path: str, data: Dict[str, Any], exclusive: bool = False):
+    """
+    Writes a JSON file atomically, so that the other process never reads a partial ticket or decision.
+    With exclusive, fails with FileExistsError if the file already exists.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file, indent=2)
+    try:
+        if exclusive:
+            os.link(tmp_path, path)
+        else:
+            os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _read_json(path: str) -> Dict[str, Any]:
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def park(state: GraphState) -> str:
+    """
+    Parks the finished candidate of the current file in the review queue and removes the file from
+    files_to_process, so that the workflow can move on to the next file while it is being reviewed.
+
+    Returns:
+        str: The identifier of the review ticket.
+    """
+    ticket_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    ticket = {
+        "ticket_id": ticket_id,
+        "file_path": state["files_to_process"].pop(0),
+        "parked_at": time.time(),
+        # The texts themselves are parked, the reviewers don't share the blob store of the workflow
+        "state": materialize({key: state.get(key) for key in PARKED_STATE_KEYS}),
+    }
+    _write_json(os.path.join(PENDING_DIR, f"{ticket_id}.json"), ticket)
+    print_info(f"Parked {state['filename']} for review (ticket {ticket_id}).")
+    return ticket_id
+
+
+def clear_parked_state(state: GraphState):
+    """
+    Empties the keys of the file that has just been parked, leaving the state ready for the next file.
+    """
+    for key in PARKED_STATE_KEYS:
+        value = state.get(key)
+        if isinstance(value, (dict, list, int)) and not isinstance(value, bool):
+            state[key] = type(value)()
+        else:
+            state[key] = ""
+
+
+def list_tickets(pending_only: bool = True) -> List[Dict[str, Any]]:
+    """
+    Lists the parked tickets, oldest first, without their decided ones if pending_only.
+    """
+    if not os.path.isdir(PENDING_DIR):
+        return []
+    tickets = []
+    for name in sorted(os.listdir(PENDING_DIR)):
+        if not name.endswith(".json"):
+            continue
+        ticket_id = name[:-len(".json")]
+        if pending_only and os.path.exists(os.path.join(DECISIONS_DIR, name)):
+            continue
+        tickets.append(get_ticket(ticket_id))
+    return tickets
+
+
+def get_ticket(ticket_id: str) -> Dict[str, Any]:
+    return _read_json(os.path.join(PENDING_DIR, f"{ticket_id}.json"))
+
+
+def submit_decision(ticket_id: str, decision: str, specific_demands: str = ""):
+    """
+    Records the reviewer's decision ('yes' or 'no' with specific demands) for a parked ticket.
+    A ticket can only be decided once.
+    """
+    if decision not in ("yes", "no"):
+        raise ValueError("The decision must be 'yes' or 'no'.")
+    if decision == "no" and not specific_demands.strip():
+        raise ValueError("Specific demands are required to reject the changes.")
+    if not os.path.exists(os.path.join(PENDING_DIR, f"{ticket_id}.json")):
+        raise KeyError(f"Unknown review ticket: {ticket_id}")
+
+    try:
+        _write_json(os.path.join(DECISIONS_DIR, f"{ticket_id}.json"), {
+            "decision": decision,
+            "specific_demands": specific_demands.strip() if decision == "no" else "",
+            "decided_at": time.time(),
+        }, exclusive=True)
+    except FileExistsError:
+        raise ValueError(f"Review ticket {ticket_id} has already been decided.")
+
+
+def has_parked_tickets() -> bool:
+    return os.path.isdir(PENDING_DIR) and any(name.endswith(".json") for name in os.listdir(PENDING_DIR))
+
+
+def has_decided_tickets() -> bool:
+    return os.path.isdir(DECISIONS_DIR) and any(name.endswith(".json") for name in os.listdir(DECISIONS_DIR))
+
+
+def pop_decided_ticket(wait: bool = False) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """
+    Takes the oldest decided ticket out of the queue.
+
+    Args:
+        wait (bool): Poll the queue until a decision is submitted instead of returning None right away.
+
+    Returns:
+        tuple: The ticket and its decision, or None if no ticket has been decided.
+    """
+    while True:
+        if has_decided_tickets():
+            name = sorted(n for n in os.listdir(DECISIONS_DIR) if n.endswith(".json"))[0]
+            ticket = _read_json(os.path.join(PENDING_DIR, name))
+            decision = _read_json(os.path.join(DECISIONS_DIR, name))
+            os.remove(os.path.join(PENDING_DIR, name))
+            os.remove(os.path.join(DECISIONS_DIR, name))
+            return ticket, decision
+        if not wait:
+            return None
+        time.sleep(REVIEW_POLL_INTERVAL)
+
+
+def restore(state: GraphState, ticket: Dict[str, Any], decision: Dict[str, Any]):
+    """
+    Puts a reviewed file back as the current file of the workflow, with the reviewer's decision.
+    """
+    state["files_to_process"].insert(0, ticket["file_path"])
+    state.update(dematerialize(ticket["state"]))
+    state["human_decision"] = decision["decision"]
+    state["specific_demands"] = decision["specific_demands"]
+    print_info(f"Resuming {state['filename']} after review (ticket {ticket['ticket_id']}): "
+               f"{'accepted' if decision['decision'] == 'yes' else 'rejected'}.")
+
+
+def review_in_terminal():
+    """
+    Works through the pending tickets of the queue in the terminal, independently of the running workflow.
+    """
+    print_heading("REVIEW QUEUE")
+    skipped = set()
+    while True:
+        tickets = [ticket for ticket in list_tickets() if ticket["ticket_id"] not in skipped]
+        if not tickets:
+            print_info("No pending review. Waiting for new candidates (Ctrl-C to quit)...")
+            skipped.clear()
+            time.sleep(REVIEW_POLL_INTERVAL)
+            continue
+
+        ticket = tickets[0]
+        parked = ticket["state"]
+        print_subheading(f"Ticket {ticket['ticket_id']}: {parked['filename']}")
+        print_code_comparator(parked["old_code"], parked["new_code"])
+        print_info(f"Critic: {(parked.get('critic') or {}).get('description', '')}")
+
+        human_decision = input("Accept changes? (yes/no/skip): ").strip().lower()
+        if human_decision == "skip":
+            # Leave it for another reviewer until the other tickets have been seen
+            skipped.add(ticket["ticket_id"])
+            continue
+        specific_demands = ""
+        if human_decision == "no":
+            specific_demands = input("Enter demands: ").strip()
+        try:
+            submit_decision(ticket["ticket_id"], human_decision, specific_demands)
+            print_info("Decision submitted.")
+        except (ValueError, KeyError) as e:
+            print_error(f"Error: {e}")
+
+
+if __name__ == "__main__":
+    review_in_terminal()
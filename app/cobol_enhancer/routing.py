@@ -0,0 +1,103 @@
+import json
+import os
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+from langchain_core.language_models import BaseChatModel
+
+from .blob_store import get_text
+from .common import MODEL_ROUTES, GraphState
+from .metrics import usage_tracker, route_stats, RouteTracker
+
+
+class Route(NamedTuple):
+    node: str
+    band: str
+    model_name: str
+    tier: int
+
+    @property
+    def key(self) -> str:
+        return f"{self.node}:{self.band}:{self.model_name}"
+
+
+def load_routes() -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Returns the routing table, read from the JSON file pointed to by MODEL_ROUTES_FILE if set, or MODEL_ROUTES.
+    """
+    routes_file = os.environ.get("MODEL_ROUTES_FILE")
+    if routes_file:
+        with open(routes_file, 'r') as file:
+            return json.load(file)
+    return MODEL_ROUTES
+
+
+def program_size(state: GraphState) -> int:
+    if state.get("program_lines"):
+        return state["program_lines"]
+    return len(get_text(state.get("old_code") or "").splitlines())
+
+
+def select_route(node: str, state: GraphState, escalation_level: Optional[int] = None) -> Route:
+    """
+    Picks the model of a node for the current program: the first size band large enough for the program,
+    then the model of the escalation ladder matching the number of rejected outputs (capped at the last model).
+
+    Args:
+        node (str): The name of the node calling the model.
+        state (GraphState): The current state, used for the size of the program and the escalation level.
+        escalation_level (int): Overrides the escalation level of the state.
+
+    Returns:
+        Route: The selected route.
+    """
+    routes = load_routes()
+    if node not in routes:
+        raise ValueError(f"No model route configured for node '{node}'.")
+
+    size = program_size(state)
+    bands = routes[node]
+    band = next((b for b in bands if b["max_lines"] is None or size <= b["max_lines"]), bands[-1])
+    band_label = f"<={band['max_lines']}" if band["max_lines"] is not None else "any"
+
+    if escalation_level is None:
+        escalation_level = state.get("escalation_level") or 0
+    tier = min(escalation_level, len(band["models"]) - 1)
+
+    return Route(node, band_label, band["models"][tier], tier)
+
+
+# Replaces the creation of the models, e.g. by the evaluation harness to use a recorded model
+ModelFactory = Callable[[Route, float, List[Any]], BaseChatModel]
+_model_factory: Optional[ModelFactory] = None
+
+
+def set_model_factory(factory: Optional[ModelFactory]):
+    """
+    Makes get_chat_model create its models with the factory (called with the route, the temperature and the
+    callbacks to attach), or with ChatOpenAI again if None.
+    """
+    global _model_factory
+    _model_factory = factory
+
+
+def get_chat_model(route: Route, temperature: float = 0) -> BaseChatModel:
+    callbacks = [usage_tracker, RouteTracker(route.key, route.model_name, route_stats)]
+    if _model_factory is not None:
+        return _model_factory(route, temperature, callbacks)
+    from langchain_openai import ChatOpenAI  # Slow to import, and not needed to plan or export
+
+    # Not streamed: streamed completions don't carry the token usage read by the trackers
+    return ChatOpenAI(temperature=temperature, model=route.model_name, callbacks=callbacks)
+
+
+def record_generation_outcome(state: GraphState, accepted: bool):
+    """
+    Records whether the output of the last generation route has been accepted by the critic and, if not,
+    escalates the next generations of the file to the next model of the ladder.
+    """
+    if state.get("generation_route"):
+        route_stats.record_outcome(state["generation_route"], accepted)
+        # Saved right away, so that an interrupted run keeps its statistics
+        route_stats.save()
+    if not accepted:
+        state["escalation_level"] = (state.get("escalation_level") or 0) + 1
@@ -0,0 +1,88 @@
+import os
+import re
+import time
+from typing import Dict, List, Optional
+
+from .common import SPOOL_DIR, SPOOL_TIMEOUT, SPOOL_POLL_INTERVAL, SPOOL_MAX_POLL_INTERVAL
+from .ingestion import read_source
+from .utils import print_info
+
+# Directory of the spool where the collected outputs are moved, so that they are never matched twice
+PROCESSED_DIR = "processed"
+
+
+class SpoolCollector:
+    """
+    Collects the job outputs (compiler listings, execution logs) of the sent files from a spool directory, where
+    the host or a local stand-in drops them. An output belongs to a file when one of the parts of its name
+    (split on dots, dashes and underscores) is the job identifier or the member name of the file, e.g.
+    JOB01234.txt or PAY001.JOB01234.lst; job identifiers take precedence.
+    """
+
+    def __init__(self, spool_dir: str = SPOOL_DIR, timeout: float = SPOOL_TIMEOUT,
+                 initial_interval: float = SPOOL_POLL_INTERVAL, max_interval: float = SPOOL_MAX_POLL_INTERVAL):
+        self.spool_dir = spool_dir
+        self.timeout = timeout
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+
+    def _matches(self, member: str, job_id: Optional[str], since: float) -> List[os.DirEntry]:
+        try:
+            entries = [entry for entry in os.scandir(self.spool_dir) if entry.is_file()]
+        except FileNotFoundError:
+            return []
+        # Members keep the extension of their file unless TRANSFER_MEMBER_NAMES is set, the outputs are named after
+        # the member without it
+        member_parts = re.split(r"[._-]", os.path.splitext(member)[0].upper())
+        by_job, by_member = [], []
+        for entry in entries:
+            # Outputs older than the upload are those of a previous submission
+            if entry.stat().st_mtime < since:
+                continue
+            parts = re.split(r"[._-]", entry.name.upper())
+            if job_id and job_id.upper() in parts:
+                by_job.append(entry)
+            elif any(parts[index:index + len(member_parts)] == member_parts for index in range(len(parts))):
+                by_member.append(entry)
+        return sorted(by_job or by_member, key=lambda entry: entry.stat().st_mtime)
+
+    def collect(self, member: str, job_id: Optional[str] = None, since: float = 0.0) -> Optional[str]:
+        """
+        Polls the spool, with an exponential backoff, until the output of a file is complete, then returns its
+        text and moves it to the processed directory.
+
+        Args:
+            member (str): The name under which the file was sent.
+            job_id (str): The job identifier given by the host, if any.
+            since (float): The time of the upload; older outputs are ignored.
+
+        Returns:
+            str: The output, or None if none was complete before the timeout.
+        """
+        deadline = time.monotonic() + self.timeout
+        interval = self.initial_interval
+        # Size of the matching outputs at the previous poll: an output is complete once its size stops changing
+        sizes: Dict[str, int] = {}
+        print_info(f"Waiting for the output of {member}{f' (job {job_id})' if job_id else ''} in {self.spool_dir}.")
+        while True:
+            for entry in self._matches(member, job_id, since):
+                size = entry.stat().st_size
+                if size > 0 and sizes.get(entry.path) == size:
+                    return self._take(entry.path)
+                sizes[entry.path] = size
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            # Poll again quickly once an output has started to appear
+            time.sleep(min(self.initial_interval if sizes else interval, remaining))
+            interval = min(interval * 2, self.max_interval)
+
+    def _take(self, path: str) -> str:
+        # Outputs fetched from the host may be in EBCDIC, and their columns are kept as they are
+        text = read_source(path, strip=False).text
+        processed_dir = os.path.join(self.spool_dir, PROCESSED_DIR)
+        os.makedirs(processed_dir, exist_ok=True)
+        os.replace(path, os.path.join(processed_dir, os.path.basename(path)))
+        print_info(f"Collected {os.path.basename(path)}.")
+        return text
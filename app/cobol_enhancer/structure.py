@@ -0,0 +1,207 @@
+import difflib
+import re
+from typing import List, NamedTuple, Tuple
+
+# Header of a paragraph or section of the procedure division: a name starting in area A (columns 8-11), alone on
+# its line with its period
+PARAGRAPH_HEADER = re.compile(r"^.{6} {1,4}([A-Za-z0-9][A-Za-z0-9-]*)(?:\s+SECTION)?\s*\.\s*$")
+PROCEDURE_DIVISION = re.compile(r"^.{6} .*\bPROCEDURE\s+DIVISION\b", re.IGNORECASE)
+# Division and section headers of the other divisions, e.g. WORKING-STORAGE SECTION
+DIVISION_HEADER = re.compile(r"^.{6} {1,4}([A-Za-z-]+\s+(?:DIVISION|SECTION))\b", re.IGNORECASE)
+
+
+class Paragraph(NamedTuple):
+    name: str
+    # Lines of the paragraph, from its header (0-based, end excluded)
+    start: int
+    end: int
+
+
+def find_paragraphs(lines: List[str]) -> List[Paragraph]:
+    """
+    Locates the paragraphs (and sections) of the procedure division of a program, given as a list of lines. A
+    paragraph ends where the next one starts, the last one at the end of the program.
+    """
+    headers, in_procedure = [], False
+    for index, line in enumerate(lines):
+        if not in_procedure:
+            in_procedure = bool(PROCEDURE_DIVISION.match(line))
+            continue
+        match = PARAGRAPH_HEADER.match(line)
+        if match:
+            headers.append((index, match.group(1).upper()))
+    ends = [start for start, _ in headers[1:]] + [len(lines)]
+    return [Paragraph(name, start, end) for (start, name), end in zip(headers, ends)]
+
+
+def split_paragraphs(code: str) -> List[Tuple[str, str]]:
+    """
+    Splits the procedure division of a program into its paragraphs (and sections), each with its header line.
+
+    Returns:
+        list: The name (in upper case) and text of each paragraph, in order.
+    """
+    lines = [line.rstrip() for line in code.split("\n")]
+    return [(paragraph.name, "\n".join(lines[paragraph.start:paragraph.end]).rstrip())
+            for paragraph in find_paragraphs(lines)]
+
+
+def paragraph_at(paragraphs: List[Paragraph], index: int):
+    """
+    Returns the paragraph containing a line, or None if the line is before the first one.
+    """
+    for paragraph in paragraphs:
+        if paragraph.start <= index < paragraph.end:
+            return paragraph
+    return None
+
+
+def summarize_structure(code: str, highlighted=()) -> str:
+    """
+    Describes the layout of a program in a few lines: its divisions and sections, then its paragraphs with their
+    line ranges (1-based), the highlighted ones marked with a star.
+    """
+    lines = code.split("\n")
+    summary = [f"{len(lines)} lines."]
+    for index, line in enumerate(lines):
+        if DIVISION_HEADER.match(line):
+            summary.append(f"{' '.join(line[7:].split()).rstrip('.')} (line {index + 1})")
+        if PROCEDURE_DIVISION.match(line):
+            break
+    paragraphs = find_paragraphs(lines)
+    if paragraphs:
+        summary.append("Paragraphs: " + ", ".join(
+            f"{paragraph.name}{'*' if paragraph.name in highlighted else ''} ({paragraph.start + 1}-{paragraph.end})"
+            for paragraph in paragraphs))
+    return "\n".join(summary)
+
+
+def _hunk_windows(opcodes, paragraphs: List[Paragraph], line_count: int, context: int,
+                  paragraph_context: int) -> List[Tuple[int, int]]:
+    # Ranges of original lines shown around the changes: a few lines, or the whole paragraph when it is short
+    windows = []
+    for tag, i1, i2, _, _ in opcodes:
+        if tag == "equal":
+            continue
+        start, end = max(0, i1 - context), min(line_count, i2 + context)
+        paragraph = paragraph_at(paragraphs, i1)
+        if paragraph and paragraph.end - paragraph.start <= paragraph_context and i2 <= paragraph.end:
+            start, end = min(start, paragraph.start), max(end, paragraph.end)
+        if windows and start <= windows[-1][1]:
+            windows[-1] = (windows[-1][0], max(windows[-1][1], end))
+        else:
+            windows.append((start, end))
+    return windows
+
+
+def structured_diff(old_code: str, new_code: str, context: int = 3,
+                    paragraph_context: int = 40) -> Tuple[str, List[str]]:
+    """
+    Diffs two versions of a program into hunks of changed lines, like a unified diff. Each hunk is headed by its
+    line ranges and the paragraphs it touches, and shows the whole paragraph around the change when the paragraph
+    is at most paragraph_context lines long, context lines otherwise.
+
+    Args:
+        old_code (str): The version the changes are made to.
+        new_code (str): The changed version.
+        context (int): Unchanged lines shown before and after each change.
+        paragraph_context (int): Length under which a changed paragraph is shown whole.
+
+    Returns:
+        tuple: The hunks, and the names of the paragraphs they touch.
+    """
+    old_lines, new_lines = old_code.split("\n"), new_code.split("\n")
+    opcodes = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes()
+    paragraphs = find_paragraphs(old_lines)
+    windows = _hunk_windows(opcodes, paragraphs, len(old_lines), context, paragraph_context)
+
+    hunks, touched = [], []
+    for start, end in windows:
+        lines, new_start, new_end, names = [], None, None, []
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == "equal":
+                low, high = max(i1, start), min(i2, end)
+                if low >= high:
+                    continue
+                lines.extend(" " + line for line in old_lines[low:high])
+                first, last = j1 + low - i1, j1 + high - i1
+            elif start <= i1 and i2 <= end:
+                lines.extend("-" + line for line in old_lines[i1:i2])
+                lines.extend("+" + line for line in new_lines[j1:j2])
+                first, last = j1, j2
+                # Inserted lines belong to the paragraph of the line they follow
+                for index in range(i1, i2) if i2 > i1 else [i1 - 1]:
+                    paragraph = paragraph_at(paragraphs, index)
+                    if paragraph and paragraph.name not in names:
+                        names.append(paragraph.name)
+            else:
+                continue
+            new_start = first if new_start is None else new_start
+            new_end = last
+
+        touched.extend(name for name in names if name not in touched)
+        header = f"@@ -{start + 1},{end - start} +{(new_start or 0) + 1},{(new_end or 0) - (new_start or 0)} @@"
+        hunks.append(f"{header} {', '.join(names)}".rstrip() + "\n" + "\n".join(lines))
+    return "\n".join(hunks), touched
+
+
+# Data description entry: level number then data name (or FILLER)
+DATA_ENTRY = re.compile(r"^.{6} \s*(\d{1,2})\s+([A-Za-z0-9][A-Za-z0-9-]*)", re.IGNORECASE)
+# File description entry of the file section
+FILE_ENTRY = re.compile(r"^.{6} \s*(FD|SD)\s+([A-Za-z0-9][A-Za-z0-9-]*)", re.IGNORECASE)
+WORD = re.compile(r"[A-Za-z0-9][A-Za-z0-9-]*[A-Za-z0-9]|[A-Za-z]")
+
+
+class DataEntry(NamedTuple):
+    # Names defined by the entry: its record and every subordinate item
+    names: frozenset
+    text: str
+
+
+def words(text: str) -> set:
+    """
+    Returns the words of a COBOL text in upper case, to match the data names it references.
+    """
+    return {word.upper() for word in WORD.findall(text)}
+
+
+def defined_names(text: str) -> set:
+    """
+    Returns the data names defined by the data description entries of a text (e.g. a copybook).
+    """
+    names = set()
+    for line in text.split("\n"):
+        match = DATA_ENTRY.match(line) or FILE_ENTRY.match(line)
+        if match and match.group(2).upper() != "FILLER":
+            names.add(match.group(2).upper())
+    return names
+
+
+def find_data_entries(lines: List[str]) -> List[DataEntry]:
+    """
+    Splits the data division of a program into its top-level entries: each file description, 01 record and 77
+    item with its subordinate items.
+    """
+    entries, current, in_data = [], [], False
+
+    def close():
+        if current:
+            text = "\n".join(current).rstrip()
+            entries.append(DataEntry(frozenset(defined_names(text)), text))
+
+    for line in lines:
+        if PROCEDURE_DIVISION.match(line):
+            break
+        if not in_data:
+            in_data = bool(re.match(r"^.{6} .*\bDATA\s+DIVISION\b", line, re.IGNORECASE))
+            continue
+        if line[6:7] in ("*", "/"):
+            continue
+        match = DATA_ENTRY.match(line) or FILE_ENTRY.match(line)
+        if DIVISION_HEADER.match(line) or match and match.group(1).upper() in ("FD", "SD", "01", "1", "77"):
+            close()
+            current = [] if DIVISION_HEADER.match(line) else [line.rstrip()]
+        elif current:
+            current.append(line.rstrip())
+    close()
+    return entries
@@ -1,15 +1,26 @@
+import asyncio
+import concurrent.futures
+import contextlib
 import difflib
 import shutil
+import uuid
 
-from langchain_community.chat_message_histories import RedisChatMessageHistory
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.runnables.history import RunnableWithMessageHistory
 from termcolor import colored
 import re
 import os
+from typing import List
 
-from app.cobol_enhancer.common import GraphState
+from app.cobol_enhancer.common import GraphState, COPYBOOK_DIR, COPYBOOK_EXTENSIONS, CONTINUATION_TAIL_LINES, \
+    MAX_CONTINUATIONS, CONTINUATION_MIN_OVERLAP, CONTINUATION_MAX_COPYBOOK_FIELDS
+from app.cobol_enhancer.ingestion import read_source
+from app.cobol_enhancer.inventory import get_inventory
+
+# File locks shared between the processes of a machine: flock on Unix/Linux, msvcrt on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 
 # Utility functions for UI
@@ -77,6 +88,53 @@ def print_code_comparator(old_code: str, new_code: str) -> str:
     print("=" * terminal_width)
 
 
+def write_atomic(path: str, content):
+    """
+    Writes a file atomically: the content (text, or bytes already encoded) is written to a temporary file of
+    the same directory, then moved over the destination, so that readers never see a partially written file.
+    Each write has its own temporary file, so concurrent writers of the same path don't clash.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'wb' if isinstance(content, bytes) else 'w') as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    """
+    Holds an exclusive lock on a lock file for the duration of the block, so that the processes sharing a file
+    (e.g. concurrent runs) update it one after the other.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, 'a+') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+            return
+        # msvcrt locks a range of bytes, and gives up after about ten seconds of retries
+        lock_file.seek(0)
+        while True:
+            try:
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                continue
+        try:
+            yield
+        finally:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
 def sanitize_output(text: str, rm_opening: bool = True, rm_closing: bool = True):
     # Define the possible opening and closing delimiters
     opening_delimiters = ["```cobol", "```plaintext"]
@@ -94,7 +152,31 @@ def sanitize_output(text: str, rm_opening: bool = True, rm_closing: bool = True)
         closing_index = text.rfind(closing_delimiter)
         text = text[:closing_index]
 
-    return text.strip()
+    # Only the surrounding blank lines are removed: the indentation of the first line is significant in COBOL
+    return text.strip("\r\n").rstrip()
+
+
+def find_copybook(copybook_name: str):
+    # The copybook may be stored as is or with one of the copybook extensions
+    for extension in [""] + COPYBOOK_EXTENSIONS:
+        copybook_path = os.path.join(COPYBOOK_DIR, copybook_name + extension)
+        if os.path.isfile(copybook_path):
+            return copybook_path
+    return None
+
+
+# Resolved copybooks by path, with the mtime they were read at: programs sharing copybooks (e.g. the programs of a
+# cluster, see dependencies.DependencyGraph.clusters) only read and decode them once
+_copybook_texts = {}
+
+
+def read_copybook(copybook_path: str) -> str:
+    mtime = os.stat(copybook_path).st_mtime_ns
+    cached = _copybook_texts.get(copybook_path)
+    if cached is None or cached[0] != mtime:
+        # Decoded and stripped of its sequence areas like the programs
+        cached = _copybook_texts[copybook_path] = (mtime, read_source(copybook_path).text)
+    return cached[1]
 
 
 def extract_copybooks(cobol_file_content: str) -> dict:
@@ -117,12 +199,11 @@ def extract_copybooks(cobol_file_content: str) -> dict:
         for match in matches:
             # Remove potential trailing period
             copybook_name = match.rstrip('.')
-            copybook_path = os.path.join("data/input/copy", copybook_name)
-            try:
-                with open(copybook_path, 'r', encoding='utf-8') as copybook_file:
-                    copybooks[copybook_name] = copybook_file.read()
-            except FileNotFoundError:
-                print(f"Copybook {copybook_name} not found at {copybook_path}")
+            copybook_path = find_copybook(copybook_name)
+            if copybook_path is None:
+                print(f"Copybook {copybook_name} not found in {COPYBOOK_DIR}")
+                continue
+            copybooks[copybook_name] = read_copybook(copybook_path)
     print("\n")
     return copybooks
 
@@ -145,63 +226,148 @@ def get_previous_critic_description(state: GraphState) -> str:
 
 
 def filename_tab_completion(text, state):
-    # List all file names in data/input/, filtering by the current input text
-    files = [f for f in os.listdir("data/input/") if f.startswith(text)]
+    # Readline calls the completer with increasing state values for the same text: look the matches up
+    # in the inventory only once, on the first call
+    if state == 0:
+        filename_tab_completion.matches = get_inventory().complete(text)
+    matches = getattr(filename_tab_completion, "matches", [])
     # Return the state-th file name if it exists, appending a space for convenience
-    return (files[state] + " ") if state < len(files) else None
+    return (matches[state] + " ") if state < len(matches) else None
 
 
-def generate_code_with_history(state, function_name, template, model, variables):
-    redis_url = os.environ.get('REDIS_URL')
-    if redis_url is None:
-        raise ValueError("The REDIS_URL environment variable is not set.")
-    session_id = f"{function_name}_{state['filename']}"
+def run_coroutine(coroutine):
+    """
+    Runs a coroutine to completion from synchronous code. asyncio.run can't be used in a thread that already runs
+    an event loop (e.g. a handler of the server): the coroutine then runs on its own loop in a worker thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
 
-    def redis_history(id):
-        return RedisChatMessageHistory(id, url=redis_url)
 
-    # Clear the history before starting to avoid any potential issues
-    redis_history(session_id).clear()
+def generate_code(template, model, variables):
+    return run_coroutine(agenerate_code(template, model, variables))
 
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", template),
-        MessagesPlaceholder(variable_name="history"),
-        ("human", "{question}")])
 
-    chain_with_history = RunnableWithMessageHistory(
-        prompt | model | StrOutputParser(),
-        redis_history,
-        input_messages_key="question",
-        history_messages_key="history",
-    )
+def _finish_reason(generation) -> str:
+    reason = (generation.generation_info or {}).get("finish_reason")
+    if reason is None:
+        metadata = getattr(generation.message, "response_metadata", None) or {}
+        reason = metadata.get("finish_reason") or metadata.get("stop_reason")
+    return reason or ""
 
-    config = {"configurable": {"session_id": session_id}}
 
-    code_block_delimiter = "```"
-    is_first_iteration = True
-    final_output_accumulated = ""
-    while True:
-        # Set "question" based on whether it's the first iteration
-        question_value = "" if is_first_iteration else "continue"
+def _complete_lines(text: str) -> List[str]:
+    # A truncated output usually ends in the middle of a line: that line is dropped and regenerated
+    lines = text.split("\n")
+    return lines[:-1] if len(lines) > 1 else lines
 
-        result = chain_with_history.invoke({
-            "question": question_value,
-            **variables  # Unpack additional_variables into the outer dictionary
-        }, config=config)
 
-        current_output = sanitize_output(result, True, False)
+def remaining_original_code(old_code: str, tail: List[str]) -> str:
+    """
+    Returns the part of the original code that follows the last lines of the tail, i.e. what is left to rewrite.
+    The whole original code is returned if the tail can't be located in it.
+    """
+    old_lines = old_code.split("\n")
+    matcher = difflib.SequenceMatcher(None, [line.strip() for line in old_lines],
+                                      [line.strip() for line in tail], autojunk=False)
+    blocks = [block for block in matcher.get_matching_blocks() if block.size > 0]
+    if not blocks:
+        return old_code
+    return "\n".join(old_lines[blocks[-1].a + blocks[-1].size:])
 
-        # Always append to the final_output_accumulated to accumulate all iterations
-        if is_first_iteration:
-            final_output_accumulated = current_output
-            is_first_iteration = False
-        else:
-            final_output_accumulated += current_output
 
-        # Check if the result meets the condition to exit the loop
-        if final_output_accumulated.strip().endswith(code_block_delimiter) and "Continuation" not in result:
-            # Final sanitization and adjustment if necessary before breaking the loop
-            redis_history(session_id).clear()
-            return sanitize_output(final_output_accumulated)
-        else:
-            print_info("Extending the output with another iteration...")
+# Lines that legitimately follow each other in a program, so their repetition at a seam proves nothing
+TRIVIAL_LINE = re.compile(r"^(END-[A-Z-]+)?\.?$", re.IGNORECASE)
+
+
+def merge_at_seam(lines: List[str], continuation: List[str]) -> List[str]:
+    """
+    Appends a continuation to the output, dropping its first lines when they repeat the end of the output. Only an
+    overlap with at least CONTINUATION_MIN_OVERLAP significant lines is dropped: blank lines or an END-IF. at the
+    seam are usually new code.
+    """
+    max_overlap = min(len(lines), len(continuation))
+    for overlap in range(max_overlap, 0, -1):
+        repeated = [line.strip() for line in continuation[:overlap]]
+        if [line.strip() for line in lines[-overlap:]] != repeated:
+            continue
+        if sum(1 for line in repeated if not TRIVIAL_LINE.match(line)) >= CONTINUATION_MIN_OVERLAP:
+            return lines + continuation[overlap:]
+    return lines + continuation
+
+
+# Data description entry of a copybook: level number, then the name of the item (FILLER has none worth giving)
+DATA_ITEM = re.compile(r"^[ \d]{6}[ D]\s*(\d{1,2})\s+([A-Z0-9][A-Z0-9-]*)", re.IGNORECASE | re.MULTILINE)
+
+
+def copybook_field_names(copybooks: str, limit: int = CONTINUATION_MAX_COPYBOOK_FIELDS) -> str:
+    """
+    Lists the names of the data items defined in the copybooks of a program (as given to the generation), at
+    most limit of them.
+    """
+    names = []
+    for _, name in DATA_ITEM.findall(copybooks or ""):
+        name = name.upper()
+        if name != "FILLER" and name not in names:
+            names.append(name)
+    if not names:
+        return "(none)"
+    more = f" (and {len(names) - limit} more)" if len(names) > limit else ""
+    return ", ".join(names[:limit]) + more
+
+
+def _requested_changes(variables: dict) -> str:
+    original_critic = variables.get("original_critic") or {}
+    if isinstance(original_critic, dict):
+        original_critic = original_critic.get("description", "")
+    changes = [original_critic, variables.get("critic"), variables.get("specific_demands"),
+               variables.get("atlas_answer")]
+    return "\n".join(change for change in changes if change)
+
+
+async def agenerate_code(template, model, variables):
+    """
+    Generates code with the template, continuing it as long as the model stops because of the length limit.
+    A continuation is not given the whole conversation again but only the end of the output so far, the part of
+    the original code left to rewrite and the requested changes, so that long programs don't pay for their
+    whole input at each continuation.
+
+    Args:
+        template (str): The generation prompt template.
+        model (BaseChatModel): The model generating the code.
+        variables (dict): The variables of the template.
+
+    Returns:
+        str: The generated code, without its code block delimiters.
+    """
+    from langchain_core.prompts import ChatPromptTemplate  # Not at the top, utils is imported by the CLI
+    from app.cobol_enhancer.prompts import continuation_prompt  # Not at the top, the prompts module uses utils
+
+    messages = ChatPromptTemplate.from_messages([("system", template), ("human", "")]).format_messages(**variables)
+    generation = (await model.agenerate([messages])).generations[0][0]
+    lines = sanitize_output(generation.text, True, False).split("\n")
+
+    continuations = 0
+    while _finish_reason(generation) in ("length", "max_tokens"):
+        if continuations == MAX_CONTINUATIONS:
+            print_error(f"The output is still cut off after {MAX_CONTINUATIONS} continuations, keeping it as is.")
+            break
+        continuations += 1
+        lines = _complete_lines("\n".join(lines))
+        tail = lines[-CONTINUATION_TAIL_LINES:]
+        print_info(f"The output was cut off, continuing from its last {len(tail)} lines "
+                   f"(continuation {continuations}).")
+
+        messages = ChatPromptTemplate.from_template(continuation_prompt()).format_messages(
+            copybook_fields=copybook_field_names(variables.get("copybooks", "")),
+            changes=_requested_changes(variables),
+            remaining_code=remaining_original_code(variables.get("old_code", ""), tail),
+            tail="\n".join(tail))
+        generation = (await model.agenerate([messages])).generations[0][0]
+        lines = merge_at_seam(lines, sanitize_output(generation.text, True, False).split("\n"))
+
+    return sanitize_output("\n".join(lines))
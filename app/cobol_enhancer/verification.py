@@ -0,0 +1,212 @@
+import difflib
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional
+
+from .blob_store import get_text, load_copybooks
+from .common import (GraphState, VERIFY_COBC, VERIFY_COBC_FLAGS, VERIFY_INPUT_DIR, VERIFY_MODE, VERIFY_TIMEOUT,
+                     VERIFY_WORKERS)
+from .results_store import grade_iteration
+from .routing import record_generation_outcome
+from .utils import print_heading, print_info, print_error
+
+# Name of the recorded input file piped to the standard input of the program
+STDIN_FILE = "stdin"
+# Limits of the compiler and of the programs: CPU seconds come from VERIFY_TIMEOUT, written files are capped
+MAX_FILE_SIZE = 64 * 1024 * 1024
+# Characters of compiler output or output differences given back to the generation
+MAX_REPORT_LENGTH = 4000
+
+
+def _limit_resources():
+    # Runs in the child process before exec: a runaway compile or program can't hog the box
+    import resource
+    resource.setrlimit(resource.RLIMIT_CPU, (int(VERIFY_TIMEOUT), int(VERIFY_TIMEOUT) + 1))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (MAX_FILE_SIZE, MAX_FILE_SIZE))
+
+
+def _run(command: List[str], cwd: str, stdin: Optional[bytes] = None) -> subprocess.CompletedProcess:
+    # Minimal environment: the programs only see the sandbox
+    environment = {"PATH": os.environ.get("PATH", "/usr/bin:/bin"), "HOME": cwd, "TMPDIR": cwd}
+    environment.update({key: value for key, value in os.environ.items() if key.startswith("COB_")})
+    return subprocess.run(command, cwd=cwd, input=stdin, capture_output=True, timeout=VERIFY_TIMEOUT,
+                          env=environment, preexec_fn=_limit_resources if os.name == "posix" else None)
+
+
+def compile_and_run(code: str, copybooks: Dict[str, str], case_dirs: List[str]) -> Dict[str, Any]:
+    """
+    Compiles a program with cobc in a temporary directory, with its copybooks on the copy path, then runs it on
+    each recorded input case in a directory of its own. Runs in a worker process of the verification pool.
+
+    Args:
+        code (str): The program.
+        copybooks (dict): The contents of the copybooks by name.
+        case_dirs (list): Directories holding the input files of each run (and its standard input, "stdin").
+
+    Returns:
+        dict: "compiled", "compile_output", and the return code, standard output and written files of each run.
+    """
+    with tempfile.TemporaryDirectory(prefix="cobol_verify_") as sandbox:
+        copy_dir = os.path.join(sandbox, "copy")
+        os.makedirs(copy_dir)
+        for name, content in copybooks.items():
+            # Copybooks are referenced with or without extension
+            for filename in (name, f"{name}.cpy"):
+                with open(os.path.join(copy_dir, filename), 'w') as file:
+                    file.write(content)
+        with open(os.path.join(sandbox, "program.cob"), 'w') as file:
+            file.write(code + "\n")
+
+        try:
+            compilation = _run([VERIFY_COBC, "-x", *VERIFY_COBC_FLAGS, "-I", copy_dir, "-o", "program",
+                                "program.cob"], sandbox)
+        except subprocess.TimeoutExpired:
+            return {"compiled": False, "compile_output": f"Compilation timed out after {VERIFY_TIMEOUT}s.", "runs": {}}
+        result = {"compiled": compilation.returncode == 0,
+                  "compile_output": (compilation.stdout + compilation.stderr).decode("utf-8", errors="replace"),
+                  "runs": {}}
+        if not result["compiled"]:
+            return result
+
+        for case_dir in case_dirs:
+            run_dir = os.path.join(sandbox, "run_" + os.path.basename(case_dir))
+            shutil.copytree(case_dir, run_dir, ignore=shutil.ignore_patterns(STDIN_FILE))
+            stdin_path = os.path.join(case_dir, STDIN_FILE)
+            stdin = open(stdin_path, 'rb').read() if os.path.exists(stdin_path) else b""
+            try:
+                process = _run([os.path.join(sandbox, "program")], run_dir, stdin)
+                run = {"returncode": process.returncode, "stdout": process.stdout.decode("utf-8", errors="replace")}
+            except subprocess.TimeoutExpired:
+                run = {"returncode": None, "stdout": f"Timed out after {VERIFY_TIMEOUT}s."}
+            # Every file of the run directory once the program ended, inputs included (they may be rewritten)
+            run["files"] = {}
+            for filename in sorted(os.listdir(run_dir)):
+                with open(os.path.join(run_dir, filename), 'rb') as file:
+                    run["files"][filename] = file.read().decode("utf-8", errors="replace")
+            result["runs"][os.path.basename(case_dir)] = run
+        return result
+
+
+def compare_runs(old_runs: Dict[str, Dict[str, Any]], new_runs: Dict[str, Dict[str, Any]]) -> List[str]:
+    """
+    Lists the differences between the runs of the original and new programs on the same inputs.
+    """
+    differences = []
+    for case, old_run in old_runs.items():
+        new_run = new_runs.get(case)
+        if new_run is None:
+            continue
+        if old_run["returncode"] != new_run["returncode"]:
+            differences.append(f"Input {case}: return code {new_run['returncode']} instead of "
+                               f"{old_run['returncode']}.")
+        outputs = [("standard output", old_run["stdout"], new_run["stdout"])]
+        for filename in sorted(set(old_run["files"]) | set(new_run["files"])):
+            outputs.append((f"file {filename}", old_run["files"].get(filename, ""),
+                            new_run["files"].get(filename, "")))
+        for name, old_output, new_output in outputs:
+            if old_output != new_output:
+                diff = "\n".join(difflib.unified_diff(old_output.splitlines(), new_output.splitlines(),
+                                                      "original", "new", lineterm=""))
+                differences.append(f"Input {case}, {name} differs:\n{diff}")
+    return differences
+
+
+def recorded_cases(filename: str) -> List[str]:
+    """
+    Returns the directories of the recorded inputs of a program: VERIFY_INPUT_DIR/<program name>/<case>/.
+    """
+    program_dir = os.path.join(VERIFY_INPUT_DIR, os.path.splitext(filename)[0])
+    if not os.path.isdir(program_dir):
+        return []
+    return [os.path.join(program_dir, case) for case in sorted(os.listdir(program_dir))
+            if os.path.isdir(os.path.join(program_dir, case))]
+
+
+_executor: Optional[ProcessPoolExecutor] = None
+# Results of the original program of each file in progress, which don't change across the iterations on the file
+# (cleared once the file is done, see clear_original_results)
+_original_results: Dict[str, Dict[str, Future]] = {}
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=VERIFY_WORKERS)
+    return _executor
+
+
+def _original_result(filename: str, old_code: str, copybooks: Dict[str, str], case_dirs: List[str]) -> Future:
+    key = hashlib.sha256(repr((old_code, sorted(copybooks.items()), case_dirs)).encode("utf-8")).hexdigest()
+    results = _original_results.setdefault(filename, {})
+    if key not in results:
+        results[key] = get_executor().submit(compile_and_run, old_code, copybooks, case_dirs)
+    return results[key]
+
+
+def clear_original_results(filename: str):
+    """
+    Forgets the results of the original program of a file, once it is done.
+    """
+    _original_results.pop(filename, None)
+
+
+def _truncate(text: str) -> str:
+    return text if len(text) <= MAX_REPORT_LENGTH else text[:MAX_REPORT_LENGTH] + "\n[...]"
+
+
+def local_verification(state: GraphState) -> GraphState:
+    print_heading("LOCAL VERIFICATION")
+    state["verification"] = {"status": "skipped"}
+    if shutil.which(VERIFY_COBC) is None:
+        print_error(f"{VERIFY_COBC} not found, the candidate is not verified locally.")
+        return state
+
+    new_code, old_code = get_text(state["new_code"]), get_text(state["old_code"])
+    copybooks = load_copybooks(state["copybooks"])
+    case_dirs = recorded_cases(state["filename"]) if VERIFY_MODE == "run" else []
+
+    # The new and original programs are compiled and run at the same time in the pool. A candidate that can't be
+    # verified (broken pool, unreadable inputs, cobc failing to start) goes on unverified
+    global _executor
+    try:
+        original = _original_result(state["filename"], old_code, copybooks, case_dirs)
+        new = get_executor().submit(compile_and_run, new_code, copybooks, case_dirs).result()
+        original_result = original.result()
+    except Exception as e:
+        print_error(f"Local verification failed, the candidate is not verified: {e!r}")
+        clear_original_results(state["filename"])
+        if isinstance(e, BrokenProcessPool):
+            # A new pool is started for the next candidate
+            _executor = None
+        return state
+
+    if not new["compiled"]:
+        if not original_result["compiled"]:
+            # The original doesn't compile with GnuCOBOL either (dialect, missing copybooks): nothing to learn
+            print_error("The original program doesn't compile locally either, the candidate is not verified.")
+            return state
+        status, report = "compilation_error", f"Local GnuCOBOL compilation:\n{new['compile_output']}"
+    else:
+        differences = compare_runs(original_result["runs"], new["runs"]) if case_dirs else []
+        if not differences:
+            state["verification"] = {"status": "ok"}
+            matched = f" and matched the original on {len(case_dirs)} input(s)" if case_dirs else ""
+            print_info(f"Compiled locally{matched}.")
+            return state
+        status, report = "execution_error", "Local runs differ from the original program:\n" + "\n".join(differences)
+
+    report = _truncate(report)
+    print_error(report)
+    state["verification"] = {"status": status}
+    # Given to the next generation like an Atlas message, without the round trip
+    state["atlas_message_type"] = status
+    state["atlas_answer"] = report
+    state["critic"] = {"description": report, "grade": "bad"}
+    grade_iteration(state)
+    record_generation_outcome(state, False)
+    return state
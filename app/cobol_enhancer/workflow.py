@@ -1,42 +1,86 @@
 from langgraph.graph import END, StateGraph
 
-from .common import GraphState
+from .common import GraphState, SPECULATIVE_CANDIDATES, REVIEW_MODE, VERIFY_MODE
 from .deciders import human_review_decider, evaluate_quality_decider, \
-    has_finished_all_files_decider
-from .generation import critic_generation, human_review, process_directory, generate, analyze_next_file
+    has_finished_all_files_decider, review_queue_decider, local_verification_decider
+from .generation import critic_generation, human_review, process_directory, generate, analyze_next_file, \
+    speculative_generation, queue_review
+from .metrics import timed_node
 from .response_handlers import sender, receiver, handle_logs, message_type_decider
+from .verification import local_verification
 
 workflow = StateGraph(GraphState)
 
-workflow.add_node("process_directory", process_directory)
-workflow.add_node("analyze_next_file", analyze_next_file)
-workflow.add_node("generate", generate)
-workflow.add_node("critic_generation", critic_generation)
-workflow.add_node("human_review", human_review)
-workflow.add_node("sender", sender)
-workflow.add_node("receiver", receiver)
-workflow.add_node("handle_logs", handle_logs)
+workflow.add_node("process_directory", timed_node("process_directory", process_directory))
+workflow.add_node("analyze_next_file", timed_node("analyze_next_file", analyze_next_file))
+# With speculative generation, candidates are generated and critiqued together in a single node
+if SPECULATIVE_CANDIDATES > 1:
+    generation_node = critic_node = "speculative_generation"
+    workflow.add_node("speculative_generation", timed_node("speculative_generation", speculative_generation))
+else:
+    generation_node, critic_node = "generate", "critic_generation"
+    workflow.add_node("generate", timed_node("generate", generate))
+    workflow.add_node("critic_generation", timed_node("critic_generation", critic_generation))
+# In queue mode, the finished candidates are parked for review and the workflow moves on to the next file
+workflow.add_node("human_review", timed_node(
+    "human_review", queue_review if REVIEW_MODE == "queue" else human_review))
+# The candidates are compiled (and run) locally before the critic, or before the human review with speculative
+# generation, so that the broken ones go straight back to the generation
+if VERIFY_MODE != "off":
+    workflow.add_node("local_verification", timed_node("local_verification", local_verification))
+workflow.add_node("sender", timed_node("sender", sender))
+workflow.add_node("receiver", timed_node("receiver", receiver))
+workflow.add_node("handle_logs", timed_node("handle_logs", handle_logs))
 
 workflow.set_entry_point("process_directory")
 workflow.add_edge("process_directory", "analyze_next_file")
-workflow.add_edge("analyze_next_file", "generate")
-workflow.add_edge("generate", "critic_generation")
-workflow.add_conditional_edges("critic_generation", evaluate_quality_decider, {
-    "re_gen": "generate",
-    "human_check": "human_review",
-})
-workflow.add_conditional_edges("human_review", human_review_decider, {
-    "re_gen": "generate",
-    "send_file": "sender",
-})
+workflow.add_edge("analyze_next_file", generation_node)
+if VERIFY_MODE == "off":
+    if generation_node != critic_node:
+        workflow.add_edge(generation_node, critic_node)
+    workflow.add_conditional_edges(critic_node, evaluate_quality_decider, {
+        "re_gen": generation_node,
+        "human_check": "human_review",
+    })
+elif generation_node != critic_node:
+    workflow.add_edge(generation_node, "local_verification")
+    workflow.add_conditional_edges("local_verification", local_verification_decider, {
+        "re_gen": generation_node,
+        "verified": critic_node,
+    })
+    workflow.add_conditional_edges(critic_node, evaluate_quality_decider, {
+        "re_gen": generation_node,
+        "human_check": "human_review",
+    })
+else:
+    workflow.add_conditional_edges(critic_node, evaluate_quality_decider, {
+        "re_gen": generation_node,
+        "human_check": "local_verification",
+    })
+    workflow.add_conditional_edges("local_verification", local_verification_decider, {
+        "re_gen": generation_node,
+        "verified": "human_review",
+    })
+if REVIEW_MODE == "queue":
+    workflow.add_conditional_edges("human_review", review_queue_decider, {
+        "re_gen": generation_node,
+        "send_file": "sender",
+        "next_file": "analyze_next_file",
+    })
+else:
+    workflow.add_conditional_edges("human_review", human_review_decider, {
+        "re_gen": generation_node,
+        "send_file": "sender",
+    })
 workflow.add_edge("sender", "receiver")
 workflow.add_conditional_edges("receiver", message_type_decider, {
-    "compilation_error": "generate",
-    "execution_error": "generate",
+    "compilation_error": generation_node,
+    "execution_error": generation_node,
     "logs": "handle_logs"
 })
 workflow.add_conditional_edges("handle_logs", has_finished_all_files_decider, {
     "next_file": "analyze_next_file",
+    "pending_reviews": "human_review",
     "no_more_file": END
 })
 
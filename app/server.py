@@ -1,6 +1,11 @@
-from fastapi import FastAPI
+import difflib
+
+from fastapi import FastAPI, HTTPException
 from fastapi.responses import RedirectResponse
 from langserve import add_routes
+from pydantic import BaseModel
+
+from app.cobol_enhancer import review_queue
 #from cobol_enhancer import chain as ubp_cobol_chain
 
 app = FastAPI()
@@ -11,6 +16,42 @@ async def redirect_root_to_docs():
     return RedirectResponse("/docs")
 
 
+class ReviewDecision(BaseModel):
+    decision: str
+    specific_demands: str = ""
+
+
+# Review queue, for reviewers working through the candidates parked by a workflow running with REVIEW_MODE=queue
+@app.get("/reviews")
+async def list_reviews():
+    return [{"ticket_id": ticket["ticket_id"], "filename": ticket["state"]["filename"],
+             "parked_at": ticket["parked_at"]} for ticket in review_queue.list_tickets()]
+
+
+@app.get("/reviews/{ticket_id}")
+async def get_review(ticket_id: str):
+    try:
+        ticket = review_queue.get_ticket(ticket_id)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Unknown review ticket: {ticket_id}")
+    parked = ticket["state"]
+    diff = difflib.unified_diff(parked["old_code"].splitlines(), parked["new_code"].splitlines(),
+                                fromfile=f"{parked['filename']} (original)", tofile=f"{parked['filename']} (new)",
+                                lineterm="")
+    return {**ticket, "diff": "\n".join(diff)}
+
+
+@app.post("/reviews/{ticket_id}")
+async def submit_review(ticket_id: str, review: ReviewDecision):
+    try:
+        review_queue.submit_decision(ticket_id, review.decision, review.specific_demands)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=409 if "already" in str(e) else 400, detail=str(e))
+    return {"ticket_id": ticket_id, "decision": review.decision}
+
+
 # Edit this to add the chain you want to add
 #add_routes(app, ubp_cobol_chain, path="/", playground_type="chat")
 
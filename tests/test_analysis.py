@@ -0,0 +1,98 @@
+from app.cobol_enhancer.analysis import SectionFinding, split_program, chunk_inputs, locate, use_map_reduce, \
+    flagged_sections
+from app.cobol_enhancer.prompts import generation_prompt
+from app.cobol_enhancer.structure import find_data_entries
+
+PROGRAM = """       IDENTIFICATION DIVISION.
+       PROGRAM-ID. PAY001.
+       DATA DIVISION.
+       FILE SECTION.
+       FD EMPLOYEE-FILE.
+       01 EMPLOYEE-RECORD.
+          05 EMP-PAY PIC 9(5).
+       WORKING-STORAGE SECTION.
+      * Totals of the run
+       01 WS-TOTALS.
+          05 WS-TOTAL PIC 9(7).
+          05 FILLER PIC X(3).
+       77 WS-EOF PIC X VALUE 'N'.
+       PROCEDURE DIVISION.
+       MAIN-PARA.
+           PERFORM READ-EMPLOYEE UNTIL WS-EOF = 'Y'.
+           STOP RUN.
+       READ-EMPLOYEE.
+           READ EMPLOYEE-FILE
+               AT END MOVE 'Y' TO WS-EOF.
+       CALC-TOTAL.
+           ADD EMP-PAY TO WS-TOTAL.
+           ADD BONUS-AMOUNT TO WS-TOTAL.
+           DISPLAY WS-TOTAL."""
+
+COPYBOOKS = {
+    "BONUSCPY": "       01 BONUS-RECORD.\n          05 BONUS-AMOUNT PIC 9(5).",
+    "DATECPY": "       01 WS-DATE PIC 9(8).",
+}
+
+
+def test_find_data_entries():
+    """
+    Test that the data division is split into its file descriptions, records and 77 items, with the names they
+    define and without the comments.
+    """
+    entries = find_data_entries(PROGRAM.split("\n"))
+    assert [sorted(entry.names) for entry in entries] == [
+        ["EMPLOYEE-FILE"], ["EMP-PAY", "EMPLOYEE-RECORD"], ["WS-TOTAL", "WS-TOTALS"], ["WS-EOF"]]
+    assert "Totals of the run" not in entries[2].text
+
+
+def test_split_program():
+    """
+    Test that the divisions before the procedure division are split by lines, and the procedure division by
+    groups of whole paragraphs.
+    """
+    chunks = split_program(PROGRAM.split("\n"), chunk_lines=6)
+    assert [(chunk.start, chunk.end, [paragraph.name for paragraph in chunk.paragraphs]) for chunk in chunks] == [
+        (0, 6, []), (6, 12, []), (12, 13, []),
+        (13, 17, ["MAIN-PARA"]), (17, 20, ["READ-EMPLOYEE"]), (20, 24, ["CALC-TOTAL"])]
+    assert chunks[-1].location == "CALC-TOTAL (lines 21-24)"
+
+
+def test_chunk_inputs_relevant_definitions():
+    """
+    Test that a part of the procedure division is given only the data definitions and copybooks it uses.
+    """
+    lines = PROGRAM.split("\n")
+    chunk = split_program(lines, chunk_lines=6)[-1]
+    inputs = chunk_inputs("PAY001.cob", lines, chunk, COPYBOOKS)
+    assert "EMPLOYEE-RECORD" in inputs["definitions"] and "WS-TOTALS" in inputs["definitions"]
+    assert "WS-EOF" not in inputs["definitions"] and "EMPLOYEE-FILE" not in inputs["definitions"]
+    assert "BONUSCPY" in inputs["copybooks"] and "DATECPY" not in inputs["copybooks"]
+
+
+def test_locate_and_mode():
+    """
+    Test that a finding is located at the lines of the paragraph it names, or of its part when the name is
+    unknown, and that the auto mode only maps and reduces large programs.
+    """
+    lines = PROGRAM.split("\n")
+    chunk = split_program(lines, chunk_lines=20)[-1]
+    finding = SectionFinding(paragraph="read-employee.", severity="low", issue="", recommendation="")
+    assert locate(finding, chunk) == "READ-EMPLOYEE (lines 18-20)"
+    assert locate(finding.copy(update={"paragraph": "MISSING"}), chunk) == chunk.location
+    assert not use_map_reduce(100, "auto") and use_map_reduce(5000, "auto") and use_map_reduce(10, "map_reduce")
+
+
+def test_generation_targets_flagged_sections():
+    """
+    Test that the first generation is given the parts of the program the findings are located in, once each.
+    """
+    findings = [
+        {"location": "CALC-TOTAL (lines 24-27)", "severity": "high", "issue": "", "recommendation": ""},
+        {"location": "READ-EMPLOYEE (lines 18-20)", "severity": "medium", "issue": "", "recommendation": ""},
+        {"location": "CALC-TOTAL (lines 24-27)", "severity": "low", "issue": "", "recommendation": ""},
+    ]
+    assert flagged_sections(findings) == "- CALC-TOTAL (lines 24-27) (high)\n- READ-EMPLOYEE (lines 18-20) (medium)"
+
+    critic = {"description": "Two issues.", "grade": "bad"}
+    assert "{flagged_sections}" in generation_prompt({"original_critic": critic, "analysis_findings": findings})
+    assert "{flagged_sections}" not in generation_prompt({"original_critic": critic, "analysis_findings": []})
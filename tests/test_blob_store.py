@@ -0,0 +1,51 @@
+from app.cobol_enhancer.blob_store import BlobStore, is_blob_ref
+
+
+def test_blob_store_spill_and_collect(tmp_path):
+    """
+    Test that blobs over the memory budget are spilled to disk, read back, and dropped by the collection.
+    """
+    store = BlobStore(spill_dir=str(tmp_path), spill_threshold=1000, memory_budget=50)
+
+    small = store.put("       MOVE A TO B.\n")
+    large = store.put("       DISPLAY 'X'.\n" * 100)
+    assert is_blob_ref(small) and is_blob_ref(large)
+    assert store.put("       MOVE A TO B.\n") == small
+    assert store.put(small) == small
+    assert store.put("") == ""
+
+    # The large blob went straight to disk and is read back through mmap
+    assert len(list(tmp_path.iterdir())) == 1
+    assert store.get(large) == "       DISPLAY 'X'.\n" * 100
+    assert store.get(small) == "       MOVE A TO B.\n"
+    assert store.get("plain text") == "plain text"
+
+    store.collect([small])
+    assert list(tmp_path.iterdir()) == []
+    assert store.get(small) == "       MOVE A TO B.\n"
+
+
+def test_blob_store_spill_dir_shared_between_runs(tmp_path):
+    """
+    Test that blobs stay in memory within the budget, and that a collection only removes from disk the spilled
+    blobs no other run has registered.
+    """
+    first = BlobStore(spill_dir=str(tmp_path), spill_threshold=100, memory_budget=1000)
+    second = BlobStore(spill_dir=str(tmp_path), spill_threshold=100, memory_budget=1000)
+    first.owner, second.owner = "run-1", "run-2"
+
+    program = first.put("       PROCEDURE DIVISION.\n")
+    assert list(tmp_path.iterdir()) == []
+
+    large = "       01 EMP-RECORD.\n" * 10
+    first.put(large)
+    assert (tmp_path / "live" / "run-1.json").exists()
+    # The other run spills the same copybook
+    copybook = second.put(large)
+    first.collect([program])
+    assert second.get(copybook) == large
+
+    second.release("run-2")
+    first.collect([program])
+    assert first.get(program) == "       PROCEDURE DIVISION.\n"
+    assert not (tmp_path / copybook[len("blob:sha256:"):]).exists()
@@ -0,0 +1,84 @@
+import os
+import re
+import subprocess
+import sys
+
+from app.cobol_enhancer.cli import main, resolve_files
+from app.cobol_enhancer.results_store import ResultsStore
+
+# Libraries that must only be imported on the paths that use them
+HEAVY_MODULES = ["langchain_openai", "langchain_anthropic", "langchain.hub", "openai", "numpy", "plotly", "networkx",
+                 "graphviz", "readline"]
+# Import time of the command line entry point, in seconds: well above its usual time, far below the full workflow
+CLI_IMPORT_BUDGET = 1.0
+
+
+def run_python(code, *options):
+    environment = {key: value for key, value in os.environ.items() if key != "OPENAI_API_KEY"}
+    return subprocess.run([sys.executable, *options, "-c", code], capture_output=True, text=True, check=True,
+                          env=environment, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def test_workflow_import_is_light():
+    """
+    Test that importing the workflow doesn't import the model clients, plotting libraries or readline, and
+    doesn't need an API key.
+    """
+    output = run_python("import sys, app.cobol_enhancer.workflow; print(' '.join(sorted(sys.modules)))")
+    loaded = set(output.stdout.split())
+    assert [module for module in HEAVY_MODULES if module in loaded] == []
+
+
+def test_cli_import_time():
+    """
+    Test that the command line entry point imports within its budget, without LangChain or LangGraph.
+    """
+    output = run_python("import sys, app.cobol_enhancer.cli; print(' '.join(sorted(sys.modules)))", "-X",
+                        "importtime")
+    loaded = set(output.stdout.split())
+    assert "langgraph" not in loaded and "langchain_core" not in loaded
+    cumulative = re.search(r"\|\s*(\d+) \| app\.cobol_enhancer\.cli$", output.stderr, re.MULTILINE)
+    assert int(cumulative.group(1)) / 1e6 < CLI_IMPORT_BUDGET
+
+
+def test_resolve_files(tmp_path, monkeypatch):
+    """
+    Test that files are found as given or in the input directory, and that missing ones are left out.
+    """
+    (tmp_path / "PAY001.cbl").write_text("")
+    monkeypatch.setattr("app.cobol_enhancer.cli.INPUT_DIR", str(tmp_path))
+    assert resolve_files(["PAY001.cbl", str(tmp_path / "PAY001.cbl"), "MISSING.cbl"]) == [
+        str(tmp_path / "PAY001.cbl"), str(tmp_path / "PAY001.cbl")]
+
+
+def test_unfinished_files(tmp_path):
+    """
+    Test that the files of the latest unfinished run without an accepted output are the ones resumed.
+    """
+    store = ResultsStore(str(tmp_path / "results.db"))
+    store.start_run("run1", ["data/input/A.cbl", "data/input/B.cbl"])
+    store.finish_run("run1")
+    assert store.unfinished_files() == (None, [])
+
+    store.start_run("run2", ["data/input/C.cbl", "data/input/D.cbl"])
+    store.connection.execute(
+        "INSERT INTO outputs (run_id, program, source_path, output_path, old_sha256, new_sha256, iterations, "
+        "accepted_at) VALUES ('run2', 'C.cbl', 'data/input/C.cbl', 'data/output/C.cbl', '', '', 1, 0)")
+    assert store.unfinished_files() == ("run2", ["data/input/D.cbl"])
+    # A finished run can still be resumed explicitly
+    assert store.unfinished_files("run1") == ("run1", ["data/input/A.cbl", "data/input/B.cbl"])
+    store.close()
+
+
+def test_plan_command(tmp_path, capsys, monkeypatch):
+    """
+    Test that the plan command estimates the given files.
+    """
+    # The planner reads the past iterations from the results store of the working directory
+    monkeypatch.chdir(tmp_path)
+    program = tmp_path / "PAY001.cbl"
+    program.write_text("       IDENTIFICATION DIVISION.\n       PROGRAM-ID. PAY001.\n")
+    assert main(["plan", str(program)]) == 0
+    assert "Total for 1 file(s)" in capsys.readouterr().out
+    # The dry run doesn't create the results store
+    assert not (tmp_path / "data" / "output" / "results.db").exists()
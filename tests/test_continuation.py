@@ -0,0 +1,81 @@
+from typing import List
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from app.cobol_enhancer.utils import generate_code, merge_at_seam, remaining_original_code
+
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    Answers with the given outputs in turn, each with its finish reason, and keeps the prompts it was sent.
+    """
+    outputs: List[tuple]
+    prompts: List[str] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def _generate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        self.prompts.append("\n".join(message.content for message in messages))
+        text, finish_reason = self.outputs[len(self.prompts) - 1]
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text),
+                                                      generation_info={"finish_reason": finish_reason})])
+
+
+def test_continuation_with_tail():
+    """
+    Test that a cut-off generation is continued from the tail of its output, without the whole context and
+    without duplicating the lines repeated at the seam.
+    """
+    old_code = "\n".join(f"       DISPLAY 'LINE {i}'." for i in range(1, 7))
+    model = ScriptedChatModel(outputs=[
+        ("```cobol\n       DISPLAY 'LINE 1'.\n       DISPLAY 'LINE 2'.\n       DISPLAY 'LINE 3'.\n       DISP", "length"),
+        ("       DISPLAY 'LINE 3'.\n       DISPLAY 'LINE 4'.\n       DISPLAY 'LINE 5'.\n       DISPLAY 'LINE 6'.\n```",
+         "stop"),
+    ], prompts=[])
+
+    code = generate_code("Refine this code:\n{old_code}", model, {"old_code": old_code, "critic": "Add comments."})
+
+    assert code == old_code
+    continuation = model.prompts[1]
+    assert "Add comments." in continuation
+    # Only what is left of the original code is sent again
+    assert "DISPLAY 'LINE 4'" in continuation and "DISPLAY 'LINE 1'" not in continuation.split("output so far")[0]
+
+
+def test_continuation_keeps_generation_rules():
+    """
+    Test that a continuation is given the formatting rules of the generation and the fields of the copybooks.
+    """
+    old_code = "\n".join(f"       DISPLAY 'LINE {i}'." for i in range(1, 4))
+    model = ScriptedChatModel(outputs=[
+        ("```cobol\n       DISPLAY 'LINE 1'.\n       DISP", "length"),
+        ("       DISPLAY 'LINE 2'.\n       DISPLAY 'LINE 3'.\n```", "stop"),
+    ], prompts=[])
+    copybooks = "Copybook: EMPREC.cpy, Content: \n       01 EMP-RECORD.\n           05 EMP-ID PIC 9(5).\n"
+
+    generate_code("Refine this code:\n{old_code}", model, {"old_code": old_code, "copybooks": copybooks})
+
+    continuation = model.prompts[1]
+    assert "Columns 1 to 6" in continuation and "never write line numbers" in continuation
+    assert "termination method" in continuation and "don't remove existing comments" in continuation
+    assert "area A" in continuation and "area B" in continuation
+    assert "EMP-RECORD, EMP-ID" in continuation
+
+
+def test_seam_and_remaining_code():
+    """
+    Test the de-duplication of the seam and the location of the tail in the original code.
+    """
+    assert merge_at_seam(["A", "B", "C"], ["B", "C", "D"]) == ["A", "B", "C", "D"]
+    assert merge_at_seam(["A", "B"], ["C"]) == ["A", "B", "C"]
+    # An overlap made only of blank lines and scope terminators is kept
+    assert merge_at_seam(["A", "      END-IF.", ""], ["END-IF.", "", "C"]) == \
+           ["A", "      END-IF.", "", "END-IF.", "", "C"]
+    assert merge_at_seam(["A", "END-PERFORM."], ["END-PERFORM.", "B"]) == ["A", "END-PERFORM.", "END-PERFORM.", "B"]
+    assert merge_at_seam(["A", "B", "END-IF.", "C"], ["B", "END-IF.", "C", "D"]) == ["A", "B", "END-IF.", "C", "D"]
+    assert remaining_original_code("A\nB\nC\nD", ["X", "B"]) == "C\nD"
+    assert remaining_original_code("A\nB", ["Z"]) == "A\nB"
@@ -0,0 +1,123 @@
+import os
+import time
+
+from app.cobol_enhancer import dependencies
+from app.cobol_enhancer.dependencies import DependencyGraph, copybook_impact, parse_dependencies
+from app.cobol_enhancer.inventory import SourceInventory
+from app.cobol_enhancer.results_store import ResultsStore
+
+
+def write_program(directory, name, *body):
+    path = directory / name
+    path.write_text("\n".join(["       IDENTIFICATION DIVISION.", f"       PROGRAM-ID. {path.stem}."] + list(body)))
+    return str(path)
+
+
+def make_tree(tmp_path, monkeypatch):
+    # Copybooks are looked up in data/input/copy/ of the working directory
+    monkeypatch.chdir(tmp_path)
+    input_dir = tmp_path / "data" / "input"
+    (input_dir / "copy").mkdir(parents=True)
+    (input_dir / "copy" / "EMPREC.cpy").write_text("       01 EMP-RECORD.\n       COPY DATEREC.\n")
+    (input_dir / "copy" / "DATEREC.cpy").write_text("       05 EMP-DATE PIC 9(8).\n")
+    files = [
+        write_program(input_dir, "PAY001.cbl", "           CALL 'PAYCALC' USING WS-PAY."),
+        write_program(input_dir, "PAYCALC.cbl", "           DISPLAY 'CALC'."),
+        write_program(input_dir, "EMP001.cbl", "       COPY EMPREC."),
+        write_program(input_dir, "RPT001.cbl", "       COPY DATEREC."),
+        write_program(input_dir, "MISC01.cbl", "           DISPLAY 'ALONE'."),
+    ]
+    inventory = SourceInventory(root=str(input_dir), cache_path=None)
+    return files, DependencyGraph(inventory, cache_path=str(tmp_path / "deps.json"))
+
+
+def test_parse_dependencies():
+    """
+    Test that the static calls, copybooks, SQL includes, external files and DB2 tables are found, but not in the
+    comment lines.
+    """
+    code = "\n".join([
+        "       PROGRAM-ID. PAY001.",
+        "           SELECT EMP-FILE ASSIGN TO EMPDD.",
+        "           COPY PAYCPY.",
+        "      *    COPY OLDCPY.",
+        "           CALL 'PAYCALC' USING WS-PAY.",
+        "           CALL WS-PROGRAM.",
+        "           EXEC SQL INCLUDE SQLCA END-EXEC.",
+        "           EXEC SQL INCLUDE DCLEMP END-EXEC.",
+        "           EXEC SQL SELECT NAME INTO :WS-NAME FROM HR.EMPLOYEE",
+        "               WHERE ID = :WS-ID END-EXEC.",
+    ])
+    assert parse_dependencies(code) == {
+        "program_id": "PAY001", "calls": ["PAYCALC"], "copybooks": ["DCLEMP", "PAYCPY"], "files": ["EMPDD"],
+        "tables": ["HR.EMPLOYEE"],
+    }
+
+
+def test_clusters(tmp_path, monkeypatch):
+    """
+    Test that a program is clustered with the programs it calls and with those sharing a copybook, also through
+    a nested COPY, in the given order.
+    """
+    files, graph = make_tree(tmp_path, monkeypatch)
+    pay, paycalc, emp, rpt, misc = files
+    assert graph.clusters([emp, pay, misc, rpt, paycalc]) == [[emp, rpt], [pay, paycalc], [misc]]
+    assert graph.program(emp)["copybooks"] == ["DATEREC", "EMPREC"]
+
+
+def test_cache_and_dependents(tmp_path, monkeypatch):
+    """
+    Test that the dependencies are read back from the cache until a file changes, and that the programs using a
+    copybook are found through the nested copybooks.
+    """
+    files, graph = make_tree(tmp_path, monkeypatch)
+    assert graph.dependents(["DATEREC.cpy"]) == [files[2], files[3]]
+
+    def fail(path):
+        raise AssertionError(f"{path} parsed again")
+
+    monkeypatch.setattr(dependencies, "read_source", fail)
+    cached = DependencyGraph(graph.inventory, cache_path=graph.cache_path)
+    assert cached.dependents(["EMPREC"]) == [files[2]]
+
+    monkeypatch.undo()
+    monkeypatch.chdir(tmp_path)
+    write_program(tmp_path / "data" / "input", "MISC01.cbl", "       COPY EMPREC.")
+    assert cached.dependents(["EMPREC"]) == [files[2], files[4]]
+
+
+def test_clusters_limits(tmp_path, monkeypatch):
+    """
+    Test that a copybook used by most programs doesn't group them, and that a cluster stops growing at its
+    maximum size.
+    """
+    files, graph = make_tree(tmp_path, monkeypatch)
+    pay, paycalc, emp, rpt, misc = files
+    for path in files:
+        with open(path, "a") as file:
+            file.write("\n       COPY COMMON.")
+    assert graph.clusters(files, max_shared_users=3) == [[pay, paycalc], [emp, rpt], [misc]]
+    assert graph.clusters(files, max_shared_users=5, max_size=2) == [[pay, paycalc], [emp, rpt], [misc]]
+    assert graph.clusters(files, max_shared_users=5, max_size=5) == [files]
+
+
+def test_copybook_impact_exact_program(tmp_path, monkeypatch):
+    """
+    Test that the last output of a program is looked up by its exact name, not as a pattern matching the more
+    recent outputs of other programs.
+    """
+    files, graph = make_tree(tmp_path, monkeypatch)
+    write_program(tmp_path / "data" / "input", "EMP_01.cbl", "       COPY EMPREC.")
+    monkeypatch.setattr(dependencies, "_dependency_graph", DependencyGraph(graph.inventory, cache_path=None))
+    store = ResultsStore(str(tmp_path / "results.db"))
+    for program, accepted_at in (("EMP_01.cbl", 100.0), ("EMPX01.cbl", time.time() + 60)):
+        store.record_output({"run_id": "run", "filename": program, "old_code": "OLD", "new_code": "NEW",
+                             "critic": {"description": "", "grade": "good"}, "atlas_answer": ""},
+                            f"data/input/{program}", f"data/output/{program}")
+        store.connection.execute("UPDATE outputs SET accepted_at = ? WHERE program = ?", (accepted_at, program))
+
+    impact = {os.path.basename(entry["path"]): entry for entry in copybook_impact(["EMPREC"], store)}
+    store.close()
+    assert impact["EMP_01.cbl"]["accepted_at"] == 100.0
+    assert impact["EMP_01.cbl"]["changed"] == ["EMPREC"]
+    assert impact["EMP001.cbl"]["accepted_at"] is None
@@ -0,0 +1,43 @@
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from app.cobol_enhancer.evals import Cassette, ReplayChatModel, similarity, find_regressions
+
+
+def test_replay_model(tmp_path):
+    """
+    Test that the replay model answers recorded requests from the cassette, with their token usage and latency,
+    and refuses the others.
+    """
+    cassette = Cassette(str(tmp_path / "cassette.json"))
+    model = ReplayChatModel(model="gpt-3.5-turbo", temperature=0, cassette=cassette, mode="replay",
+                            openai_api_key="replay")
+    messages = [HumanMessage(content="Analyze PAY001")]
+    result = ChatResult(generations=[ChatGeneration(message=AIMessage(content="The program is fine."))],
+                        llm_output={"token_usage": {"prompt_tokens": 12, "completion_tokens": 5}})
+    cassette.put(model.request_key(messages), ReplayChatModel._to_entry(result, 1.5))
+    cassette.merge_and_save(cassette.recorded)
+
+    model.cassette = Cassette(str(tmp_path / "cassette.json"))
+    replayed = model.generate([messages])
+    assert replayed.generations[0][0].text == "The program is fine."
+    assert replayed.llm_output["token_usage"]["prompt_tokens"] == 12
+    assert replayed.generations[0][0].generation_info["recorded_latency"] == 1.5
+
+    with pytest.raises(KeyError):
+        model.invoke([HumanMessage(content="Analyze ACC001")])
+
+
+def test_scoring_and_regressions():
+    """
+    Test the similarity score and the detection of regressions between two evaluations.
+    """
+    assert similarity("       MOVE A TO B.\n\n       STOP RUN.", "move a to b.\n stop run.") == 1.0
+    assert similarity("       MOVE A TO B.", "       STOP RUN.") == 0.0
+
+    previous = {"score": 0.9, "acceptance_rate": 1.0, "prompt_tokens": 1000, "completion_tokens": 400,
+                "latency": 10.0, "iterations_to_accept": 1.5}
+    assert find_regressions(dict(previous, prompt_tokens=1050), previous) == []
+    regressions = find_regressions(dict(previous, prompt_tokens=1500, score=0.7), previous)
+    assert len(regressions) == 2 and regressions[0].startswith("score dropped")
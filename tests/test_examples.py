@@ -0,0 +1,92 @@
+import numpy as np
+
+from app.cobol_enhancer.examples import ExampleIndex, split_paragraphs, paragraph_pairs
+
+OLD_CODE = """       IDENTIFICATION DIVISION.
+       PROGRAM-ID. PAY001.
+       PROCEDURE DIVISION.
+       MAIN-PARA.
+           PERFORM READ-EMPLOYEE.
+           STOP RUN.
+       READ-EMPLOYEE.
+           READ EMPLOYEE-FILE
+               AT END MOVE 'Y' TO WS-EOF.
+       CALC-TOTAL SECTION.
+           ADD WS-PAY TO WS-TOTAL."""
+
+NEW_CODE = OLD_CODE.replace("""           READ EMPLOYEE-FILE
+               AT END MOVE 'Y' TO WS-EOF.""", """      * Read the next employee, flag the end of the file
+           READ EMPLOYEE-FILE
+               AT END MOVE 'Y' TO WS-EOF
+           END-READ.""")
+
+VOCABULARY = ["READ", "ADD", "PERFORM", "MOVE", "DISPLAY"]
+
+
+def bag_of_words(texts):
+    # Stand-in for the embedding model: counts of a few COBOL verbs
+    return [[text.count(word) for word in VOCABULARY] for text in texts]
+
+
+def test_split_paragraphs():
+    """
+    Test that the procedure division is split at the paragraph and section headers in area A.
+    """
+    paragraphs = split_paragraphs(OLD_CODE)
+    assert [name for name, _ in paragraphs] == ["MAIN-PARA", "READ-EMPLOYEE", "CALC-TOTAL"]
+    assert paragraphs[1][1].splitlines()[0].strip() == "READ-EMPLOYEE."
+    assert split_paragraphs("       IDENTIFICATION DIVISION.\n       PROGRAM-ID. X.") == []
+
+
+def test_paragraph_pairs():
+    """
+    Test that only the changed paragraphs are paired.
+    """
+    pairs = paragraph_pairs(OLD_CODE, NEW_CODE)
+    assert [name for name, _, _ in pairs] == ["READ-EMPLOYEE"]
+    assert "END-READ" in pairs[0][2] and "END-READ" not in pairs[0][1]
+
+
+def test_example_index(tmp_path):
+    """
+    Test that pairs are embedded once, persisted, and retrieved by similarity within the token budget.
+    """
+    calls = []
+
+    def embedder(texts):
+        calls.append(len(texts))
+        return bag_of_words(texts)
+
+    index = ExampleIndex(str(tmp_path), embedder=embedder, batch_size=2)
+    pairs = [("READ-A", "READ FILE-A.", "READ FILE-A END-READ."),
+             ("ADD-B", "ADD 1 TO B.", "ADD 1 TO B END-ADD."),
+             ("SHOW-C", "DISPLAY C.", "DISPLAY 'C: ' C.")]
+    assert index.add("PAY001.cbl", pairs) == 3
+    assert calls == [2, 1]
+    assert index.add("PAY001.cbl", pairs[:1]) == 0
+
+    reloaded = ExampleIndex(str(tmp_path), embedder=embedder)
+    assert len(reloaded) == 3
+    assert np.allclose(np.linalg.norm(reloaded.embeddings, axis=1), 1)
+
+    examples = reloaded.search(OLD_CODE.replace("ADD WS-PAY TO WS-TOTAL", "MOVE WS-PAY TO WS-TOTAL"))
+    assert [example["paragraph"] for example in examples] == ["READ-A"]
+    assert reloaded.search(OLD_CODE, token_budget=0) == []
+
+
+def test_example_index_concurrent_adds(tmp_path):
+    """
+    Test that runs adding to the same index from stale copies keep every example with its own embedding.
+    """
+    first = ExampleIndex(str(tmp_path), embedder=bag_of_words)
+    second = ExampleIndex(str(tmp_path), embedder=bag_of_words)
+    pairs = paragraph_pairs(OLD_CODE, NEW_CODE)
+    assert first.add("PAY001.cbl", pairs) == 1
+    assert second.add("PAY001.cbl", pairs) == 0
+    assert second.add("ACC001.cbl", [("CALC-TOTAL", "           ADD WS-PAY TO WS-TOTAL.",
+                                      "           ADD WS-PAY TO WS-TOTAL ROUNDED.")]) == 1
+    assert first.add("RPT001.cbl", [("MAIN-PARA", "           PERFORM MAIN.", "           PERFORM MAIN-LOOP.")]) == 1
+
+    index = ExampleIndex(str(tmp_path), embedder=bag_of_words)
+    assert [example["program"] for example in index.examples] == ["PAY001.cbl", "ACC001.cbl", "RPT001.cbl"]
+    assert np.allclose(index.embeddings, index.embed([example["before"] for example in index.examples]))
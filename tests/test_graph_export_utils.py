@@ -0,0 +1,42 @@
+from app.cobol_enhancer.graph_export_utils import summarize_trace
+
+
+def test_summarize_trace():
+    """
+    Test that a run trace is aggregated into per-node times and per-edge traversal counts.
+    """
+    def timings(*steps):
+        return [{"node": node, "started_at": index, "duration": duration}
+                for index, (node, duration) in enumerate(steps)]
+
+    trace = {
+        "PAY001.cob": timings(("analyze_next_file", 2.0), ("generate", 5.0), ("critic_generation", 3.0),
+                              ("generate", 4.0), ("critic_generation", 1.0), ("human_review", 1.0)),
+        "ACC001.cob": timings(("analyze_next_file", 1.0), ("generate", 3.0), ("critic_generation", 2.0)),
+    }
+
+    node_stats, edge_counts = summarize_trace(trace)
+    assert node_stats["generate"] == {"total": 12.0, "count": 3, "mean": 4.0}
+    assert edge_counts[("critic_generation", "generate")] == 1
+    assert edge_counts[("generate", "critic_generation")] == 3
+    # Nodes of different files are not chained
+    assert ("human_review", "analyze_next_file") not in edge_counts
+
+
+def test_summarize_full_file_cycle():
+    """
+    Test that the trace of a run covers a whole file cycle: the edges into and out of handle_logs are traversed,
+    including the one to the analysis of the next file.
+    """
+    cycle = ["analyze_next_file", "generation", "critic", "human_review", "sender", "receiver", "handle_logs"]
+    trace = {
+        "PAY001.cob": [{"node": node, "started_at": index, "duration": 1.0}
+                       for index, node in enumerate(["process_directory"] + cycle)],
+        "ACC001.cob": [{"node": node, "started_at": 10 + index, "duration": 1.0} for index, node in enumerate(cycle)],
+    }
+
+    node_stats, edge_counts = summarize_trace(trace)
+    assert node_stats["handle_logs"]["count"] == 2
+    assert edge_counts[("process_directory", "analyze_next_file")] == 1
+    assert edge_counts[("receiver", "handle_logs")] == 2
+    assert edge_counts[("handle_logs", "analyze_next_file")] == 1
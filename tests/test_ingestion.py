@@ -0,0 +1,61 @@
+from app.cobol_enhancer.ingestion import read_source, restore_sequence_areas, encode_source, detect_encoding
+
+SOURCE = [
+    "000100 IDENTIFICATION DIVISION.".ljust(72) + "PAY00010",
+    "000200 PROGRAM-ID. PAY001.".ljust(72) + "PAY00020",
+    "000300 PROCEDURE DIVISION.".ljust(72) + "PAY00030",
+    "000400     DISPLAY 'HELLO'.".ljust(72) + "PAY00040",
+    "000500     STOP RUN.".ljust(72) + "PAY00050",
+]
+
+
+def test_ebcdic_records_round_trip(tmp_path):
+    """
+    Test that fixed-length EBCDIC records are detected, decoded and stripped of their sequence areas, and that
+    the areas, encoding and records are restored on a modified version.
+    """
+    path = tmp_path / "PAY001.cob"
+    path.write_bytes("".join(SOURCE).encode("cp1047"))
+
+    source = read_source(str(path), encoding="auto")
+    assert detect_encoding(path.read_bytes()) == "cp037"
+    assert source.layout["record_length"] == 80
+    assert source.text.splitlines()[0] == "       IDENTIFICATION DIVISION."
+    assert "PAY000" not in source.text and "000100" not in source.text
+
+    # Unchanged lines are restored as they were
+    assert encode_source(restore_sequence_areas(source.text, source.sequence_areas, source.text),
+                         dict(source.layout, encoding="cp1047")) == path.read_bytes()
+
+    lines = source.text.split("\n")
+    new_text = "\n".join(lines[:3] + ["           DISPLAY 'WORLD'."] + lines[3:])
+    restored = restore_sequence_areas(source.text, source.sequence_areas, new_text).split("\n")
+    assert restored[2] == SOURCE[2]
+    assert restored[3] == "           DISPLAY 'WORLD'."
+    assert restored[4] == SOURCE[3]
+
+
+def test_free_format_untouched(tmp_path):
+    """
+    Test that sources without sequence areas are read as is.
+    """
+    path = tmp_path / "FREE.cob"
+    path.write_text("       IDENTIFICATION DIVISION.\n       PROGRAM-ID. FREE.\n")
+
+    source = read_source(str(path))
+    assert source.text == "       IDENTIFICATION DIVISION.\n       PROGRAM-ID. FREE."
+    assert source.layout["encoding"] == "utf-8" and not source.layout["fixed_format"]
+    assert restore_sequence_areas(source.text, source.sequence_areas, "X") == "X"
+
+
+def test_free_format_from_column_one_untouched(tmp_path):
+    """
+    Test that free-format code written from column 1 is not taken for sequence areas and cut.
+    """
+    path = tmp_path / "FREE.cob"
+    text = "IDENTIFICATION DIVISION.\nPROGRAM-ID. FREE.\nPROCEDURE DIVISION.\n    DISPLAY 'FREE'.\n    STOP RUN."
+    path.write_text(text + "\n")
+
+    source = read_source(str(path))
+    assert source.text == text
+    assert not source.layout["fixed_format"] and source.sequence_areas == ""
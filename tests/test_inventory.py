@@ -0,0 +1,70 @@
+import os
+import threading
+
+from app.cobol_enhancer.inventory import SourceInventory
+from app.cobol_enhancer.utils import write_atomic
+
+
+def make_tree(root, paths):
+    for path in paths:
+        full_path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w') as file:
+            file.write("       IDENTIFICATION DIVISION.\n")
+
+
+def test_inventory_scan_and_completion(tmp_path):
+    """
+    Test that the inventory only indexes the configured extensions and globs, and completes by prefix.
+    """
+    make_tree(tmp_path, ["PAY001.cob", "PAY002.CBL", "ACC001.cbl", "notes.txt", "copy/PAYREC.cpy",
+                         "old/PAY000.cob"])
+
+    inventory = SourceInventory(str(tmp_path), extensions=[".cob", ".cbl", ".CBL"], include=[],
+                                exclude=["old/*"], cache_path=str(tmp_path / "inventory.json"))
+
+    assert inventory.files() == ["ACC001.cbl", "PAY001.cob", "PAY002.CBL"]
+    assert inventory.complete("PAY") == ["PAY001.cob", "PAY002.CBL"]
+    assert inventory.complete("X") == []
+    assert "ACC001.cbl" in inventory
+
+
+def test_inventory_cache_invalidation(tmp_path):
+    """
+    Test that the cached index is reused by a new inventory and invalidated when the tree changes.
+    """
+    make_tree(tmp_path / "input", ["A.cob"])
+    cache_path = str(tmp_path / "inventory.json")
+
+    assert SourceInventory(str(tmp_path / "input"), [".cob"], [], [], cache_path).files() == ["A.cob"]
+
+    # A fresh inventory starts from the cache without scanning
+    cached = SourceInventory(str(tmp_path / "input"), [".cob"], [], [], cache_path)
+    assert cached._files == ["A.cob"]
+
+    make_tree(tmp_path / "input", ["sub/B.cob"])
+    assert cached.files() == ["A.cob", "sub/B.cob"]
+
+
+def test_concurrent_atomic_writes(tmp_path):
+    """
+    Test that concurrent writers of the same cache each use their own temporary file, so none of them fails and
+    no temporary file is left behind.
+    """
+    path = str(tmp_path / "cache" / ".dependencies.json")
+    errors = []
+
+    def write(index):
+        try:
+            for _ in range(50):
+                write_atomic(path, f"{index}" * 1000)
+        except OSError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(index,)) for index in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert os.listdir(tmp_path / "cache") == [".dependencies.json"]
@@ -0,0 +1,97 @@
+import json
+import subprocess
+import sys
+import time
+
+from app.cobol_enhancer import examples
+from app.cobol_enhancer.metrics import RouteStats, timed_node
+from app.cobol_enhancer.response_handlers import handle_logs
+from app.cobol_enhancer.results_store import ResultsStore, flush_node_timings
+
+
+def test_route_stats_merge_concurrent_saves(tmp_path):
+    """
+    Test that the statistics are read on first use and that each save adds its counts to those saved by another
+    process in the meantime instead of overwriting them.
+    """
+    path = str(tmp_path / "route_stats.json")
+    first, second = RouteStats(path), RouteStats(path)
+    assert not (tmp_path / "route_stats.json").exists()
+
+    first.record_outcome("generate:any:gpt-4", True)
+    second.record_outcome("generate:any:gpt-4", False)
+    second.record_call("generate:any:gpt-4", 2.0, {"prompt_tokens": 10, "completion_tokens": 5}, 0.1)
+    first.save()
+    second.save()
+    # Nothing new to add
+    first.save()
+
+    with open(path) as file:
+        route = json.load(file)["generate:any:gpt-4"]
+    assert (route["accepted"], route["rejected"], route["calls"], route["prompt_tokens"]) == (1, 1, 1, 10)
+    assert RouteStats(path).routes["generate:any:gpt-4"]["rejected"] == 1
+
+
+def test_route_stats_without_fcntl(tmp_path):
+    """
+    Test that the metrics can be imported and saved where fcntl doesn't exist (Windows), locking with msvcrt.
+    """
+    script = """
+import sys, types
+sys.modules["fcntl"] = None
+# The standard library takes the presence of msvcrt for Windows, so only the tool sees the stand-in
+import asyncio, subprocess, langchain_core.callbacks, app.cobol_enhancer.inventory
+msvcrt = types.ModuleType("msvcrt")
+msvcrt.LK_LOCK, msvcrt.LK_UNLCK, msvcrt.calls = 2, 0, []
+msvcrt.locking = lambda fd, mode, size: msvcrt.calls.append(mode)
+sys.modules["msvcrt"] = msvcrt
+from app.cobol_enhancer.metrics import RouteStats
+stats = RouteStats(sys.argv[1])
+stats.record_outcome("generate:any:gpt-4", True)
+stats.save()
+assert msvcrt.calls == [2, 0], msvcrt.calls
+"""
+    path = str(tmp_path / "route_stats.json")
+    subprocess.run([sys.executable, "-c", script, path], check=True)
+    assert RouteStats(path).routes["generate:any:gpt-4"]["accepted"] == 1
+
+
+def run_file_cycle(state, filename, handle_logs_node):
+    """
+    Runs the end of the processing of a file like the workflow: the analysis flushes the timings of the previous
+    file, a few nodes run, then handle_logs through its timing wrapper.
+    """
+    flush_node_timings(state)
+    state.update({
+        "files_to_process": [f"data/input/{filename}"], "filename": filename, "old_code": "       OLD.",
+        "new_code": "       NEW.", "critic": {"description": "Fine.", "grade": "good"}, "atlas_answer": "OK",
+    })
+    for node in ("analyze_next_file", "generate", "receiver"):
+        state["node_timings"] = state["node_timings"] + [{"node": node, "started_at": time.time(), "duration": 0.1}]
+    return handle_logs_node(state)
+
+
+def test_handle_logs_timing_recorded(tmp_path, monkeypatch):
+    """
+    Test that the timing of handle_logs, only known once it has recorded the output, is added to that output, and
+    that the timings before the first file go with the first one.
+    """
+    monkeypatch.chdir(tmp_path)
+    # No examples recorded from the outputs
+    monkeypatch.setattr(examples, "_example_index", None)
+    monkeypatch.setattr(examples, "_enabled", False)
+    handle = timed_node("handle_logs", handle_logs)
+    state = {"run_id": "run", "node_timings": [{"node": "process_directory", "started_at": time.time(),
+                                                "duration": 0.1}]}
+
+    state = run_file_cycle(state, "PAY001.cob", handle)
+    output_id = state["output_id"]
+    state = run_file_cycle(state, "ACC001.cob", handle)
+    flush_node_timings(state)
+
+    store = ResultsStore()
+    nodes = [timing["node"] for timing in store.output_details(output_id)["node_timings"]]
+    last_nodes = [timing["node"] for timing in store.output_details(state["output_id"])["node_timings"]]
+    store.close()
+    assert nodes == ["process_directory", "analyze_next_file", "generate", "receiver", "handle_logs"]
+    assert last_nodes == ["analyze_next_file", "generate", "receiver", "handle_logs"]
@@ -0,0 +1,24 @@
+from app.cobol_enhancer.planner import expected_iterations
+from app.cobol_enhancer.results_store import ResultsStore
+
+
+def record(store, program, iterations):
+    state = {"run_id": "run", "filename": program, "old_code": "OLD", "new_code": "NEW",
+             "critic": {"description": "", "grade": "good"}, "atlas_answer": "",
+             "iteration_history": [{"iteration": index + 1} for index in range(iterations)]}
+    store.record_output(state, f"data/input/{program}", f"data/output/{program}")
+
+
+def test_query_exact_program_and_pattern(tmp_path):
+    """
+    Test that a program is matched exactly, so that the SQL wildcards of its name don't pick up the history of
+    other programs, while the pattern of the command line still matches several programs.
+    """
+    store = ResultsStore(str(tmp_path / "results.db"))
+    record(store, "PAY_01.cbl", 1)
+    record(store, "PAYX01.cbl", 5)
+
+    assert [output["program"] for output in store.query(program="PAY_01.cbl")] == ["PAY_01.cbl"]
+    assert expected_iterations("PAY_01.cbl", store) == 1
+    assert len(store.query(program_pattern="PAY*")) == 2
+    store.close()
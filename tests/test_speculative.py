@@ -0,0 +1,33 @@
+import asyncio
+
+from app.cobol_enhancer import generation
+from app.cobol_enhancer.utils import run_coroutine
+
+
+def test_speculative_race_inside_event_loop(monkeypatch):
+    """
+    Test that the speculative race can be run from a thread already running an event loop, and that the losing
+    candidates are cancelled and awaited before it returns.
+    """
+    cancelled = []
+
+    async def candidate(state, index, temperature, template, variables):
+        if index == 0:
+            return index, "NEW CODE", {"description": "", "grade": "good"}
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(index)
+            raise
+
+    monkeypatch.setattr(generation, "_generate_and_critique", candidate)
+    monkeypatch.setattr(generation, "SPECULATIVE_CANDIDATES", 3)
+
+    async def race():
+        # The cancelled candidates must have stopped by the time the race returns
+        return (await generation._race_candidates({}, "", {}))[:2], sorted(cancelled)
+
+    async def handler():
+        return run_coroutine(race())
+
+    assert asyncio.run(handler()) == ((0, "NEW CODE"), [1, 2])
@@ -0,0 +1,52 @@
+import os
+import time
+
+from app.cobol_enhancer import response_handlers, transfer
+from app.cobol_enhancer.blob_store import put_text
+from app.cobol_enhancer.spool import SpoolCollector, PROCESSED_DIR
+from app.cobol_enhancer.transfer import TransferManager
+
+
+def test_spool_collects_matching_output(tmp_path):
+    """
+    Test that the output of a file is matched by job identifier before member name, and moved once collected.
+    """
+    since = time.time() - 1
+    (tmp_path / "PAY001.lst").write_text("IGYPS2121-S \"WS-X\" was not defined as a data-name.")
+    (tmp_path / "PAY001.JOB01234.txt").write_text("CEE3204S The system detected a protection exception.")
+    (tmp_path / "ACC001.lst").write_text("RETURN CODE 0")
+
+    collector = SpoolCollector(str(tmp_path), timeout=5, initial_interval=0.01, max_interval=0.05)
+    assert collector.collect("PAY001", "JOB01234", since).startswith("CEE3204S")
+    assert os.path.exists(tmp_path / PROCESSED_DIR / "PAY001.JOB01234.txt")
+    assert collector.collect("PAY001", None, since).startswith("IGYPS2121-S")
+
+
+def test_spool_timeout(tmp_path):
+    """
+    Test that the collector gives up after its timeout and ignores outputs older than the upload.
+    """
+    (tmp_path / "PAY001.lst").write_text("RETURN CODE 0")
+    os.utime(tmp_path / "PAY001.lst", (time.time() - 60, time.time() - 60))
+
+    collector = SpoolCollector(str(tmp_path), timeout=0.1, initial_interval=0.01, max_interval=0.05)
+    assert collector.collect("PAY001", None, since=time.time() - 1) is None
+
+
+def test_spool_matches_member_sent_with_extension(tmp_path, monkeypatch):
+    """
+    Test that the output of a file sent under its own name, extension included, is matched on the member name.
+    """
+    monkeypatch.setattr(response_handlers, "TRANSFER_MEMBER_NAMES", False)
+    manager = TransferManager(f"dir://{tmp_path / 'transfer'}", pool_size=1)
+    monkeypatch.setattr(transfer, "_transfer_manager", manager)
+    code = put_text("       DISPLAY 'PAY'.")
+    state = response_handlers.sender({"filename": "PAY-001.cob", "old_code": code, "new_code": code})
+    result = manager.wait(state["pending_transfers"][-1], timeout=5)
+    manager.close()
+    assert result.remote_name == "PAY-001.cob"
+
+    (tmp_path / "PAY-001.lst").write_text("RETURN CODE 0")
+    (tmp_path / "PAY-0012.lst").write_text("RETURN CODE 8")
+    collector = SpoolCollector(str(tmp_path), timeout=5, initial_interval=0.01, max_interval=0.05)
+    assert collector.collect(result.remote_name, result.job_id, result.submitted_at - 1) == "RETURN CODE 0"
@@ -0,0 +1,95 @@
+from langchain_core.prompts import ChatPromptTemplate
+
+from app.cobol_enhancer import generation
+from app.cobol_enhancer.generation import critic_diff_inputs
+from app.cobol_enhancer.prompts import critic_diff_prompt
+from app.cobol_enhancer.structure import find_paragraphs, structured_diff, summarize_structure
+
+PROGRAM = """       IDENTIFICATION DIVISION.
+       PROGRAM-ID. PAY001.
+       DATA DIVISION.
+       WORKING-STORAGE SECTION.
+       01 WS-TOTAL PIC 9(5).
+       PROCEDURE DIVISION.
+       MAIN-PARA.
+           PERFORM READ-EMPLOYEE.
+           PERFORM CALC-TOTAL.
+           STOP RUN.
+       READ-EMPLOYEE.
+           READ EMPLOYEE-FILE
+               AT END MOVE 'Y' TO WS-EOF.
+       CALC-TOTAL.
+           ADD WS-PAY TO WS-TOTAL.
+           DISPLAY WS-TOTAL."""
+
+
+def test_find_paragraphs():
+    """
+    Test that the paragraphs of the procedure division are located from their header to the next one.
+    """
+    paragraphs = find_paragraphs(PROGRAM.split("\n"))
+    assert [(paragraph.name, paragraph.start, paragraph.end) for paragraph in paragraphs] == [
+        ("MAIN-PARA", 6, 10), ("READ-EMPLOYEE", 10, 13), ("CALC-TOTAL", 13, 16)]
+
+
+def test_summarize_structure():
+    """
+    Test that the summary lists the divisions, sections and paragraphs, marking the highlighted ones.
+    """
+    summary = summarize_structure(PROGRAM, ["CALC-TOTAL"])
+    assert summary.splitlines() == [
+        "16 lines.",
+        "IDENTIFICATION DIVISION (line 1)",
+        "DATA DIVISION (line 3)",
+        "WORKING-STORAGE SECTION (line 4)",
+        "PROCEDURE DIVISION (line 6)",
+        "Paragraphs: MAIN-PARA (7-10), READ-EMPLOYEE (11-13), CALC-TOTAL* (14-16)",
+    ]
+
+
+def test_structured_diff():
+    """
+    Test that a change is shown with its whole paragraph when it is short, with context lines otherwise, and
+    that the hunks name the paragraphs they change.
+    """
+    new_program = PROGRAM.replace("           DISPLAY WS-TOTAL.", "           DISPLAY 'TOTAL: ' WS-TOTAL.")
+    diff, changed = structured_diff(PROGRAM, new_program, context=0)
+    assert changed == ["CALC-TOTAL"]
+    assert diff.splitlines() == [
+        "@@ -14,3 +14,3 @@ CALC-TOTAL",
+        "        CALC-TOTAL.",
+        "            ADD WS-PAY TO WS-TOTAL.",
+        "-           DISPLAY WS-TOTAL.",
+        "+           DISPLAY 'TOTAL: ' WS-TOTAL.",
+    ]
+
+    diff, _ = structured_diff(PROGRAM, new_program, context=0, paragraph_context=0)
+    assert diff.splitlines()[0] == "@@ -16,1 +16,1 @@ CALC-TOTAL"
+    assert structured_diff(PROGRAM, PROGRAM) == ("", [])
+
+    # Distant changes make separate hunks
+    new_program = new_program.replace("       MAIN-PARA.", "       MAIN-PARA.\n      * Entry point")
+    diff, changed = structured_diff(PROGRAM, new_program, context=0, paragraph_context=0)
+    assert changed == ["MAIN-PARA", "CALC-TOTAL"]
+    assert [line for line in diff.splitlines() if line.startswith("@@")] == [
+        "@@ -8,0 +8,1 @@ MAIN-PARA", "@@ -16,1 +17,1 @@ CALC-TOTAL"]
+
+
+def test_critic_diff_prefix_stable(monkeypatch):
+    """
+    Test that the critic prompt of the diff mode starts the same for candidates changing different paragraphs,
+    the changed paragraphs being listed with the changes.
+    """
+    # The diffs of such a short program are never worth it otherwise
+    monkeypatch.setattr(generation, "CRITIC_DIFF_MAX_RATIO", 10)
+    prompts = []
+    for old_line, new_line in (("ADD WS-PAY TO WS-TOTAL.", "ADD WS-PAY TO WS-TOTAL ROUNDED."),
+                               ("PERFORM READ-EMPLOYEE.", "PERFORM READ-EMPLOYEE THRU READ-EMPLOYEE.")):
+        inputs = critic_diff_inputs(PROGRAM, "", PROGRAM.replace(old_line, new_line))
+        prompts.append(ChatPromptTemplate.from_template(critic_diff_prompt({})).format(
+            previous_critic_description="", specific_demands="", atlas_answer="", **inputs))
+
+    prefixes = [prompt.split("Changes of the Newly Generated COBOL Code")[0] for prompt in prompts]
+    assert prefixes[0] == prefixes[1] and "*" not in prefixes[0]
+    assert "Changed paragraphs: CALC-TOTAL\n" in prompts[0]
+    assert "Changed paragraphs: MAIN-PARA\n" in prompts[1]
@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+from app.cobol_enhancer import response_handlers, transfer
+from app.cobol_enhancer.transfer import TransferManager, DirectoryBackend, TransferError, settle_transfers
+
+
+class CountingBackend(DirectoryBackend):
+    connections = 0
+
+    def connect(self):
+        CountingBackend.connections += 1
+
+
+def test_transfer_pool_reuses_connections(tmp_path):
+    """
+    Test that uploads are written to the target in the background over a single persistent connection.
+    """
+    manager = TransferManager(f"dir://{tmp_path}", pool_size=1, batch_size=4)
+    manager.create_backend = lambda: CountingBackend(str(tmp_path))
+
+    transfer_ids = [manager.submit(f"PAY00{i}", f"       DISPLAY '{i}'.\n".encode(), text=True) for i in range(10)]
+    assert [manager.wait(transfer_id, timeout=5).remote_name for transfer_id in transfer_ids] == \
+           [f"PAY00{i}" for i in range(10)]
+    manager.close()
+
+    assert CountingBackend.connections == 1
+    assert (tmp_path / "PAY007").read_bytes() == b"       DISPLAY '7'.\n"
+
+
+def test_transfer_failure_after_retries(tmp_path):
+    """
+    Test that a batch failing on every connection reports the failure of its uploads.
+    """
+    class FailingBackend(DirectoryBackend):
+        def upload(self, upload):
+            raise OSError("connection reset")
+
+    manager = TransferManager(f"dir://{tmp_path}", pool_size=1, retries=2)
+    manager.create_backend = lambda: FailingBackend(str(tmp_path))
+
+    with pytest.raises(TransferError, match="connection reset"):
+        manager.wait(manager.submit("PAY001", b"X"), timeout=5)
+    manager.close()
+
+
+def test_receiver_falls_back_on_upload_failure(tmp_path, monkeypatch):
+    """
+    Test that a failed upload is reported and its results asked in the terminal instead of ending the workflow,
+    and that the receiver leaves the uploads of the other files running.
+    """
+    class FailingBackend(DirectoryBackend):
+        def upload(self, upload):
+            if upload.remote_name == "PAY001.cob":
+                raise OSError("connection reset")
+            time.sleep(0.5)
+
+    manager = TransferManager(f"dir://{tmp_path}", pool_size=2, batch_size=1, retries=0)
+    manager.create_backend = lambda: FailingBackend(str(tmp_path))
+    monkeypatch.setattr(transfer, "_transfer_manager", manager)
+    monkeypatch.setattr(response_handlers, "RECEIVER_MODE", "spool")
+    answers = iter(["COMPILATION SUCCESSFUL", "END"])
+    monkeypatch.setattr("builtins.input", lambda: next(answers))
+
+    slow = manager.submit("ACC001.cob", b"X")
+    state = {"pending_transfers": [slow, manager.submit("PAY001.cob", b"X")]}
+    state = response_handlers.receiver(state)
+    assert state["atlas_answer"] == "COMPILATION SUCCESSFUL"
+    assert state["pending_transfers"] == [slow]
+
+    assert settle_transfers(state["pending_transfers"], wait=True) == []
+    manager.close()
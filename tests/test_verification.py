@@ -0,0 +1,86 @@
+import shutil
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from app.cobol_enhancer import verification
+from app.cobol_enhancer.blob_store import put_text
+from app.cobol_enhancer.verification import compare_runs, compile_and_run, recorded_cases, local_verification
+
+HELLO = """       IDENTIFICATION DIVISION.
+       PROGRAM-ID. HELLO.
+       PROCEDURE DIVISION.
+           DISPLAY "HELLO".
+           STOP RUN."""
+
+
+def test_compare_runs():
+    """
+    Test that differences in return code, standard output and written files are reported, and nothing else.
+    """
+    old = {"case1": {"returncode": 0, "stdout": "TOTAL 10\n", "files": {"OUT.DAT": "A\nB\n"}}}
+    assert compare_runs(old, old) == []
+
+    new = {"case1": {"returncode": 4, "stdout": "TOTAL 10\n", "files": {"OUT.DAT": "A\nC\n", "TMP.DAT": "X"}}}
+    differences = compare_runs(old, new)
+    assert len(differences) == 3
+    assert differences[0] == "Input case1: return code 4 instead of 0."
+    assert "-B" in differences[1] and "+C" in differences[1]
+    assert differences[2].startswith("Input case1, file TMP.DAT differs")
+
+
+def test_recorded_cases(tmp_path, monkeypatch):
+    """
+    Test that the input cases of a program are found in its directory of the inputs.
+    """
+    (tmp_path / "PAY001" / "month_end").mkdir(parents=True)
+    (tmp_path / "PAY001" / "empty").mkdir()
+    (tmp_path / "PAY001" / "README").write_text("not a case")
+    monkeypatch.setattr(verification, "VERIFY_INPUT_DIR", str(tmp_path))
+
+    assert [case.split("/")[-1] for case in recorded_cases("PAY001.cbl")] == ["empty", "month_end"]
+    assert recorded_cases("ACC001.cbl") == []
+
+
+def test_local_verification_without_cobc(monkeypatch):
+    """
+    Test that the candidate goes on unverified when the compiler is not installed.
+    """
+    monkeypatch.setattr(verification, "VERIFY_COBC", "cobc-not-installed")
+    state = local_verification({"filename": "PAY001.cbl"})
+    assert state["verification"] == {"status": "skipped"}
+
+
+def test_local_verification_pool_failure(monkeypatch):
+    """
+    Test that a candidate goes on unverified when the pool fails, and that the pool and the results of the
+    original program are dropped.
+    """
+    class BrokenExecutor:
+        def submit(self, function, *args):
+            future = Future()
+            future.set_exception(BrokenProcessPool("a worker died"))
+            return future
+
+    monkeypatch.setattr(verification.shutil, "which", lambda name: "/usr/bin/cobc")
+    monkeypatch.setattr(verification, "_executor", BrokenExecutor())
+    code = put_text("       DISPLAY 'HELLO'.")
+    state = local_verification({"filename": "PAY001.cbl", "old_code": code, "new_code": code, "copybooks": {}})
+    assert state["verification"] == {"status": "skipped"}
+    assert verification._executor is None
+    assert "PAY001.cbl" not in verification._original_results
+
+
+@pytest.mark.skipif(shutil.which("cobc") is None, reason="GnuCOBOL is not installed")
+def test_compile_and_run(tmp_path):
+    """
+    Test that a program is compiled and run on its inputs, and that compilation errors are reported.
+    """
+    (tmp_path / "case1").mkdir()
+    result = compile_and_run(HELLO, {}, [str(tmp_path / "case1")])
+    assert result["compiled"]
+    assert result["runs"]["case1"]["stdout"].strip() == "HELLO"
+
+    result = compile_and_run(HELLO.replace("STOP RUN", "STOP RUNN"), {}, [])
+    assert not result["compiled"] and result["compile_output"]